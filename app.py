@@ -1,11 +1,16 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.security import OAuth2PasswordBearer
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import sqlite3
+import asyncio
+import base64
+import json
+import time
 import jwt, sys, os
 import datetime
 import logging
 import bcrypt
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, Optional, Tuple
 from pydantic import BaseModel
 
 class LoginRequest(BaseModel):
@@ -21,10 +26,64 @@ logger = logging.getLogger(__name__)
 # ✅ Load AI Models Locally
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from Models.medbert import medbert  # Ensure correct import path
-from Models.biogpt import biogpt  # Ensure correct import path
+from inference import (Budget, InferencePool, MicroBatcher, ModelRegistry, PoolSaturated, BATCH_MAX_SIZE,
+                       INFERENCE_RETRY_AFTER, MODEL_PRELOAD, STOP_CANCELLED, STOP_COMPLETE, STOP_LENGTH,
+                       classify_and_embed, classify_batch, embed_query, generate_budgeted, generate_stream,
+                       length_buckets)
+from cache import ResponseCache, SemanticCache
+from sessions import SessionStore
+from auth import (AttemptLimiter, TokenCache, TooManyAttempts, AUTH_HASH_MAX_QUEUE, AUTH_HASH_WORKERS,
+                  LOGIN_IP_MAX_ATTEMPTS, LOGIN_USER_MAX_FAILURES, client_address,
+                  is_trusted_proxy)
+import database
+from database import ChatWriter, run_db
+from retention import RetentionJob
+from metrics import REGISTRY, CONTENT_TYPE, CallbackGauge, MetricsMiddleware, model_span, record_span, span
+from profiling import Profiler
+from weights import MMAP_WEIGHTS, memory_report
+from speculative import speculation_stats
+from scheduler import (PRIORITIES, PRIORITY_GUEST, PRIORITY_REGISTERED, Caller, FairScheduler, OverBurst,
+                       RateLimited)
+
+# ✅ Every request is timed per route and stage; see /metrics and the Server-Timing header
+app.add_middleware(MetricsMiddleware)
+
+# ✅ MedBERT and BioGPT load in the background; auth and history work meanwhile
+models = ModelRegistry()
+
+@app.on_event("startup")
+def preload_models():
+    if MODEL_PRELOAD:
+        models.start()
+
+# ✅ Model calls run on a bounded worker pool, never on the event loop
+inference_pool = InferencePool()
+
+# ✅ Registered users go before guests; each caller is capped, rate limited and queued fairly
+fair_scheduler = FairScheduler()
+
+# ✅ Concurrent /healthbot queries share one BioGPT forward pass
+generation_batcher = MicroBatcher(
+    lambda items: generate_budgeted(models.biogpt, [query for query, _ in items], [budget for _, budget in items]),
+    inference_pool)
+
+# ✅ Repeated questions are answered from cache; identical in-flight ones share a generation
+response_cache = ResponseCache()
+
+# ✅ Paraphrased questions are answered from the closest stored response (MedBERT embeddings)
+semantic_cache = SemanticCache()
+
+# ✅ Multi-turn conversations keep their context and KV cache per session
+session_store = SessionStore()
+
+# ✅ Admin-gated cProfile/torch profiler captures of sampled or flagged /healthbot requests
+profiler = Profiler()
+
+@app.on_event("shutdown")
+def save_caches():
+    response_cache.close()
+    semantic_cache.save()
 
-DATABASE = "health_chatbot.db"
 SECRET_KEY = os.getenv("SECRET_KEY")
 if SECRET_KEY is None:
     raise RuntimeError("SECRET_KEY environment variable is not set.")
@@ -32,184 +91,938 @@ ALGORITHM = "HS256"
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
-# ✅ Securely initialize SQLite DB
-def get_db():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    return conn, cursor
-
-# ✅ Create tables if they don't exist
-def init_db():
-    conn, cursor = get_db()
-    cursor.executescript(""" 
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL
-    );
-
-    CREATE TABLE IF NOT EXISTS chat_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        query TEXT NOT NULL,
-        response TEXT NOT NULL,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    );
-    """)
-    conn.commit()
-    conn.close()
-
-init_db()
+# ✅ bcrypt runs on its own capped pool so login bursts never block the event loop
+password_pool = InferencePool(AUTH_HASH_WORKERS, AUTH_HASH_MAX_QUEUE, name="bcrypt")
+
+# ✅ Brute-force throttling: failed attempts per client IP, failed logins per username
+# (which lets anyone knowing a username lock it out for LOGIN_WINDOW; see auth.py)
+ip_limiter = AttemptLimiter(LOGIN_IP_MAX_ATTEMPTS)
+user_limiter = AttemptLimiter(LOGIN_USER_MAX_FAILURES)
+
+# ✅ Recently verified tokens skip the JWT signature check
+token_cache = TokenCache()
+
+# ✅ Pooled WAL-mode SQLite; queries run off the event loop
+database.init_db()
+
+# ✅ Chat records are committed in batches behind the response
+chat_writer = ChatWriter()
+
+# ✅ Chat history past RETENTION_DAYS is archived and purged in the background
+retention_job = RetentionJob()
+
+@app.on_event("startup")
+def start_retention():
+    retention_job.start()
+
+@app.on_event("shutdown")
+async def close_database():
+    await retention_job.stop()
+    await chat_writer.close()
+    database.pool.close()
 
 # ✅ Token generation function
-def create_access_token(username: str) -> str:
+def create_access_token(username: str, user_id: int) -> str:
     expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
-    payload = {"sub": username, "exp": expiration}
+    payload = {"sub": username, "uid": user_id, "exp": expiration}
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
 # ✅ Token validation function
-def verify_token(token: str) -> str:
+def decode_token(token: str) -> dict:
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload["sub"]
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    token_cache.put(token, payload)
+    return payload
+
+# ✅ Resolve username and user id from the token (no DB lookup for tokens carrying "uid")
+async def get_current_user(token: str) -> Tuple[str, int]:
+    with span("token_verify"):
+        payload = decode_token(token)
+    username, user_id = payload["sub"], payload.get("uid")
+    if user_id is None:
+        # Tokens issued before user ids were embedded
+        with span("user_lookup"):
+            user_id = await run_db(database.fetch_user_id, username)
+        if user_id is None:
+            raise HTTPException(status_code=401, detail="User not found")
+    return username, user_id
+
+# ✅ Password hashing and verification (blocking; run them on password_pool)
+def hash_password(plain_password: str) -> str:
+    return bcrypt.hashpw(plain_password.encode('utf-8'), bcrypt.gensalt()).decode("utf-8")
 
-# ✅ Password verification function
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+# ✅ 429 with Retry-After once a key has used up its attempts (only failures are recorded)
+def throttle(limiter: AttemptLimiter, key: str):
+    try:
+        limiter.check(key)
+    except TooManyAttempts as e:
+        logger.warning(f"Throttled auth attempts for {key}")
+        raise HTTPException(status_code=429, detail="Too many attempts, please retry later",
+                            headers={"Retry-After": str(e.retry_after)})
+
+# ✅ Run a bcrypt call on password_pool, or 503 when its queue is full
+async def run_bcrypt(fn, *args):
+    try:
+        with span("bcrypt"), password_pool.admit():
+            return await password_pool.run(fn, *args)
+    except PoolSaturated as e:
+        raise HTTPException(status_code=503, detail="Server is busy, please retry shortly",
+                            headers={"Retry-After": str(e.retry_after)})
+
+# ✅ The end user's IP, read from X-Forwarded-For when the peer is one of TRUSTED_PROXIES
+def client_ip(request: Request) -> str:
+    peer = request.client.host if request.client else "unknown"
+    return client_address(peer, request.headers.get("x-forwarded-for"))
+
 # ✅ Register new user
 @app.post("/auth/register")
-async def register_user(user: LoginRequest):
+async def register_user(user: LoginRequest, http_request: Request):
     username = user.username
     password = user.password
 
     if not username or not password:
         raise HTTPException(status_code=400, detail="Username and password are required")
 
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode("utf-8")
+    ip_key = f"ip:{client_ip(http_request)}"
+    throttle(ip_limiter, ip_key)
+    hashed_password = await run_bcrypt(hash_password, password)
 
-    conn, cursor = get_db()
     try:
-        cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
-        conn.commit()
+        with span("user_insert"):
+            await run_db(database.insert_user, username, hashed_password)
         return {"message": "User registered successfully"}
     except sqlite3.IntegrityError:
+        ip_limiter.record(ip_key)  # probing for taken usernames counts against the address
         raise HTTPException(status_code=400, detail="Username already exists")
-    finally:
-        conn.close()
 
 # ✅ Login and return JWT token
 @app.post("/auth/login")
-async def login_user(request: LoginRequest):
+async def login_user(request: LoginRequest, http_request: Request):
     """Authenticate user and return JWT token"""
     logger.info(f"Login request received: {request}")
 
     # ✅ Convert Pydantic object to dictionary
     user_data = request.dict()
+    user_key = f"user:{user_data['username']}"
+    ip_key = f"ip:{client_ip(http_request)}"
 
-    conn, cursor = get_db()
+    # ✅ Refuse throttled callers before spending any bcrypt time on them
+    throttle(ip_limiter, ip_key)
+    throttle(user_limiter, user_key)
 
     # ✅ Fetch user from database
-    cursor.execute("SELECT * FROM users WHERE username = ?", (user_data["username"],))
-    user = cursor.fetchone()
+    with span("user_lookup"):
+        user = await run_db(database.fetch_user, user_data["username"])
 
-    if not user or not verify_password(user_data["password"], user[2]):  # user[2] is hashed_password
+    if not user or not await run_bcrypt(verify_password, user_data["password"], user[2]):  # user[2] is hashed_password
         logger.error("Invalid username or password")
+        ip_limiter.record(ip_key)
+        user_limiter.record(user_key)
         raise HTTPException(status_code=422, detail="Invalid username or password")
+    user_limiter.reset(user_key)
 
     # ✅ Generate JWT token
-    access_token = create_access_token(username=user_data["username"])
-    conn.close()
+    access_token = create_access_token(username=user_data["username"], user_id=user[0])
 
     return {"token": access_token}
 
-# ✅ Store user queries and bot responses
-@app.post("/healthbot")
-async def healthbot_response(request: Request, data: Dict[str, str]):
-    # Check for a guest token by inspecting the request headers
+# ✅ Resolve the caller: "Bearer guest" or a registered user's JWT
+async def get_request_user(request: Request) -> Tuple[str, Optional[int]]:
     auth_header = request.headers.get("Authorization")
     if auth_header and auth_header.startswith("Bearer guest"):
-        username = "Guest"
+        return "Guest", None
+    # Verify token for registered users
+    token = await oauth2_scheme(request)
+    return await get_current_user(token)
+
+# ✅ Store chat history for registered users
+async def save_chat(user_id: Optional[int], query: str, bot_response: str):
+    if user_id is None:
+        return
+    with span("history_insert"):
+        await chat_writer.submit(user_id, query, bot_response)
+
+# ✅ Who the scheduler queues a request under: registered users by id; guests by the per-session
+# X-Guest-Id a trusted proxy (the Streamlit app) sends, else by client IP
+GUEST_ID_MAX_LENGTH = 64
+
+def request_caller(request: Request, user_id: Optional[int]) -> Caller:
+    if user_id is not None:
+        return Caller(f"user:{user_id}", PRIORITY_REGISTERED)
+    guest_id = request.headers.get("x-guest-id")
+    if guest_id and request.client and is_trusted_proxy(request.client.host):
+        return Caller(f"guest:id:{guest_id[:GUEST_ID_MAX_LENGTH]}", PRIORITY_GUEST)
+    return Caller(f"guest:{client_ip(request)}", PRIORITY_GUEST)
+
+# ✅ Take from the caller's token bucket, or tell it when to come back (or that a batch is
+# bigger than its bucket can ever hold)
+def charge_request(caller: Caller, amount: int = 1, batch: bool = False):
+    try:
+        fair_scheduler.charge(caller, amount, batch)
+    except OverBurst as e:
+        raise HTTPException(status_code=413, detail=f"At most {e.burst} queries per batch for {caller.priority} callers")
+    except RateLimited as e:
+        logger.warning(f"Rate limited {caller.key}")
+        raise HTTPException(status_code=429, detail="Too many requests, please retry later",
+                            headers={"Retry-After": str(e.retry_after)})
+
+# ✅ Reserve an inference slot or tell the client when to come back; enter it with ``async with``
+# to wait for the scheduler (``cost``: the tokens the request may generate)
+def admit_inference(caller: Caller, cost: int):
+    if not models.ready:
+        models.start()
+        raise HTTPException(status_code=503, detail="Models are still loading, please retry shortly",
+                            headers={"Retry-After": str(INFERENCE_RETRY_AFTER)})
+    try:
+        return fair_scheduler.admit(inference_pool, caller, cost)
+    except PoolSaturated as e:
+        raise HTTPException(status_code=503, detail="Server is busy, please retry shortly",
+                            headers={"Retry-After": str(e.retry_after)})
+
+# ✅ Each generation runs within a token budget and deadline (server policy, optionally lowered by the client)
+DISCONNECT_POLL_S = float(os.getenv("DISCONNECT_POLL_S", "0.25"))
+
+def request_budget(max_new_tokens: Optional[int], timeout_s: Optional[float]) -> Budget:
+    if max_new_tokens is not None and max_new_tokens < 1:
+        raise HTTPException(status_code=400, detail="max_new_tokens must be at least 1")
+    if timeout_s is not None and timeout_s <= 0:
+        raise HTTPException(status_code=400, detail="timeout_s must be positive")
+    return Budget.for_request(max_new_tokens, timeout_s)
+
+def cacheable(budget: Budget, stop_reason: Optional[str]) -> bool:
+    # Answers cut short by a deadline, a disconnect or a lowered budget are only for this request
+    return stop_reason in (STOP_COMPLETE, STOP_LENGTH) and not budget.lowered
+
+# ✅ A conversation's first turn needs no context, so it is answered like any other question
+# (caches, batcher) and then seeds the session; only follow-ups run in the session.
+# Sessions live in the process that holds the models: with several API workers, set
+# MODEL_SERVER so every worker reaches the same sessions.
+async def session_started(username: str, session_id: Optional[str]) -> bool:
+    if not session_id or not models.ready:
+        return False
+    return await asyncio.get_running_loop().run_in_executor(
+        None, session_store.started, models.biogpt, username, session_id)
+
+async def seed_session(username: str, session_id: Optional[str], query: str, bot_response: str):
+    if session_id and models.ready:
+        await asyncio.get_running_loop().run_in_executor(
+            None, session_store.seed, models.biogpt, username, session_id, query, bot_response)
+
+# ✅ Awaitables run side by side; once one fails the others are cancelled instead of left running
+async def gather_or_cancel(*awaitables):
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+# ✅ Stop generating for clients that went away
+async def cancel_on_disconnect(request: Request, budget: Budget):
+    while not budget.cancelled:
+        if await request.is_disconnected():
+            logger.info("Client disconnected, cancelling its generation")
+            # Off the event loop: with a model server, cancelling is a call to it
+            await asyncio.get_running_loop().run_in_executor(None, budget.cancel)
+            return
+        await asyncio.sleep(DISCONNECT_POLL_S)
+
+# ✅ Store user queries and bot responses
+@app.post("/healthbot")
+async def healthbot_response(request: Request, response: Response, data: Dict[str, str], classify: bool = False,
+                             max_new_tokens: Optional[int] = None, timeout_s: Optional[float] = None):
+    with span("auth"):
+        username, user_id = await get_request_user(request)
+
+    query = data.get("query")
+    if not query:
+        raise HTTPException(status_code=400, detail="Query is required")
+    budget = request_budget(max_new_tokens, timeout_s)
+    caller = request_caller(request, user_id)
+    charge_request(caller)
+    watcher = asyncio.ensure_future(cancel_on_disconnect(request, budget))
+    try:
+        return await answer_healthbot(request, response, username, user_id, caller, query, data.get("session_id"),
+                                      classify, budget)
+    finally:
+        watcher.cancel()
+
+async def answer_healthbot(request: Request, response: Response, username: str, user_id: Optional[int],
+                           caller: Caller, query: str, session_id: Optional[str], classify: bool, budget: Budget):
+    semantic_hit = False
+
+    # Profile this request's model calls: always with a valid X-Profile header, or when sampled
+    profile_forced = profiler.is_admin(request.headers.get("x-profile"))
+    profile_id = profiler.new_id() if profile_forced or profiler.sampled() else None
+
+    async def run_model(label: str, fn, *args):
+        if profile_id is None:
+            return await inference_pool.run(fn, *args)
+        response.headers["X-Profile-Id"] = profile_id
+        return await inference_pool.run(profiler.capture, profile_id, label, fn, *args)
+
+    async def answer_in_session():
+        # Follow-ups depend on the conversation, so they skip the caches and the batcher
+        async with admit_inference(caller, budget.max_new_tokens) as ticket:
+            with span("generate"):
+                session = session_store.get(username, session_id)
+                generation = await run_model("generate", session_store.generate_turn, models.biogpt, session, query,
+                                             None, budget.max_new_tokens, budget)
+        record_span("queue_wait", ticket.wait_s)
+        response.headers["X-Queue-Depth"] = str(ticket.queue_depth)
+        response.headers["X-Queue-Wait-Ms"] = f"{ticket.wait_ms:.1f}"
+        return (generation.text, generation.stop_reason), "bypass"
+
+    # Returns (response, stop_reason), the value the response cache keeps
+    async def answer():
+        nonlocal semantic_hit
+        embedding = None
+        if encoding is not None:
+            # Awaited before admission since the shared pass holds a ticket of its own
+            with span("embed"):
+                embedding = (await asyncio.shield(encoding))[1]
+        # Reject early instead of queueing past the pool's limit
+        async with admit_inference(caller, budget.max_new_tokens) as ticket:
+            if semantic:
+                if encoding is None:
+                    with span("embed"):
+                        embedding = await inference_pool.run(embed_query, models.medbert, query)
+                with span("semantic_lookup"):
+                    recalled = await inference_pool.run(semantic_cache.lookup, embedding)
+                if recalled is not None:
+                    semantic_hit = True
+                    return recalled
+
+            # Generate response using BioGPT (batched with concurrent requests; alone when profiled)
+            with span("generate"):
+                if profile_id is None:
+                    generation = await generation_batcher.submit((query, budget))
+                else:
+                    generation = (await run_model("generate", generate_budgeted, models.biogpt, [query], [budget]))[0]
+            if cacheable(budget, generation.stop_reason):
+                semantic_cache.add(embedding, query, generation.text, generation.stop_reason)
+
+        record_span("queue_wait", ticket.wait_s)
+        response.headers["X-Queue-Depth"] = str(ticket.queue_depth)
+        response.headers["X-Queue-Wait-Ms"] = f"{ticket.wait_ms:.1f}"
+        return generation.text, generation.stop_reason
+
+    def classify_text(text: str):
+        with model_span("medbert", "classify"):
+            return models.medbert.classify_text(text)
+
+    async def classify_query():
+        if encoding is not None:
+            return (await encoding)[0]
+        async with admit_inference(caller, 1):
+            with span("classify"):
+                return await run_model("classify", classify_text, query)
+
+    async def encode_query():
+        async with admit_inference(caller, 1):
+            with span("classify"):
+                return await run_model("classify", classify_and_embed, models.medbert, query)
+
+    async def answer_uncached():
+        return await answer(), "bypass"
+
+    in_session = await session_started(username, session_id)
+    semantic = semantic_cache.enabled and not profile_forced and not budget.lowered and not in_session
+    # With ?classify=true, one MedBERT pass gives both the classification and the embedding
+    # the semantic lookup needs, rather than an extra embedding pass ahead of generation
+    encoding = asyncio.ensure_future(encode_query()) if classify and semantic else None
+    if in_session:
+        answering = answer_in_session()
+    elif profile_forced or budget.lowered:
+        answering = answer_uncached()
     else:
-        # Verify token for registered users
-        token = await oauth2_scheme(request)
-        username = verify_token(token)
+        answering = response_cache.get_or_compute(query, answer, lambda result: cacheable(budget, result[1]))
+
+    # MedBERT classification is opt-in (?classify=true) and runs alongside generation;
+    # profiled requests run the two in turn since one capture runs at a time
+    try:
+        if classify and profile_id is not None:
+            classification_result = await classify_query()
+            (bot_response, stop_reason), cache_status = await answering
+        elif classify:
+            classification_result, ((bot_response, stop_reason), cache_status) = await gather_or_cancel(
+                classify_query(), answering)
+        else:
+            (bot_response, stop_reason), cache_status = await answering
+    finally:
+        if encoding is not None:
+            encoding.cancel()
+    if semantic_hit:
+        cache_status = "semantic"
+    response.headers["X-Cache"] = cache_status
+
+    if stop_reason != STOP_CANCELLED:
+        if not in_session:
+            await seed_session(username, session_id, query, bot_response)
+        await save_chat(user_id, query, bot_response)
+
+    # Answers stopped by the token budget, the deadline or a disconnect are marked partial
+    result = {"response": bot_response, "partial": stop_reason not in (None, STOP_COMPLETE)}
+    if stop_reason is not None:
+        result["stop_reason"] = stop_reason
+    if session_id:
+        result["session_id"] = session_id
+    if classify:
+        result["classification"] = classification_result.tolist()
+    return result
+
+# ✅ A streamed body enters its ticket only once the server starts iterating it; if the
+# client goes away before that, the ticket is discarded so its admission slot comes back
+class AdmittedStreamingResponse(StreamingResponse):
+    def __init__(self, ticket, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self.ticket = ticket
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Unwind a body left suspended mid-stream, then release a ticket it never entered
+            await self.body_iterator.aclose()
+            self.ticket.discard()
+
+# ✅ Stream the bot response token by token as server-sent events
+@app.post("/healthbot/stream")
+async def healthbot_stream(request: Request, data: Dict[str, str], max_new_tokens: Optional[int] = None,
+                           timeout_s: Optional[float] = None):
+    with span("auth"):
+        username, user_id = await get_request_user(request)
 
     query = data.get("query")
     if not query:
         raise HTTPException(status_code=400, detail="Query is required")
+    budget = request_budget(max_new_tokens, timeout_s)
+    caller = request_caller(request, user_id)
+    charge_request(caller)
+
+    session_id = data.get("session_id")
+    in_session = await session_started(username, session_id)
+    cached = None if in_session or budget.lowered else response_cache.get(query)
+    if cached is not None:
+        cached_response, cached_stop_reason = cached
+        await seed_session(username, session_id, query, cached_response)
+        await save_chat(user_id, query, cached_response)
+        response_cache.hits += 1
+
+        async def cached_events():
+            yield f"data: {json.dumps({'token': cached_response})}\n\n"
+            done = {"response": cached_response, "partial": cached_stop_reason not in (None, STOP_COMPLETE),
+                    "ttft_ms": 0.0, "total_ms": 0.0}
+            if cached_stop_reason is not None:
+                done["stop_reason"] = cached_stop_reason
+            yield f"event: done\ndata: {json.dumps(done)}\n\n"
+
+        return StreamingResponse(cached_events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Cache": "hit"})
+
+    ticket = admit_inference(caller, budget.max_new_tokens)
+
+    async def events():
+        loop = asyncio.get_running_loop()
+        pieces: asyncio.Queue = asyncio.Queue()
+
+        def on_text(text: str):
+            loop.call_soon_threadsafe(pieces.put_nowait, text)
+
+        async with ticket:
+            started = time.perf_counter()
+            ttft_ms = None
+            if session_id:
+                session = session_store.get(username, session_id)
+                generation = asyncio.ensure_future(inference_pool.run(
+                    session_store.generate_turn, models.biogpt, session, query, on_text, budget.max_new_tokens,
+                    budget))
+            else:
+                generation = asyncio.ensure_future(inference_pool.run(
+                    generate_stream, models.biogpt, query, on_text, budget.max_new_tokens, budget))
+            # Text callbacks are queued on the loop before the result, so None marks the end
+            generation.add_done_callback(lambda _: pieces.put_nowait(None))
+            watcher = asyncio.ensure_future(cancel_on_disconnect(request, budget))
+            try:
+                while (text := await pieces.get()) is not None:
+                    if ttft_ms is None:
+                        ttft_ms = (time.perf_counter() - started) * 1000
+                        record_span("ttft", ttft_ms / 1000)
+                    yield f"data: {json.dumps({'token': text})}\n\n"
+            finally:
+                watcher.cancel()
+                if not generation.done():
+                    # The stream was closed under us (client gone): stop generating
+                    loop.run_in_executor(None, budget.cancel)
+
+            try:
+                bot_response, stop_reason = generation.result()
+            except Exception:
+                logger.exception("Streaming generation failed")
+                yield f"event: error\ndata: {json.dumps({'detail': 'Generation failed'})}\n\n"
+                return
+
+        total_ms = (time.perf_counter() - started) * 1000
+        record_span("generate", total_ms / 1000)
+        record_span("queue_wait", ticket.wait_s)
+        logger.info(f"Streamed response: ttft={ttft_ms or total_ms:.0f}ms total={total_ms:.0f}ms stop={stop_reason}")
+        if stop_reason == STOP_CANCELLED:
+            return
+        if not in_session:
+            response_cache.misses += 1
+            if cacheable(budget, stop_reason):
+                response_cache.put(query, bot_response, stop_reason)
+        await save_chat(user_id, query, bot_response)
+        done = {"response": bot_response, "partial": stop_reason != STOP_COMPLETE, "stop_reason": stop_reason,
+                "ttft_ms": round(ttft_ms or total_ms, 1), "total_ms": round(total_ms, 1)}
+        yield f"event: done\ndata: {json.dumps(done)}\n\n"
+
+    return AdmittedStreamingResponse(ticket, events(), media_type="text/event-stream",
+                                     headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ✅ Bulk questions in one call: one MedBERT pass, BioGPT in length-bucketed batches
+# (a registered user's batch bucket, SCHEDULER_REGISTERED_BATCH_BURST, holds this many queries by default)
+HEALTHBOT_BATCH_MAX_QUERIES = int(os.getenv("HEALTHBOT_BATCH_MAX_QUERIES", "256"))
+HEALTHBOT_BATCH_GENERATE_SIZE = int(os.getenv("HEALTHBOT_BATCH_GENERATE_SIZE", str(BATCH_MAX_SIZE)))
+HEALTHBOT_BATCH_CLASSIFY_SIZE = int(os.getenv("HEALTHBOT_BATCH_CLASSIFY_SIZE", "64"))
+
+class BatchQueries(BaseModel):
+    queries: List[Any]  # validated per item so one bad entry does not reject the batch
+
+async def run_isolated(fn, wrapper, items: List[str]) -> list:
+    """``fn(wrapper, items)`` on the pool; if the batch fails, each item is retried alone.
+
+    Items that still fail hold their exception instead of a result.
+    """
+    try:
+        return await inference_pool.run(fn, wrapper, items)
+    except Exception as e:
+        if len(items) == 1:
+            return [e]
+        logger.warning(f"Batch of {len(items)} failed ({e}), retrying one by one")
+    results = []
+    for item in items:
+        try:
+            results.extend(await inference_pool.run(fn, wrapper, [item]))
+        except Exception as e:
+            results.append(e)
+    return results
+
+async def healthbot_batch_items(user_id: Optional[int], queries: list, classify: bool,
+                                budget: Optional[Budget] = None):
+    """Yield one result per query as it completes; each carries its ``index``.
+
+    ``budget`` covers the whole batch: once its deadline passes the remaining
+    queries come back as empty partial answers.
+    """
+    budget = budget or Budget.for_request()
+    valid = []
+    for index, query in enumerate(queries):
+        if isinstance(query, str) and query.strip():
+            valid.append(index)
+        else:
+            yield {"index": index, "error": "Query is required"}
+
+    classifications = {}
+    if classify and valid:
+        with span("classify"):
+            for start in range(0, len(valid), HEALTHBOT_BATCH_CLASSIFY_SIZE):
+                chunk = valid[start:start + HEALTHBOT_BATCH_CLASSIFY_SIZE]
+                results = await run_isolated(classify_batch, models.medbert, [queries[i] for i in chunk])
+                classifications.update(zip(chunk, results))
+
+    def result(index: int, bot_response, cache_status: str, stop_reason: Optional[str] = None) -> dict:
+        item = {"index": index, "query": queries[index]}
+        if isinstance(bot_response, Exception):
+            item["error"] = "Generation failed"
+        else:
+            item["response"] = bot_response
+            item["cache"] = cache_status
+            item["partial"] = stop_reason not in (None, STOP_COMPLETE)
+            if stop_reason is not None:
+                item["stop_reason"] = stop_reason
+        if classify:
+            classification = classifications[index]
+            if isinstance(classification, Exception):
+                item["error"] = "Classification failed"
+            else:
+                item["classification"] = classification.tolist()
+        return item
+
+    # Repeated questions are generated once; cached ones not at all
+    misses: Dict[str, List[int]] = {}
+    for index in valid:
+        query = queries[index]
+        cached = None if budget.lowered else response_cache.get(query)
+        if cached is None:
+            misses.setdefault(query, []).append(index)
+            continue
+        response_cache.hits += 1
+        if user_id is not None:
+            await chat_writer.submit(user_id, query, cached[0])
+        yield result(index, cached[0], "hit", cached[1])
+
+    def generate(wrapper, bucket_queries: List[str]) -> list:
+        return generate_budgeted(wrapper, bucket_queries, [budget] * len(bucket_queries))
+
+    unique = list(misses)
+    generating = 0.0
+    for bucket in await inference_pool.run(length_buckets, models.biogpt, unique, HEALTHBOT_BATCH_GENERATE_SIZE):
+        started = time.perf_counter()
+        generated = await run_isolated(generate, models.biogpt, [unique[i] for i in bucket])
+        generating += time.perf_counter() - started
+        for i, generation in zip(bucket, generated):
+            query = unique[i]
+            if isinstance(generation, Exception):
+                logger.error(f"Batch generation failed for one query: {generation}")
+                bot_response, stop_reason = generation, None
+            else:
+                bot_response, stop_reason = generation
+                response_cache.misses += 1
+                if cacheable(budget, stop_reason):
+                    response_cache.put(query, bot_response, stop_reason)
+            for index in misses[query]:
+                if user_id is not None and stop_reason not in (None, STOP_CANCELLED):
+                    await chat_writer.submit(user_id, query, bot_response)
+                yield result(index, bot_response, "miss", stop_reason)
+    record_span("generate", generating)
+
+@app.post("/healthbot/batch")
+async def healthbot_batch(request: Request, data: BatchQueries, classify: bool = False, format: str = "json",
+                          max_new_tokens: Optional[int] = None, timeout_s: Optional[float] = None):
+    with span("auth"):
+        _, user_id = await get_request_user(request)
+
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be json or ndjson")
+    if not data.queries:
+        raise HTTPException(status_code=400, detail="queries is required")
+    if len(data.queries) > HEALTHBOT_BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {HEALTHBOT_BATCH_MAX_QUERIES} queries per batch")
+
+    budget = request_budget(max_new_tokens, timeout_s)
+    caller = request_caller(request, user_id)
+    charge_request(caller, len(data.queries), batch=True)
+
+    # The whole batch holds one admission slot and runs its model calls one after another
+    ticket = admit_inference(caller, budget.max_new_tokens * len(data.queries))
 
-    # Process input with MedBERT
-    classification_result = medbert.classify_text(query)
+    async def items():
+        watcher = asyncio.ensure_future(cancel_on_disconnect(request, budget))
+        produced = healthbot_batch_items(user_id, data.queries, classify, budget)
+        try:
+            # Exits even when the stream is closed from another task (see Ticket.__exit__)
+            async with ticket:
+                async for item in produced:
+                    yield item
+        finally:
+            watcher.cancel()
+            await produced.aclose()
+        record_span("queue_wait", ticket.wait_s)
 
-    # Generate response using BioGPT
-    bot_response = biogpt.generate_response(query)
+    if format == "ndjson":
+        # ✅ Streamed in completion order, one JSON object per line
+        async def lines():
+            results = items()
+            try:
+                async for item in results:
+                    yield json.dumps(item) + "\n"
+            finally:
+                await results.aclose()  # exit the ticket with the stream, not when collected
 
-    # Store chat history for registered users
-    if username != "Guest":
-        conn, cursor = get_db()
-        cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
-        if user:
-            user_id = user[0]
-            cursor.execute("INSERT INTO chat_history (user_id, query, response) VALUES (?, ?, ?)", 
-                           (user_id, query, bot_response))
-            conn.commit()
-        conn.close()
+        return AdmittedStreamingResponse(ticket, lines(), media_type="application/x-ndjson")
 
-    return {"classification": classification_result.tolist(), "response": bot_response}
+    results = sorted([item async for item in items()], key=lambda item: item["index"])
+    return {"results": results, "failed": sum("error" in item for item in results),
+            "partial": sum(item.get("partial", False) for item in results)}
 
-# ✅ Retrieve all chat history for the logged-in user
+# ✅ Liveness: the process is up and serving requests
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+# ✅ Readiness: models are loaded (and warmed up) so /healthbot can answer
+@app.get("/readyz")
+async def readyz(response: Response):
+    status = models.status()
+    if not status["ready"]:
+        response.status_code = 503
+    return status
+
+# ✅ Inference pool status (queue depth, wait and service times) and cache counters
+@app.get("/inference/stats")
+async def inference_stats():
+    model_server = mapped_weights = speculative = None
+    if models.client is not None:
+        model_server = await asyncio.get_running_loop().run_in_executor(None, models.client.stats)
+    else:
+        speculative = speculation_stats.stats()
+        if MMAP_WEIGHTS:
+            mapped_weights = memory_report(os.getpid())["weights"]
+    return {
+        "pool": inference_pool.stats(),
+        "scheduler": fair_scheduler.stats(),
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "sessions": session_store.stats(),
+        "model_server": model_server,
+        "mapped_weights": mapped_weights,
+        "speculative": speculative,
+        "chat_writer": chat_writer.stats(),
+        "retention": retention_job.stats(),
+        "auth": {
+            "password_pool": password_pool.stats(),
+            "ip_limiter": ip_limiter.stats(),
+            "user_limiter": user_limiter.stats(),
+            "token_cache": token_cache.stats(),
+        },
+    }
+
+# ✅ Profiling admin: status and dumps (GET), runtime sample rate (POST)
+def require_profile_admin(request: Request):
+    if not profiler.enabled:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    if not profiler.is_admin(request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/admin/profiling")
+async def profiling_status(request: Request):
+    require_profile_admin(request)
+    return profiler.status()
+
+@app.post("/admin/profiling")
+async def configure_profiling(request: Request, data: Dict[str, float]):
+    require_profile_admin(request)
+    rate = data.get("sample_rate")
+    if rate is None or not 0 <= rate <= 1:
+        raise HTTPException(status_code=400, detail="sample_rate between 0 and 1 is required")
+    profiler.sample_rate = rate
+    logger.info(f"Profiling sample rate set to {rate}")
+    return profiler.status()
+
+# ✅ Scrape-time gauges for state other components already track
+def _pool_gauge(key: str):
+    return lambda: {("inference",): inference_pool.stats()[key], ("bcrypt",): password_pool.stats()[key]}
+
+def _cache_counts():
+    response_stats, semantic_stats = response_cache.stats(), semantic_cache.stats()
+    counts = {("response", outcome): response_stats[outcome] for outcome in ("hits", "misses", "coalesced")}
+    counts.update({("semantic", outcome): semantic_stats[outcome] for outcome in ("hits", "misses")})
+    return counts
+
+def _scheduler_counts():
+    running, waiting = fair_scheduler.counts("running"), fair_scheduler.counts("waiting")
+    counts = {(priority, "running"): running[priority] for priority in PRIORITIES}
+    counts.update({(priority, "waiting"): waiting[priority] for priority in PRIORITIES})
+    return counts
+
+_model_bytes: Dict[int, int] = {}
+
+def _model_memory():
+    """Parameter and buffer bytes of each loaded torch model (computed once per model object)."""
+    if not models.ready:
+        return None
+    sizes = {}
+    for name in ("medbert", "biogpt"):
+        model = getattr(getattr(models, name), "model", None)
+        if not hasattr(model, "state_dict"):
+            continue
+        if id(model) not in _model_bytes:
+            _model_bytes[id(model)] = sum(t.numel() * t.element_size() for t in model.state_dict().values()
+                                          if hasattr(t, "element_size"))
+        sizes[(name,)] = _model_bytes[id(model)]
+    return sizes
+
+def _process_rss():
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+for gauge in (
+    CallbackGauge("healthbot_models_ready", "1 once MedBERT and BioGPT are loaded.", lambda: int(models.ready)),
+    CallbackGauge("worker_pool_queue_depth", "Admitted requests waiting for a worker thread.",
+                  _pool_gauge("queue_depth"), ("pool",)),
+    CallbackGauge("worker_pool_in_flight", "Requests admitted to the pool (running or queued).",
+                  _pool_gauge("in_flight"), ("pool",)),
+    CallbackGauge("scheduler_requests", "Inference requests holding a scheduler slot or waiting for one, by class.",
+                  _scheduler_counts, ("priority", "state")),
+    CallbackGauge("cache_lookups_total", "Response and semantic cache lookups by outcome.",
+                  _cache_counts, ("cache", "outcome"), kind="counter"),
+    CallbackGauge("cache_entries", "Entries held by each cache.", lambda: {
+        ("response",): response_cache.stats()["entries"], ("semantic",): semantic_cache.stats()["entries"]}, ("cache",)),
+    CallbackGauge("session_kv_cache_bytes", "Bytes held by per-session KV caches.",
+                  lambda: session_store.stats()["cache_mb"] * 2**20),
+    CallbackGauge("chat_writer_queued", "Chat records waiting to be committed.", lambda: chat_writer.stats()["queued"]),
+    CallbackGauge("retention_runs_total", "Completed chat history retention runs.",
+                  lambda: retention_job.runs, kind="counter"),
+    CallbackGauge("retention_rows_total", "Expired chat records archived and purged by retention.", lambda: {
+        ("archived",): retention_job.rows_archived, ("purged",): retention_job.rows_purged}, ("outcome",),
+                  kind="counter"),
+    CallbackGauge("retention_pages_reclaimed_total", "Database pages returned to the filesystem by retention.",
+                  lambda: retention_job.pages_reclaimed, kind="counter"),
+    CallbackGauge("retention_write_transactions_total", "Write transactions taken by retention purges and vacuums.",
+                  lambda: retention_job.transactions, kind="counter"),
+    CallbackGauge("retention_lock_hold_seconds_total", "Time retention held the database write lock.",
+                  lambda: retention_job.lock_hold_total_ms / 1000, kind="counter"),
+    CallbackGauge("model_memory_bytes", "Parameter and buffer bytes of each loaded model.", _model_memory, ("model",)),
+    CallbackGauge("process_resident_memory_bytes", "Resident set size of the API process.", _process_rss),
+):
+    REGISTRY.register(gauge)
+
+# ✅ Prometheus scrape endpoint
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+# ✅ Chat history is served newest first in keyset pages: the cursor is the
+# (timestamp, id) of the last row returned, so deep pages cost the same as the first
+HISTORY_DEFAULT_LIMIT = 100
+HISTORY_MAX_LIMIT = 1000
+HISTORY_STREAM_PAGE = 500
+
+def encode_history_cursor(timestamp: str, record_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([timestamp, record_id]).encode()).decode()
+
+def decode_history_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        timestamp, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(timestamp), int(record_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def parse_history_bound(value: str, name: str, end: bool = False) -> str:
+    """ISO date or datetime -> chat_history timestamp text; a date-only ``until`` covers that whole day."""
+    try:
+        if len(value) == 10:
+            moment = datetime.datetime.strptime(value, "%Y-%m-%d")
+            if end:
+                moment += datetime.timedelta(days=1)
+        else:
+            moment = datetime.datetime.fromisoformat(value)
+            if moment.tzinfo is not None:
+                moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}, expected an ISO date or datetime")
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+def parse_history_fields(fields: Optional[str]) -> Tuple[str, ...]:
+    if not fields:
+        return database.HISTORY_COLUMNS
+    requested = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = requested - set(database.HISTORY_COLUMNS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    # id and timestamp are always returned, they make up the cursor
+    return tuple(c for c in database.HISTORY_COLUMNS if c in requested or c in ("id", "timestamp"))
+
+# ✅ Retrieve the logged-in user's chat history
 @app.get("/chat_history/")
-async def get_chat_history(token: str = Depends(oauth2_scheme)):
-    username = verify_token(token)
+async def get_chat_history(
+    token: str = Depends(oauth2_scheme),
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    fields: Optional[str] = None,
+    format: str = "json",
+):
+    _, user_id = await get_current_user(token)
+    with span("history_flush"):
+        await chat_writer.flush_user(user_id)  # read-your-writes
+
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be json or ndjson")
+    if limit is not None and not 1 <= limit <= HISTORY_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {HISTORY_MAX_LIMIT}")
+    columns = parse_history_fields(fields)
+    since = parse_history_bound(since, "since") if since else None
+    until = parse_history_bound(until, "until", end=True) if until else None
+    after = decode_history_cursor(cursor) if cursor else None
+    id_at, timestamp_at = columns.index("id"), columns.index("timestamp")
 
-    conn, cursor = get_db()
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+    if format == "ndjson":
+        # ✅ Export: one row per line, fetched a page at a time so the full history is never held
+        async def rows():
+            position, remaining = after, limit
+            while remaining is None or remaining > 0:
+                page_size = HISTORY_STREAM_PAGE if remaining is None else min(remaining, HISTORY_STREAM_PAGE)
+                with span("db_query"):
+                    page = await run_db(database.fetch_history_page, user_id, columns, since, until, position, page_size)
+                for record in page:
+                    yield json.dumps(dict(zip(columns, record))) + "\n"
+                if len(page) < page_size:
+                    break
+                position = (page[-1][timestamp_at], page[-1][id_at])
+                if remaining is not None:
+                    remaining -= len(page)
 
-    user_id = user[0]
-    cursor.execute("SELECT id, query, response, timestamp FROM chat_history WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-    chat_records = cursor.fetchall()
-    conn.close()
+        return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+    limit = limit or HISTORY_DEFAULT_LIMIT
+    # One extra row tells whether another page follows
+    with span("db_query"):
+        chat_records = await run_db(database.fetch_history_page, user_id, columns, since, until, after, limit + 1)
+    next_cursor = None
+    if len(chat_records) > limit:
+        chat_records = chat_records[:limit]
+        last = chat_records[-1]
+        next_cursor = encode_history_cursor(last[timestamp_at], last[id_at])
 
     history_by_date = {}
     for record in chat_records:
-        record_id, query, response, timestamp = record
-        date = timestamp.split(" ")[0]
+        date = record[timestamp_at].split(" ")[0]
         if date not in history_by_date:
             history_by_date[date] = []
-        history_by_date[date].append({
-            "id": record_id,
-            "query": query,
-            "response": response,
-            "timestamp": timestamp
-        })
+        history_by_date[date].append(dict(zip(columns, record)))
+
+    return {"history": history_by_date, "next_cursor": next_cursor}
 
-    return {"history": history_by_date}
+# ✅ Full-text search over the user's chats, best match first (declared before /{chat_id})
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+@app.get("/chat_history/search")
+async def search_chat_history(q: str, token: str = Depends(oauth2_scheme), limit: int = SEARCH_DEFAULT_LIMIT,
+                              offset: int = 0):
+    _, user_id = await get_current_user(token)
+    if not 1 <= limit <= SEARCH_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {SEARCH_MAX_LIMIT}")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="offset must not be negative")
+    expression = database.search_expression(q)
+    if expression is None:
+        raise HTTPException(status_code=400, detail="Search query has no words")
+    with span("history_flush"):
+        await chat_writer.flush_user(user_id)
+
+    # One extra row tells whether another page follows
+    with span("db_query"):
+        rows = await run_db(database.search_history, user_id, expression, limit + 1, offset)
+    next_offset = offset + limit if len(rows) > limit else None
+    return {"results": [dict(zip(database.SEARCH_COLUMNS, row)) for row in rows[:limit]], "next_offset": next_offset}
 
 # ✅ Retrieve a specific chat history
 @app.get("/chat_history/{chat_id}")
 async def get_chat_detail(chat_id: int, token: str = Depends(oauth2_scheme)):
-    username = verify_token(token)
+    _, user_id = await get_current_user(token)
+    with span("history_flush"):
+        await chat_writer.flush_user(user_id)
 
-    conn, cursor = get_db()
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-
-    user_id = user[0]
-    cursor.execute("SELECT query, response, timestamp FROM chat_history WHERE id = ? AND user_id = ?", (chat_id, user_id))
-    chat_record = cursor.fetchone()
-    conn.close()
+    with span("db_query"):
+        chat_record = await run_db(database.fetch_chat, chat_id, user_id)
 
     if not chat_record:
         raise HTTPException(status_code=404, detail="Chat not found")
@@ -223,17 +1036,11 @@ async def get_chat_detail(chat_id: int, token: str = Depends(oauth2_scheme)):
 # ✅ Delete chat history
 @app.delete("/chat_history/delete/")
 async def delete_chat_history(token: str = Depends(oauth2_scheme)):
-    username = verify_token(token)
-
-    conn, cursor = get_db()
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+    _, user_id = await get_current_user(token)
+    with span("history_flush"):
+        await chat_writer.flush_user(user_id)  # queued rows must not outlive the delete
 
-    user_id = user[0]
-    cursor.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with span("db_query"):
+        deleted = await run_db(database.delete_history, user_id)
 
-    return {"message": "Chat history deleted successfully"}
\ No newline at end of file
+    return {"message": "Chat history deleted successfully", "deleted": deleted}
\ No newline at end of file
@@ -0,0 +1,178 @@
+"""Login throttling and verified-token caching for the auth routes.
+
+bcrypt hashing and checking take 100-300 ms of CPU, so the API runs them on
+their own small ``InferencePool`` (``AUTH_HASH_WORKERS`` threads, at most
+``AUTH_HASH_MAX_QUEUE`` waiting) and a login burst can only ever occupy
+those threads, never the event loop.
+
+``AttemptLimiter`` is a sliding-window counter per key (client IP or
+username); once a key reaches its limit, further attempts are refused with a
+Retry-After until the oldest attempt leaves the window.  Only failed
+attempts are counted, so clients sharing an address (behind NAT, or every
+Streamlit user when the address is not resolved) are not capped by each
+other's successful logins.  The per-username limit means anyone who knows a
+username can lock its owner out for ``LOGIN_WINDOW`` seconds by failing
+``LOGIN_USER_MAX_FAILURES`` logins; that is the price of stopping password
+guessing spread across many addresses, and the lockout lifts by itself.
+
+``client_address`` resolves the client's IP: the peer address, unless the
+peer is one of ``TRUSTED_PROXIES`` (e.g. the Streamlit server or a reverse
+proxy), in which case the nearest untrusted hop of ``X-Forwarded-For``.
+List a proxy only if it sets that header itself: one that passes on what
+the browser sent lets every client pick its own address, and with it a
+fresh ``LOGIN_IP_MAX_ATTEMPTS`` allowance on each try.  The Streamlit app
+forwards the header only when ``STREAMLIT_FORWARD_CLIENT_IP=1``, for
+deployments with a reverse proxy in front of it that overwrites the
+header; otherwise every Streamlit user shares its address.
+
+``TokenCache`` keeps the payloads of recently verified JWTs so repeat
+requests skip the signature check; an entry never outlives the token's own
+``exp``.
+"""
+import ipaddress
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Optional, Tuple
+
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", "2"))
+AUTH_HASH_MAX_QUEUE = int(os.getenv("AUTH_HASH_MAX_QUEUE", "16"))
+LOGIN_IP_MAX_ATTEMPTS = int(os.getenv("LOGIN_IP_MAX_ATTEMPTS", "30"))  # failed attempts, per client IP
+LOGIN_USER_MAX_FAILURES = int(os.getenv("LOGIN_USER_MAX_FAILURES", "5"))  # failed logins, per username
+LOGIN_WINDOW = float(os.getenv("LOGIN_WINDOW", "300"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+TRUSTED_PROXIES = os.getenv("TRUSTED_PROXIES", "")  # comma-separated IPs/CIDRs allowed to set X-Forwarded-For
+
+
+def parse_networks(spec: str) -> Tuple:
+    return tuple(ipaddress.ip_network(part.strip(), strict=False) for part in spec.split(",") if part.strip())
+
+
+TRUSTED_NETWORKS = parse_networks(TRUSTED_PROXIES)
+
+
+def is_trusted_proxy(address: str, networks: Tuple = TRUSTED_NETWORKS) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in networks)
+
+
+def client_address(peer: str, forwarded_for: Optional[str], networks: Tuple = TRUSTED_NETWORKS) -> str:
+    """The client's IP: ``peer``, or if it is a trusted proxy the last ``X-Forwarded-For`` hop it did not add.
+
+    Hops are read right to left, since only the ones appended by trusted
+    proxies can be believed; the first untrusted one is the client.
+    """
+    if not forwarded_for or not is_trusted_proxy(peer, networks):
+        return peer
+    hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop, networks):
+            return hop
+    return hops[0] if hops else peer
+
+
+class TooManyAttempts(Exception):
+    """Raised by ``AttemptLimiter.check`` while a key is over its limit."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Too many attempts, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AttemptLimiter:
+    """At most ``max_attempts`` per key in any ``window_seconds``."""
+
+    def __init__(self, max_attempts: int, window_seconds: float = LOGIN_WINDOW, max_keys: int = 100_000):
+        self.max_attempts = max(1, max_attempts)
+        self.window = window_seconds
+        self.max_keys = max_keys
+        self._attempts: "OrderedDict[str, Deque[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def _recent(self, key: str, now: float) -> Optional[Deque[float]]:
+        attempts = self._attempts.get(key)
+        if attempts is None:
+            return None
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+        if not attempts:
+            del self._attempts[key]
+            return None
+        return attempts
+
+    def check(self, key: str):
+        """Raise ``TooManyAttempts`` if ``key`` has used up its window."""
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._recent(key, now)
+            if attempts is not None and len(attempts) >= self.max_attempts:
+                self.rejected += 1
+                raise TooManyAttempts(max(1, int(attempts[0] + self.window - now) + 1))
+
+    def record(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._recent(key, now)
+            if attempts is None:
+                attempts = self._attempts[key] = deque()
+            attempts.append(now)
+            self._attempts.move_to_end(key)
+            while len(self._attempts) > self.max_keys:
+                self._attempts.popitem(last=False)
+
+    def reset(self, key: str):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tracked_keys": len(self._attempts), "max_attempts": self.max_attempts,
+                    "window_s": self.window, "rejected": self.rejected}
+
+
+class TokenCache:
+    """LRU of verified JWT payloads, each kept until ``min(now + ttl, exp)``."""
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_SIZE, ttl_seconds: float = TOKEN_CACHE_TTL):
+        self.max_entries = max(0, max_entries)
+        self.ttl = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[1] > time.time():
+                self._entries.move_to_end(token)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token: str, payload: dict):
+        if not self.max_entries:
+            return
+        expires_at = time.time() + self.ttl
+        if "exp" in payload:
+            expires_at = min(expires_at, float(payload["exp"]))
+        with self._lock:
+            self._entries[token] = (payload, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits,
+                    "misses": self.misses, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0}
@@ -0,0 +1,157 @@
+"""CPU inference backends for the MedBERT and BioGPT wrappers.
+
+``apply_backend`` swaps the HF model inside a wrapper for one of:
+
+* ``fp32`` - the PyTorch model as loaded, in float32.
+* ``int8`` - torch dynamic quantization: ``nn.Linear`` weights stored as int8,
+  activations quantized on the fly.  No calibration data needed.
+* ``onnx`` - the model exported to ONNX and run with onnxruntime.  MedBERT is
+  exported with ``torch.onnx.export``; BioGPT needs ``optimum`` for an
+  exported graph that supports ``generate``.  Both are optional
+  dependencies (``pip install onnxruntime optimum[onnxruntime]``).
+
+The wrapper's own ``classify_text``/``generate_response`` keep working since
+the replacement model is called the same way.
+"""
+import logging
+import os
+import torch
+from transformers.modeling_outputs import SequenceClassifierOutput
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("fp32", "int8", "onnx")
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "fp32")
+MEDBERT_BACKEND = os.getenv("MEDBERT_BACKEND", INFERENCE_BACKEND)
+BIOGPT_BACKEND = os.getenv("BIOGPT_BACKEND", INFERENCE_BACKEND)
+ONNX_EXPORT_DIR = os.getenv("ONNX_EXPORT_DIR", "onnx_models")
+
+
+def apply_backend(wrapper, backend: str, name: str):
+    """Replace ``wrapper.model`` in place with the ``backend`` variant.
+
+    ``name`` ("medbert" or "biogpt") picks the ONNX export strategy and the
+    file name under ``ONNX_EXPORT_DIR``.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {BACKENDS}")
+    if not hasattr(wrapper, "model"):
+        logger.warning(f"{name} wrapper exposes no model; keeping its own backend")
+        return wrapper
+
+    if backend == "fp32":
+        wrapper.model = wrapper.model.float().eval()
+    elif backend == "int8":
+        wrapper.model = quantize_int8(wrapper.model)
+    elif name == "biogpt":
+        wrapper.model = export_onnx_causal_lm(wrapper.model, os.path.join(ONNX_EXPORT_DIR, name))
+    else:
+        wrapper.model = OnnxSequenceClassifier.export(
+            wrapper.model, wrapper.tokenizer, os.path.join(ONNX_EXPORT_DIR, f"{name}.onnx"))
+    logger.info(f"{name} running on the {backend} backend")
+    return wrapper
+
+
+def quantize_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """Dynamic int8 quantization of every ``nn.Linear`` in ``model``."""
+    return torch.ao.quantization.quantize_dynamic(model.float().eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise RuntimeError("The onnx backend needs onnxruntime: pip install onnxruntime") from e
+    return onnxruntime
+
+
+def _session(path: str):
+    ort = _onnxruntime()
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+class _ClassifierWithHidden(torch.nn.Module):
+    """Export shim returning both logits and the encoder's last hidden state."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        output = self.model(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
+        return output.logits, output.hidden_states[-1]
+
+
+class OnnxSequenceClassifier:
+    """Drop-in for an HF sequence classifier backed by an onnxruntime session.
+
+    Called like the PyTorch model (``model(**inputs).logits``; with
+    ``output_hidden_states`` the last hidden state comes along, so
+    ``classify_and_embed`` still works).  ``base_model`` returns the encoder's
+    last hidden state so ``embed_query`` still works.
+    """
+
+    def __init__(self, path: str, config=None):
+        self.path = path
+        self.config = config
+        self._session = _session(path)
+
+    @classmethod
+    def export(cls, model, tokenizer, path: str) -> "OnnxSequenceClassifier":
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            sample = tokenizer("what are the symptoms of diabetes", return_tensors="pt")
+            torch.onnx.export(
+                _ClassifierWithHidden(model.float().eval()),
+                (sample["input_ids"], sample["attention_mask"]),
+                path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["logits", "last_hidden_state"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "logits": {0: "batch"},
+                    "last_hidden_state": {0: "batch", 1: "sequence"},
+                },
+                opset_version=17,
+            )
+            logger.info(f"Exported ONNX classifier to {path}")
+        return cls(path, config=getattr(model, "config", None))
+
+    def _run(self, input_ids, attention_mask=None, **_):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        logits, hidden = self._session.run(None, {
+            "input_ids": input_ids.numpy().astype("int64"),
+            "attention_mask": attention_mask.numpy().astype("int64"),
+        })
+        return torch.from_numpy(logits), torch.from_numpy(hidden)
+
+    def __call__(self, input_ids, attention_mask=None, output_hidden_states=False, **kwargs):
+        logits, hidden = self._run(input_ids, attention_mask, **kwargs)
+        return SequenceClassifierOutput(logits=logits, hidden_states=(hidden,) if output_hidden_states else None)
+
+    @property
+    def base_model(self):
+        return lambda input_ids, attention_mask=None, **kwargs: (self._run(input_ids, attention_mask)[1],)
+
+    def eval(self):
+        return self
+
+
+def export_onnx_causal_lm(model, directory: str):
+    """Export a causal LM with past key/values to ONNX via optimum."""
+    _onnxruntime()
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError as e:
+        raise RuntimeError("The onnx backend for BioGPT needs optimum: pip install optimum[onnxruntime]") from e
+
+    if not os.path.exists(os.path.join(directory, "config.json")):
+        source = os.path.join(directory, "pytorch")
+        model.float().save_pretrained(source)
+        ORTModelForCausalLM.from_pretrained(source, export=True, use_cache=True).save_pretrained(directory)
+        logger.info(f"Exported ONNX causal LM to {directory}")
+    return ORTModelForCausalLM.from_pretrained(directory, use_cache=True)
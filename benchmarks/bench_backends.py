@@ -0,0 +1,116 @@
+"""Parity check and latency/memory benchmark for each CPU inference backend.
+
+Every backend is applied to a fresh copy of the fp32 wrappers and compared
+against them:
+
+* MedBERT: max absolute difference of ``classify_text`` outputs and how often
+  the top class agrees.
+* BioGPT: share of prompts whose greedy output is identical to fp32.
+
+Latency is the median over ``--repeats`` runs; memory is the process RSS
+growth after building the backend plus the model's parameter/buffer size.
+
+Usage:
+    python benchmarks/bench_backends.py --backends fp32 int8 onnx
+"""
+import argparse
+import copy
+import json
+import os
+import statistics
+import sys
+import time
+
+import psutil
+import torch
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, ".."))
+
+from backends import BACKENDS, apply_backend  # noqa: E402
+from inference import generate_batch  # noqa: E402
+from bench_batching import PROMPTS  # noqa: E402
+
+
+def _tensor_bytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(v) for v in value)
+    return 0
+
+
+def model_mb(model) -> float:
+    """Size of the weights; int8 Linear weights live in packed params in the state dict."""
+    if not isinstance(model, torch.nn.Module):
+        return 0.0  # onnxruntime keeps its weights outside torch
+    return round(sum(_tensor_bytes(v) for v in model.state_dict().values()) / 2**20, 2)
+
+
+def median_ms(fn, repeats: int) -> float:
+    fn()  # warm-up
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(samples), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    from Models.medbert import medbert
+    from Models.biogpt import biogpt
+
+    reference_scores = [torch.as_tensor(medbert.classify_text(p)) for p in PROMPTS]
+    reference_text = generate_batch(biogpt, PROMPTS, max_new_tokens=args.max_new_tokens)
+    process = psutil.Process()
+
+    def bench_medbert(backend):
+        bert = apply_backend(copy.deepcopy(medbert), backend, "medbert")
+        scores = [torch.as_tensor(bert.classify_text(p)) for p in PROMPTS]
+        max_diff = max(float((s - r).abs().max()) for s, r in zip(scores, reference_scores))
+        top_agree = sum(int(s.argmax() == r.argmax()) for s, r in zip(scores, reference_scores)) / len(PROMPTS)
+        return {
+            "classify_ms": median_ms(lambda: bert.classify_text(PROMPTS[0]), args.repeats),
+            "max_abs_diff": round(max_diff, 6),
+            "top_class_agreement": round(top_agree, 3),
+            "model_mb": model_mb(bert.model),
+        }
+
+    def bench_biogpt(backend):
+        gpt = apply_backend(copy.deepcopy(biogpt), backend, "biogpt")
+        texts = generate_batch(gpt, PROMPTS, max_new_tokens=args.max_new_tokens)
+        same_text = sum(a == b for a, b in zip(texts, reference_text)) / len(PROMPTS)
+        return {
+            "generate_ms": median_ms(
+                lambda: generate_batch(gpt, PROMPTS[:1], max_new_tokens=args.max_new_tokens), args.repeats),
+            "identical_output_rate": round(same_text, 3),
+            "model_mb": model_mb(gpt.model),
+        }
+
+    results = []
+    for backend in args.backends:
+        row = {"backend": backend}
+        for name, bench in (("medbert", bench_medbert), ("biogpt", bench_biogpt)):
+            rss_before = process.memory_info().rss
+            try:
+                row[name] = bench(backend)
+            except RuntimeError as e:
+                row[name] = {"error": str(e)}
+                continue
+            row[name]["rss_growth_mb"] = round((process.memory_info().rss - rss_before) / 2**20, 1)
+        results.append(row)
+        print(json.dumps(row), flush=True)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Measure BioGPT generation throughput (tokens/sec) against batch size.
+
+Usage:
+    python benchmarks/bench_batching.py --batch-sizes 1 2 4 8 16 --max-new-tokens 64
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, ".."))
+
+from inference import generate_batch  # noqa: E402
+
+PROMPTS = [
+    "What are the symptoms of diabetes?",
+    "What is a fever?",
+    "How is high blood pressure treated?",
+    "What causes migraines?",
+    "What are the early signs of a heart attack?",
+    "How long does the flu last?",
+    "What is the treatment for asthma?",
+    "What are common side effects of ibuprofen?",
+]
+
+
+def run(wrapper, batch_size: int, max_new_tokens: int, repeats: int) -> dict:
+    prompts = [PROMPTS[i % len(PROMPTS)] for i in range(batch_size)]
+    generate_batch(wrapper, prompts, max_new_tokens=max_new_tokens)  # warm-up
+
+    tokens = 0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        responses = generate_batch(wrapper, prompts, max_new_tokens=max_new_tokens)
+        tokens += sum(len(wrapper.tokenizer(r)["input_ids"]) for r in responses)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "batch_size": batch_size,
+        "seconds": round(elapsed, 3),
+        "generated_tokens": tokens,
+        "tokens_per_sec": round(tokens / elapsed, 1),
+        "requests_per_sec": round(batch_size * repeats / elapsed, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    from Models.biogpt import biogpt
+
+    results = [run(biogpt, size, args.max_new_tokens, args.repeats) for size in args.batch_sizes]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""chat_history insert throughput and /healthbot latency, per-request commits vs write-behind.
+
+1. Insert throughput: ``--producers`` concurrent coroutines each save
+   ``--records`` chats through ``ChatWriter`` with ``write_behind`` off (one
+   commit per chat, the old path) and on (batched transactions).
+2. /healthbot latency: the API runs in-process (httpx ASGI transport) against
+   a temporary database and ``--clients`` concurrent registered users send
+   cached queries, so the time left is mostly auth, saving the chat and
+   serialization.
+
+Usage:
+    python benchmarks/bench_chat_writes.py --producers 32 --records 200 --clients 32 --requests 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+
+async def insert_throughput(database, write_behind: bool, producers: int, records: int) -> dict:
+    writer = database.ChatWriter(write_behind=write_behind)
+
+    async def producer(user_id: int):
+        for i in range(records):
+            await writer.submit(user_id, f"question {i}", "An answer of typical length for a chat response.")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(producer(u + 1) for u in range(producers)))
+    await writer.close()
+    elapsed = time.perf_counter() - start
+    return {"rows_per_s": round(producers * records / elapsed), "elapsed_s": round(elapsed, 2), **writer.stats()}
+
+
+async def healthbot_latency(app, client, write_behind: bool, tokens: list, requests: int) -> dict:
+    app.chat_writer.write_behind = write_behind
+    samples = []
+
+    async def user(token: str):
+        headers = {"Authorization": f"Bearer {token}"}
+        for _ in range(requests):
+            start = time.perf_counter()
+            r = await client.post("/healthbot", json={"query": "What are the symptoms of flu?"}, headers=headers)
+            r.raise_for_status()
+            samples.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(t) for t in tokens))
+    elapsed = time.perf_counter() - start
+    await app.chat_writer.close()
+    p50, p99 = np.percentile(samples, [50, 99])
+    return {"requests_per_s": round(len(samples) / elapsed), "p50_ms": round(p50, 2), "p99_ms": round(p99, 2)}
+
+
+async def run(args) -> dict:
+    import httpx
+    import database
+    import app
+
+    database.pool.connection  # pool created against the temporary DATABASE
+    results = {"insert": {}, "healthbot": {}}
+    for write_behind in (False, True):
+        mode = "write_behind" if write_behind else "per_request_commit"
+        results["insert"][mode] = await insert_throughput(database, write_behind, args.producers, args.records)
+
+    app.models.start()
+    app.models.wait()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://bench", timeout=600) as client:
+        tokens = []
+        for i in range(args.clients):
+            credentials = {"username": f"bench{i}", "password": "bench-password"}
+            await client.post("/auth/register", json=credentials)
+            tokens.append((await client.post("/auth/login", json=credentials)).json()["token"])
+        await client.post("/healthbot", json={"query": "What are the symptoms of flu?"},
+                          headers={"Authorization": "Bearer guest"})  # fill the response cache
+        for write_behind in (False, True):
+            mode = "write_behind" if write_behind else "per_request_commit"
+            results["healthbot"][mode] = await healthbot_latency(app, client, write_behind, tokens, args.requests)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--producers", type=int, default=32)
+    parser.add_argument("--records", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("LOGIN_IP_MAX_ATTEMPTS", str(10 * args.clients))  # every request comes from one IP
+    os.environ.setdefault("SCHEDULER_REGISTERED_RATE", "0")  # measure the writes, not the per-user quotas
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE"] = os.path.join(tmp, "bench.db")
+        print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Mixed read/write SQLite concurrency benchmark: pooled WAL vs per-request connections.
+
+Each worker thread loops over a mix of chat_history inserts (one commit each,
+like /healthbot) and history reads (like /chat_history) for ``--seconds``.
+The baseline opens a new default-journal connection per operation, as the
+old ``get_db()`` did; the pooled run uses ``database.ConnectionPool``.
+Reports operations/sec, read/write latency percentiles and "database is
+locked" errors.
+
+Usage:
+    python benchmarks/bench_db.py --threads 16 --write-ratio 0.3 --seconds 10
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import database  # noqa: E402
+
+
+def seed(path: str, users: int, rows_per_user: int):
+    conn = sqlite3.connect(path)
+    conn.executescript(database.SCHEMA)
+    conn.executemany(database.SQL_INSERT_USER, [(f"user{i}", "x") for i in range(users)])
+    conn.executemany(
+        "INSERT INTO chat_history (user_id, query, response) VALUES (?, ?, ?)",
+        [(u + 1, "what is a fever", "A fever is a temporary rise in body temperature." * 4)
+         for u in range(users) for _ in range(rows_per_user)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def naive_connection(path: str):
+    @contextmanager
+    def connection():
+        conn = sqlite3.connect(path, timeout=5)
+        try:
+            yield conn
+        finally:
+            conn.close()
+    return connection
+
+
+def run(connection, threads: int, write_ratio: float, seconds: float, users: int) -> dict:
+    stop = time.perf_counter() + seconds
+    reads, writes, errors = [], [], []
+    lock = threading.Lock()
+
+    def worker(seed_value: int):
+        rng = random.Random(seed_value)
+        local_reads, local_writes, local_errors = [], [], 0
+        while time.perf_counter() < stop:
+            user = rng.randrange(users) + 1
+            is_write = rng.random() < write_ratio
+            start = time.perf_counter()
+            try:
+                with connection() as conn:
+                    if is_write:
+                        conn.execute(database.SQL_INSERT_CHAT, (user, "what is a fever", "It is a symptom."))
+                        conn.commit()
+                    else:
+                        database.fetch_history_page(conn, user)
+            except sqlite3.OperationalError:
+                local_errors += 1
+                continue
+            (local_writes if is_write else local_reads).append((time.perf_counter() - start) * 1000)
+        with lock:
+            reads.extend(local_reads)
+            writes.extend(local_writes)
+            errors.append(local_errors)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    def pct(samples):
+        if not samples:
+            return {}
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        return {"p50_ms": round(p50, 2), "p95_ms": round(p95, 2), "p99_ms": round(p99, 2)}
+
+    return {
+        "ops_per_sec": round((len(reads) + len(writes)) / seconds, 1),
+        "reads": len(reads),
+        "writes": len(writes),
+        "locked_errors": sum(errors),
+        "read_latency": pct(reads),
+        "write_latency": pct(writes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--write-ratio", type=float, default=0.3)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rows-per-user", type=int, default=200)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "naive.db")
+        seed(path, args.users, args.rows_per_user)
+        results["per_request_connection"] = run(
+            naive_connection(path), args.threads, args.write_ratio, args.seconds, args.users)
+
+        path = os.path.join(tmp, "pooled.db")
+        seed(path, args.users, args.rows_per_user)
+        pool = database.ConnectionPool(path, size=args.threads)
+        results["pooled_wal"] = run(pool.connection, args.threads, args.write_ratio, args.seconds, args.users)
+        pool.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Multi-tenant /healthbot load: a guest flood next to registered users, FIFO vs fair-share scheduling.
+
+Runs app.py in-process (httpx ASGI transport, one transport per simulated
+client IP) on a temporary database with the ``benchmarks/stub_models``
+stand-ins, so the model time is fixed and only the scheduling differs.  For
+``--duration`` seconds:
+
+* ``--guest-ips`` guest client IPs each keep ``--guest-concurrency``
+  "Bearer guest" requests in flight, with no pause (a scripted flood);
+* one ``heavy`` registered user keeps ``--heavy-concurrency`` requests in
+  flight;
+* ``--light-users`` registered users each send one request at a time with
+  ``--think-ms`` between them.
+
+Every question is distinct, so no request is answered from cache.  The
+stubs answer one query at a time, so ``--slots`` (``SCHEDULER_SLOTS``)
+defaults to one per worker; with the real models it is sized for full
+micro-batches.  Modes:
+
+* ``fifo``: the scheduler out of the way (no caps, buckets or queue share,
+  more slots than the pool admits), which is first come, first served;
+* ``fair``: the scheduler with its default policies (or the
+  ``SCHEDULER_*`` variables set in the environment);
+* ``fair_no_buckets``: the same without the token buckets, so every
+  request reaches the queue and only priority, caps and fair queuing act.
+
+Reports, per class and per registered user: completed requests, 429 and 503
+counts, latency and queue-wait (``X-Queue-Wait-Ms``) percentiles, plus the
+scheduler's own stats.
+
+Usage:
+    python benchmarks/bench_fair_share.py --duration 20 --guest-ips 2 --guest-concurrency 16
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+FIFO_ENVIRONMENT = {
+    "SCHEDULER_SLOTS": "1000000",
+    "SCHEDULER_REGISTERED_MAX_CONCURRENT": "0",
+    "SCHEDULER_REGISTERED_RATE": "0",
+    "SCHEDULER_GUEST_MAX_CONCURRENT": "0",
+    "SCHEDULER_GUEST_RATE": "0",
+    "SCHEDULER_GUEST_QUEUE_SHARE": "1",
+}
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 1), "p95": round(float(p95), 1), "p99": round(float(p99), 1)}
+
+
+class Tally:
+    def __init__(self):
+        self.latency_ms, self.wait_ms = [], []
+        self.status = defaultdict(int)
+
+    def add(self, status: int, latency_ms: float, wait_ms: str):
+        self.status[status] += 1
+        if status == 200:
+            self.latency_ms.append(latency_ms)
+            self.wait_ms.append(float(wait_ms or 0))
+
+    def summary(self, duration: float) -> dict:
+        return {
+            "ok": self.status.get(200, 0),
+            "ok_per_s": round(self.status.get(200, 0) / duration, 2),
+            "rate_limited": self.status.get(429, 0),
+            "rejected_busy": self.status.get(503, 0),
+            "other": sum(n for status, n in self.status.items() if status not in (200, 429, 503)),
+            "latency_ms": percentiles(self.latency_ms),
+            "queue_wait_ms": percentiles(self.wait_ms),
+        }
+
+
+async def child(args) -> dict:
+    import httpx
+    import app
+
+    app.models.start()
+    app.models.wait()
+    await app.app.router.startup()
+
+    def client(ip: str):
+        transport = httpx.ASGITransport(app=app.app, client=(ip, 40000))
+        return httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None)
+
+    counter = itertools.count()
+    tallies = defaultdict(Tally)
+    deadline = time.monotonic() + args.duration
+
+    async def session(http, headers: dict, tally_keys: tuple, think_s: float = 0.0):
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            response = await http.post("/healthbot", json={"query": f"What helps with symptom {next(counter)}?"},
+                                       headers=headers)
+            latency = (time.perf_counter() - started) * 1000
+            for key in tally_keys:
+                tallies[key].add(response.status_code, latency, response.headers.get("x-queue-wait-ms"))
+            if response.status_code == 429:
+                await asyncio.sleep(min(float(response.headers.get("retry-after", 1)), 1.0))
+            elif response.status_code == 503:
+                await asyncio.sleep(0.05)
+            elif think_s:
+                await asyncio.sleep(think_s)
+
+    async with client("10.0.0.1") as registered:
+        users = ["heavy"] + [f"light{i}" for i in range(args.light_users)]
+        tokens = {}
+        for user in users:
+            await registered.post("/auth/register", json={"username": user, "password": "bench-password"})
+            login = await registered.post("/auth/login", json={"username": user, "password": "bench-password"})
+            tokens[user] = {"Authorization": f"Bearer {login.json()['token']}"}
+
+        guests = [client(f"10.1.0.{i + 1}") for i in range(args.guest_ips)]
+        tasks = [session(guest, {"Authorization": "Bearer guest"}, ("guest", f"guest_ip{i}"))
+                 for i, guest in enumerate(guests) for _ in range(args.guest_concurrency)]
+        tasks += [session(registered, tokens["heavy"], ("registered", "heavy"))
+                  for _ in range(args.heavy_concurrency)]
+        tasks += [session(registered, tokens[user], ("registered", user), args.think_ms / 1000)
+                  for user in users[1:]]
+        await asyncio.gather(*tasks)
+        for guest in guests:
+            await guest.aclose()
+
+    stats = app.fair_scheduler.stats()
+    await app.app.router.shutdown()
+    light = [tallies[f"light{i}"].summary(args.duration) for i in range(args.light_users)]
+    return {
+        "classes": {key: tallies[key].summary(args.duration) for key in ("registered", "guest")},
+        "heavy_user": tallies["heavy"].summary(args.duration),
+        "light_users": light,
+        "guest_ips": [tallies[f"guest_ip{i}"].summary(args.duration)["ok"] for i in range(args.guest_ips)],
+        "scheduler": stats,
+    }
+
+
+def run_mode(args, mode: str, tmp: str) -> dict:
+    env = {
+        **os.environ,
+        "SECRET_KEY": "bench",
+        "DATABASE": os.path.join(tmp, f"{mode}.db"),
+        "SEMANTIC_CACHE": "0",
+        "LOGIN_IP_MAX_ATTEMPTS": "1000000000",
+        "MODELS_PACKAGE": "stub_models",
+        "STUB_BIOGPT_LATENCY_MS": str(args.stub_biogpt_ms),
+        "STUB_BIOGPT_MS_PER_WORD": "0",
+        "PYTHONPATH": os.pathsep.join([BENCH_DIR, ROOT, os.environ.get("PYTHONPATH", "")]),
+    }
+    if mode == "fifo":
+        env.update(FIFO_ENVIRONMENT)
+    else:
+        env["SCHEDULER_SLOTS"] = str(args.slots)
+    if mode == "fair_no_buckets":
+        env.update({"SCHEDULER_REGISTERED_RATE": "0", "SCHEDULER_GUEST_RATE": "0"})
+    argv = [sys.executable, __file__, "--child", "--duration", str(args.duration),
+            "--guest-ips", str(args.guest_ips), "--guest-concurrency", str(args.guest_concurrency),
+            "--heavy-concurrency", str(args.heavy_concurrency), "--light-users", str(args.light_users),
+            "--think-ms", str(args.think_ms)]
+    output = subprocess.run(argv, cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--guest-ips", type=int, default=2)
+    parser.add_argument("--guest-concurrency", type=int, default=16)
+    parser.add_argument("--heavy-concurrency", type=int, default=8)
+    parser.add_argument("--light-users", type=int, default=4)
+    parser.add_argument("--think-ms", type=float, default=200)
+    parser.add_argument("--stub-biogpt-ms", type=float, default=50)
+    parser.add_argument("--slots", type=int, default=2)
+    parser.add_argument("--modes", nargs="+", choices=("fifo", "fair", "fair_no_buckets"),
+                        default=["fifo", "fair", "fair_no_buckets"])
+    args = parser.parse_args()
+
+    if args.child:
+        import logging
+
+        logging.disable(logging.WARNING)  # keep stdout to the JSON line
+        print(json.dumps(asyncio.run(child(args))))
+        return
+
+    results = {key: getattr(args, key) for key in ("duration", "guest_ips", "guest_concurrency",
+                                                   "heavy_concurrency", "light_users", "think_ms", "slots")}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in args.modes:
+            results[mode] = run_mode(args, mode, tmp)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Throughput of /healthbot/batch against one /healthbot call per question.
+
+Runs app.py in-process (httpx ASGI transport) on a temporary database and
+answers ``--queries`` distinct questions four ways, each with fresh questions
+so no mode is served from another's cache:
+
+* ``sequential``: one /healthbot call after another, as the triage tooling does;
+* ``concurrent``: ``--concurrency`` /healthbot calls in flight (micro-batched);
+* ``batch``: one /healthbot/batch call (JSON);
+* ``batch_ndjson``: the same streamed.  The in-process transport buffers
+  response bodies, so the time to the first result is taken from
+  ``app.healthbot_batch_items``, the generator the stream is written from.
+
+``--models real`` (default) loads the ``Models`` package next to the repo;
+``--models stub`` uses ``benchmarks/stub_models``, which cannot batch and so
+only shows the HTTP and bookkeeping overhead saved.
+
+Usage:
+    python benchmarks/bench_healthbot_batch.py --queries 128 --classify
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+CONDITIONS = ("diabetes", "asthma", "migraine", "flu", "hypertension", "anemia", "arthritis", "eczema",
+              "bronchitis", "gastritis", "insomnia", "psoriasis", "sinusitis", "tonsillitis", "gout", "angina")
+TEMPLATES = ("What are the symptoms of {}?", "How is {} treated in older adults with other conditions?",
+             "What causes {}?", "Is {} contagious?", "How long does {} usually last if left untreated?")
+
+
+def questions(count: int, tag: str) -> list:
+    base = [t.format(c) for t in TEMPLATES for c in CONDITIONS]
+    return [f"{base[i % len(base)]} ({tag} {i})" for i in range(count)]
+
+
+async def run(args) -> dict:
+    import httpx
+    import app
+
+    app.models.start()
+    app.models.wait()
+    await app.app.router.startup()
+    classify = "true" if args.classify else "false"
+    results = {"queries": args.queries, "classify": args.classify, "models": args.models}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://bench",
+                                 timeout=None) as client:
+        async def login(username: str) -> dict:
+            await client.post("/auth/register", json={"username": username, "password": "bench-password"})
+            response = await client.post("/auth/login", json={"username": username, "password": "bench-password"})
+            return {"Authorization": f"Bearer {response.json()['token']}"}
+
+        headers = await login("bench")
+
+        async def single(query: str):
+            response = await client.post(f"/healthbot?classify={classify}", json={"query": query}, headers=headers)
+            response.raise_for_status()
+
+        queries = questions(args.queries, "sequential")
+        started = time.perf_counter()
+        for query in queries:
+            await single(query)
+        results["sequential"] = elapsed(started, args.queries)
+
+        queries = questions(args.queries, "concurrent")
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(query: str):
+            async with semaphore:
+                await single(query)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(query) for query in queries))
+        results["concurrent"] = {"concurrency": args.concurrency, **elapsed(started, args.queries)}
+
+        queries = questions(args.queries, "batch")
+        started = time.perf_counter()
+        response = await client.post(f"/healthbot/batch?classify={classify}", json={"queries": queries},
+                                     headers=headers)
+        response.raise_for_status()
+        results["batch"] = {**elapsed(started, args.queries), "failed": response.json()["failed"]}
+
+        queries = questions(args.queries, "ndjson")
+        started = time.perf_counter()
+        # Another user: each batch mode starts with a full batch bucket
+        response = await client.post(f"/healthbot/batch?classify={classify}&format=ndjson",
+                                     json={"queries": queries}, headers=await login("bench_ndjson"))
+        response.raise_for_status()
+        results["batch_ndjson"] = elapsed(started, len(response.text.splitlines()))
+
+        queries = questions(args.queries, "first")
+        started = time.perf_counter()
+        items = app.healthbot_batch_items(None, queries, args.classify)
+        await items.__anext__()
+        results["batch_ndjson"]["first_result_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        async for _ in items:
+            pass
+
+    await app.app.router.shutdown()
+    for mode in ("concurrent", "batch", "batch_ndjson"):
+        results[mode]["speedup_vs_sequential"] = round(
+            results[mode]["queries_per_s"] / results["sequential"]["queries_per_s"], 2)
+    return results
+
+
+def elapsed(started: float, count: int) -> dict:
+    seconds = time.perf_counter() - started
+    return {"seconds": round(seconds, 3), "queries_per_s": round(count / seconds, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=128)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--classify", action="store_true")
+    parser.add_argument("--models", choices=("real", "stub"), default="real")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench_batch_")
+    os.environ.update({
+        "SECRET_KEY": "bench",
+        "DATABASE": os.path.join(tmp, "bench.db"),
+        "SEMANTIC_CACHE": "0",  # the batch endpoint only uses the exact-match cache
+        # The single-call modes send every query as its own request from one user, far past
+        # that user's request bucket; the batch modes keep the default batch buckets
+        "SCHEDULER_REGISTERED_RATE": "0",
+        "SCHEDULER_REGISTERED_MAX_CONCURRENT": "0",
+    })
+    if args.queries > 256:
+        # A larger batch than the defaults accept, so raise the cap and the batch bucket with it
+        os.environ.update({"HEALTHBOT_BATCH_MAX_QUERIES": str(args.queries),
+                           "SCHEDULER_REGISTERED_BATCH_BURST": str(args.queries)})
+    sys.path.insert(0, ROOT)
+    if args.models == "stub":
+        os.environ["MODELS_PACKAGE"] = "stub_models"
+        sys.path.insert(0, BENCH_DIR)
+    else:
+        sys.path.append(os.path.dirname(ROOT))
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Chat-history query latency at 1M+ rows, before and after the schema migrations.
+
+Seeds ``--rows`` chat_history rows spread over ``--users`` users, then times
+the first /chat_history page for random users with the original schema (no index)
+and again after ``database.migrate`` has added the composite index.  Also
+times the per-request ``SELECT id FROM users WHERE username = ?`` that tokens
+carrying the user id now skip.
+
+Usage:
+    python benchmarks/bench_history.py --rows 1000000 --users 2000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import database  # noqa: E402
+
+
+def seed(conn: sqlite3.Connection, rows: int, users: int):
+    conn.executescript(database.SCHEMA)
+    conn.executemany(database.SQL_INSERT_USER, ((f"user{i}", "x") for i in range(users)))
+    rng = random.Random(0)
+    start = time.time() - 365 * 86400
+
+    def records():
+        for i in range(rows):
+            ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + i * 30))
+            yield rng.randrange(users) + 1, "what is a fever", "A fever is a rise in body temperature.", ts
+
+    conn.executemany("INSERT INTO chat_history (user_id, query, response, timestamp) VALUES (?, ?, ?, ?)", records())
+    conn.commit()
+
+
+def time_queries(conn: sqlite3.Connection, sql: str, params: list) -> dict:
+    samples = []
+    for args in params:
+        start = time.perf_counter()
+        conn.execute(sql, args).fetchall()
+        samples.append((time.perf_counter() - start) * 1000)
+    p50, p99 = np.percentile(samples, [50, 99])
+    return {"p50_ms": round(p50, 3), "p99_ms": round(p99, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=100)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    user_ids = [(rng.randrange(args.users) + 1, args.page_size) for _ in range(args.queries)]
+    usernames = [(f"user{uid - 1}",) for uid, _ in user_ids]
+    history_sql = database.history_page_sql(database.HISTORY_COLUMNS)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "history.db"))
+        started = time.perf_counter()
+        seed(conn, args.rows, args.users)
+        results = {"rows": args.rows, "users": args.users, "seed_s": round(time.perf_counter() - started, 1)}
+
+        plan = conn.execute("EXPLAIN QUERY PLAN " + history_sql, (1, args.page_size)).fetchall()
+        results["before"] = {"plan": [row[-1] for row in plan],
+                             "history_query": time_queries(conn, history_sql, user_ids)}
+
+        started = time.perf_counter()
+        database.migrate(conn)
+        results["migration_s"] = round(time.perf_counter() - started, 2)
+
+        plan = conn.execute("EXPLAIN QUERY PLAN " + history_sql, (1, args.page_size)).fetchall()
+        results["after"] = {"plan": [row[-1] for row in plan],
+                            "history_query": time_queries(conn, history_sql, user_ids)}
+        results["username_lookup_skipped"] = time_queries(conn, database.SQL_USER_ID_BY_NAME, usernames)
+        conn.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
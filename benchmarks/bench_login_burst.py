@@ -0,0 +1,110 @@
+"""/healthbot latency while a burst of logins is in progress.
+
+Runs the API in-process (httpx ASGI transport, one event loop) against a
+temporary database.  A probe client sends the same guest /healthbot query
+every ``--probe-interval-ms`` (answered from the response cache after the
+first call, so its latency is mostly event-loop responsiveness) on a fixed
+schedule while
+``--logins`` concurrent logins hit /auth/login.  ``--inline-bcrypt`` runs
+bcrypt directly in the handlers, as before, for comparison.
+
+Usage:
+    python benchmarks/bench_login_burst.py --logins 50
+    python benchmarks/bench_login_burst.py --logins 50 --inline-bcrypt
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def summarize(samples: list) -> dict:
+    if not samples:
+        return {"count": 0}
+    p50, p99 = np.percentile(samples, [50, 99])
+    return {"count": len(samples), "p50_ms": round(p50, 2), "p99_ms": round(p99, 2), "max_ms": round(max(samples), 2)}
+
+
+async def probe(client, stop: asyncio.Event, interval_s: float) -> list:
+    """Latency measured from each probe's scheduled send time, so event-loop stalls count."""
+    samples = []
+    scheduled = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+        await client.post("/healthbot", json={"query": "What are the symptoms of flu?"},
+                          headers={"Authorization": "Bearer guest"})
+        finished = time.perf_counter()
+        samples.append((finished - scheduled) * 1000)
+        scheduled = max(scheduled + interval_s, finished)
+    return samples
+
+
+async def run(args):
+    import httpx
+    import app
+
+    if args.inline_bcrypt:
+        async def inline(fn, *fn_args):
+            return fn(*fn_args)
+        app.run_bcrypt = inline
+
+    app.models.start()
+    app.models.wait()
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=600) as client:
+        await client.post("/auth/register", json={"username": "burst", "password": "burst-password"})
+        await client.post("/healthbot", json={"query": "What are the symptoms of flu?"},
+                          headers={"Authorization": "Bearer guest"})  # fill the response cache
+
+        async def measure(with_burst: bool) -> dict:
+            stop = asyncio.Event()
+            probe_task = asyncio.create_task(probe(client, stop, args.probe_interval_ms / 1000))
+            statuses, started = {}, time.perf_counter()
+            if with_burst:
+                responses = await asyncio.gather(*(
+                    client.post("/auth/login", json={"username": "burst", "password": "burst-password"})
+                    for _ in range(args.logins)))
+                for r in responses:
+                    statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+            else:
+                await asyncio.sleep(args.idle_seconds)
+            elapsed = time.perf_counter() - started
+            stop.set()
+            result = {"healthbot": summarize(await probe_task), "elapsed_s": round(elapsed, 2)}
+            if with_burst:
+                result["login_status"] = statuses
+            return result
+
+        return {
+            "inline_bcrypt": args.inline_bcrypt,
+            "logins": args.logins,
+            "idle": await measure(False),
+            "burst": await measure(True),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=50)
+    parser.add_argument("--probe-interval-ms", type=float, default=20)
+    parser.add_argument("--idle-seconds", type=float, default=2)
+    parser.add_argument("--inline-bcrypt", action="store_true")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("LOGIN_IP_MAX_ATTEMPTS", str(10 * args.logins))  # every request comes from one IP
+    os.environ.setdefault("AUTH_HASH_MAX_QUEUE", str(args.logins))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE"] = os.path.join(tmp, "bench.db")
+        print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
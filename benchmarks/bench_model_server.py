@@ -0,0 +1,160 @@
+"""Memory and throughput of ``uvicorn --workers N``, in-process models vs a shared model server.
+
+For each mode, starts the API under uvicorn with ``--workers`` workers (and,
+for ``server``, ``model_server.py`` with ``--server-processes`` processes),
+waits until every worker is ready, then drives ``--clients`` concurrent
+clients posting distinct /healthbot questions for ``--duration`` seconds.
+Afterwards it reports RSS and PSS (proportional set size: shared pages split
+between the processes mapping them) per API worker and for the model
+server(s), plus throughput and latency.
+
+Models come from ``MODELS_PACKAGE`` (default ``Models`` next to the repo).
+
+Usage:
+    python benchmarks/bench_model_server.py --workers 4 --clients 16 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import psutil
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from loadtest import build_queries, free_port  # noqa: E402
+
+MB = 2 ** 20
+
+
+def spawned(process: psutil.Process) -> list:
+    """Worker processes started by ``process`` through multiprocessing."""
+    return [child for child in process.children(recursive=True)
+            if any("spawn_main" in part for part in child.cmdline())]
+
+
+def memory(processes: list) -> dict:
+    rss = [p.memory_info().rss / MB for p in processes]
+    pss = [p.memory_full_info().pss / MB for p in processes]
+    return {
+        "processes": len(processes),
+        "rss_mb_each": [round(value) for value in rss],
+        "rss_mb_total": round(sum(rss)),
+        "pss_mb_total": round(sum(pss)),
+    }
+
+
+async def wait_all_ready(client, workers: int, timeout: float):
+    """Until ``workers * 3`` /readyz calls in a row succeed, so every worker has answered."""
+    deadline, streak = time.monotonic() + timeout, 0
+    while streak < workers * 3:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"API not ready after {timeout:.0f}s")
+        try:
+            streak = streak + 1 if (await client.get("/readyz")).status_code == 200 else 0
+        except Exception:
+            streak = 0
+        if not streak:
+            await asyncio.sleep(0.5)
+
+
+async def drive(client, args, mode: str) -> dict:
+    await client.post("/auth/register", json={"username": "bench", "password": "bench-password"})
+    login = await client.post("/auth/login", json={"username": "bench", "password": "bench-password"})
+    headers = {"Authorization": f"Bearer {login.json()['token']}"}
+    queries = iter(f"{q} ({mode})" for q in build_queries(1_000_000))
+    latencies, errors = [], 0
+    deadline = time.monotonic() + args.duration
+
+    async def worker():
+        nonlocal errors
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            response = await client.post(f"/healthbot?classify={'true' if args.classify else 'false'}",
+                                         json={"query": next(queries)}, headers=headers)
+            if response.status_code == 200:
+                latencies.append((time.perf_counter() - started) * 1000)
+            else:
+                errors += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(args.clients)))
+    elapsed = time.monotonic() - started
+    p50, p99 = np.percentile(latencies, [50, 99]) if latencies else (0.0, 0.0)
+    return {"requests": len(latencies), "errors": errors, "requests_per_s": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(float(p50), 1), "p99_ms": round(float(p99), 1)}
+
+
+async def run_mode(args, mode: str, tmp: str) -> dict:
+    import httpx
+
+    path = os.pathsep.join([ROOT, os.path.dirname(ROOT), os.environ.get("PYTHONPATH", "")])
+    env = {**os.environ, "PYTHONPATH": path, "SECRET_KEY": "bench", "DATABASE": os.path.join(tmp, f"{mode}.db"),
+           "SEMANTIC_CACHE": "0", "LOGIN_IP_MAX_ATTEMPTS": "1000000000",
+           "SCHEDULER_REGISTERED_RATE": "0", "SCHEDULER_REGISTERED_MAX_CONCURRENT": "0"}  # one user drives all load
+    env.pop("MODEL_SERVER", None)
+    model_server = None
+    if mode == "server":
+        socket_path = os.path.join(tmp, "models.sock")
+        model_server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "model_server.py"), "--socket", socket_path,
+             "--processes", str(args.server_processes)], cwd=ROOT, env=env, stdout=subprocess.PIPE, text=True)
+        if args.server_processes > 1:
+            env["MODEL_SERVER"] = model_server.stdout.readline().strip().split("=", 1)[1]
+        else:
+            env["MODEL_SERVER"] = socket_path
+
+    port = free_port()
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(args.workers), "--log-level", "warning"], cwd=ROOT, env=env)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=httpx.Timeout(120),
+                                     limits=httpx.Limits(max_connections=args.clients * 2)) as client:
+            started = time.monotonic()
+            await wait_all_ready(client, args.workers, args.ready_timeout)
+            result = {"ready_s": round(time.monotonic() - started, 1)}
+            result.update(await drive(client, args, mode))
+
+        result["api_workers"] = memory(spawned(psutil.Process(api.pid)))
+        if model_server is not None:
+            server = psutil.Process(model_server.pid)
+            result["model_servers"] = memory(spawned(server) if args.server_processes > 1 else [server])
+        servers = result.get("model_servers", {"rss_mb_total": 0, "pss_mb_total": 0})
+        result["rss_mb_total"] = result["api_workers"]["rss_mb_total"] + servers["rss_mb_total"]
+        result["pss_mb_total"] = result["api_workers"]["pss_mb_total"] + servers["pss_mb_total"]
+        return result
+    finally:
+        for process in (api, model_server):
+            if process is not None:
+                process.terminate()
+                process.wait(30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--server-processes", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--classify", action="store_true")
+    parser.add_argument("--modes", nargs="+", choices=("inprocess", "server"), default=["inprocess", "server"])
+    parser.add_argument("--ready-timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    results = {"workers": args.workers, "server_processes": args.server_processes, "clients": args.clients}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in args.modes:
+            results[mode] = asyncio.run(run_mode(args, mode, tmp))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
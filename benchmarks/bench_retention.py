@@ -0,0 +1,155 @@
+"""Write latency while expired chat history is purged, one DELETE vs chunked retention.
+
+Seeds ``--rows`` chat_history rows of which ``--expired`` fraction are past
+the retention period, then purges them while a writer thread keeps inserting
+chats and records each insert's latency:
+
+* ``single_delete``: one ``DELETE ... WHERE timestamp < ?`` transaction.
+* ``retention_job``: ``RetentionJob`` chunks (archived, then deleted) followed
+  by incremental vacuum.
+
+Also reports the database file size before and after each purge.
+
+Usage:
+    python benchmarks/bench_retention.py --rows 500000 --expired 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def seed(path: str, rows: int, expired: float, days: int):
+    import database
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    database.enable_incremental_vacuum(conn)
+    conn.executescript(database.SCHEMA)
+    database.migrate(conn)
+    rng = random.Random(0)
+    now = time.time()
+
+    def records():
+        for i in range(rows):
+            age = (days + 1 + rng.random() * 300) if rng.random() < expired else rng.random() * days * 0.9
+            ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - age * 86400))
+            yield rng.randrange(1000) + 1, "what is a fever " * 4, "A fever is a rise in body temperature. " * 8, ts
+
+    conn.executemany("INSERT INTO chat_history (user_id, query, response, timestamp) VALUES (?, ?, ?, ?)", records())
+    conn.commit()
+    conn.close()
+
+
+def file_mb(path: str) -> float:
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    return round(os.path.getsize(path) / 2**20, 1)
+
+
+def with_writer(path: str, purge) -> dict:
+    """Run ``purge()`` while a thread inserts chats; returns insert latencies."""
+    samples, stop = [], threading.Event()
+
+    def writer():
+        conn = sqlite3.connect(path, timeout=30)
+        while not stop.is_set():
+            start = time.perf_counter()
+            conn.execute("INSERT INTO chat_history (user_id, query, response) VALUES (1, 'q', 'r')")
+            conn.commit()
+            samples.append((time.perf_counter() - start) * 1000)
+            time.sleep(0.002)
+        conn.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    time.sleep(0.2)
+    started = time.perf_counter()
+    try:
+        extra = purge()
+        elapsed = time.perf_counter() - started
+        time.sleep(0.2)
+    finally:
+        stop.set()
+        thread.join()
+    p50, p99 = np.percentile(samples, [50, 99])
+    return {"purge_s": round(elapsed, 2), "insert_p50_ms": round(p50, 2), "insert_p99_ms": round(p99, 2),
+            "insert_max_ms": round(max(samples), 2), **extra}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--expired", type=float, default=0.5)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--chunk", type=int, default=500)
+    args = parser.parse_args()
+
+    results = {"rows": args.rows, "expired": args.expired}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "retention.db")
+        os.environ["DATABASE"] = path
+        import database
+        from retention import RetentionJob
+
+        seed(path, args.rows, args.expired, args.days)
+        template = path + ".seed"
+        os.replace(path, template)
+
+        def fresh_copy():
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            with open(template, "rb") as src, open(path, "wb") as dst:
+                dst.write(src.read())
+
+        fresh_copy()
+        size_before = file_mb(path)
+        job = RetentionJob(days=args.days)
+
+        def single_delete():
+            conn = sqlite3.connect(path, timeout=30)
+            start = time.perf_counter()
+            count = conn.execute("DELETE FROM chat_history WHERE timestamp < ?", (job.cutoff(),)).rowcount
+            conn.commit()
+            held = (time.perf_counter() - start) * 1000
+            conn.close()
+            return {"rows_purged": count, "lock_hold_max_ms": round(held, 1)}
+
+        results["single_delete"] = with_writer(path, single_delete)
+        results["single_delete"]["file_mb"] = [size_before, file_mb(path)]
+
+        fresh_copy()
+        database.pool.close()
+        database.pool = database.ConnectionPool(path)
+        job = RetentionJob(days=args.days, chunk=args.chunk, archive_dir=os.path.join(tmp, "archive"))
+
+        def retention_job():
+            asyncio.run(job.run_once())
+            stats = job.stats()
+            return {key: stats[key] for key in ("rows_purged", "rows_archived", "pages_reclaimed",
+                                                "write_transactions", "lock_hold_avg_ms", "lock_hold_max_ms")}
+
+        results["retention_job"] = with_writer(path, retention_job)
+        database.pool.close()
+        results["retention_job"]["file_mb"] = [size_before, file_mb(path)]
+        archive = os.path.join(tmp, "archive")
+        results["retention_job"]["archive_mb"] = round(
+            sum(os.path.getsize(os.path.join(archive, f)) for f in os.listdir(archive)) / 2**20, 1)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
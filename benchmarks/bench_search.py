@@ -0,0 +1,155 @@
+"""Chat-history full-text search latency on a multi-million-row table.
+
+Seeds ``--rows`` chat_history rows over ``--users`` users with a Zipf-skewed
+medical vocabulary, applies ``database.migrate`` (which builds the FTS5 index
+from the existing rows) and times one page of search results per query for
+random users:
+
+* ``like``: what search costs without an index, a LIKE scan of the user's rows;
+* ``fts_filter_after``: FTS5 match over all users, rows filtered by user_id afterwards;
+* ``fts``: ``database.search_history``, the user's token intersected in the index.
+
+Each is run for a common word, a rare word and a two-word query, for random
+users and for one heavy user owning ``--heavy-share`` of all rows (where the
+LIKE scan has the most to read).  Also reports the insert cost of the sync
+triggers, against the schema with every earlier migration applied.
+
+Usage:
+    python benchmarks/bench_search.py --rows 2000000 --users 5000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import database  # noqa: E402
+
+TERMS = [
+    "fever", "headache", "cough", "fatigue", "nausea", "dizziness", "rash", "insomnia", "anxiety", "asthma",
+    "diabetes", "hypertension", "migraine", "arthritis", "allergy", "bronchitis", "anemia", "eczema", "gout",
+    "influenza", "pneumonia", "sinusitis", "tonsillitis", "vertigo", "tinnitus", "psoriasis", "shingles",
+    "appendicitis", "gastritis", "hepatitis", "meningitis", "scoliosis", "sciatica", "tendinitis", "lupus",
+    "sarcoidosis", "myasthenia", "porphyria", "amyloidosis", "acromegaly",
+]
+TEMPLATES = ["what causes {a}", "how do I treat {a} with {b}", "is {a} a sign of {b}", "best medicine for {a}"]
+ANSWERS = [
+    "{a} is commonly associated with {b}. Rest, fluids and seeing a doctor if it persists are advised.",
+    "Treatment of {a} depends on the cause; {b} may need specific care from a specialist.",
+]
+
+SQL_LIKE = (
+    "SELECT id, query, response, timestamp FROM chat_history "
+    "WHERE user_id = ? AND (query LIKE ? OR response LIKE ?) ORDER BY timestamp DESC, id DESC LIMIT ?"
+)
+SQL_FTS_FILTER_AFTER = (
+    "SELECT c.id, c.query, c.response, c.timestamp FROM chat_history_fts "
+    "JOIN chat_history AS c ON c.id = chat_history_fts.rowid "
+    "WHERE chat_history_fts MATCH ? AND c.user_id = ? ORDER BY rank LIMIT ?"
+)
+
+
+def seed(conn: sqlite3.Connection, rows: int, users: int, heavy_share: float):
+    conn.executescript(database.SCHEMA)
+    conn.executemany(database.SQL_INSERT_USER, ((f"user{i}", "x") for i in range(users)))
+    rng = np.random.default_rng(0)
+    # Zipf-skewed term choice: the first terms are in many rows, the last in few
+    weights = 1 / np.arange(1, len(TERMS) + 1) ** 1.2
+    picks = rng.choice(len(TERMS), size=(rows, 2), p=weights / weights.sum())
+    owners = rng.integers(1, users + 1, size=rows)
+    owners[rng.random(rows) < heavy_share] = 1
+    start = time.time() - 365 * 86400
+
+    def records():
+        for i in range(rows):
+            a, b = TERMS[picks[i, 0]], TERMS[picks[i, 1]]
+            ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + i * 15))
+            yield (int(owners[i]), TEMPLATES[i % len(TEMPLATES)].format(a=a, b=b),
+                   ANSWERS[i % len(ANSWERS)].format(a=a.capitalize(), b=b), ts)
+
+    conn.executemany("INSERT INTO chat_history (user_id, query, response, timestamp) VALUES (?, ?, ?, ?)", records())
+    conn.commit()
+
+
+def time_queries(fn, params: list) -> dict:
+    samples = []
+    for args in params:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    p50, p99 = np.percentile(samples, [50, 99])
+    return {"p50_ms": round(p50, 3), "p99_ms": round(p99, 3)}
+
+
+def insert_rate(conn: sqlite3.Connection, count: int) -> float:
+    records = [(2, "what causes fever", "Fever is commonly associated with influenza.")] * count
+    start = time.perf_counter()
+    for offset in range(0, count, 256):
+        database.insert_chats(conn, records[offset:offset + 256])
+    return round(count / (time.perf_counter() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--heavy-share", type=float, default=0.02)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    users = [rng.randrange(2, args.users) + 1 for _ in range(args.queries)]
+    searches = {"common": TERMS[0], "rare": TERMS[-5], "two_words": f"{TERMS[1]} {TERMS[3]}"}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "search.db"))
+        started = time.perf_counter()
+        seed(conn, args.rows, args.users, args.heavy_share)
+        results = {"rows": args.rows, "users": args.users, "seed_s": round(time.perf_counter() - started, 1),
+                   "heavy_user_rows": conn.execute("SELECT count(*) FROM chat_history WHERE user_id = 1").fetchone()[0]}
+
+        fts_migration = len(database.MIGRATIONS)
+        for number, script in enumerate(database.MIGRATIONS[:fts_migration - 1], start=1):
+            conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+        results["insert_rows_per_s_without_fts"] = insert_rate(conn, 20_000)
+
+        started = time.perf_counter()
+        database.migrate(conn)  # only the FTS migration is left: builds the index from every row
+        results["fts_build_s"] = round(time.perf_counter() - started, 1)
+        results["insert_rows_per_s_with_fts"] = insert_rate(conn, 20_000)
+
+        for name, text in searches.items():
+            expression = database.search_expression(text)
+            words = text.split()
+            like = lambda uid: conn.execute(  # noqa: E731
+                SQL_LIKE, (uid, f"%{words[0]}%", f"%{words[0]}%", args.limit)).fetchall()
+            filter_after = lambda uid: conn.execute(  # noqa: E731
+                SQL_FTS_FILTER_AFTER, (expression, uid, args.limit)).fetchall()
+            fts = lambda uid: database.search_history(conn, uid, expression, args.limit)  # noqa: E731
+            params = [(uid,) for uid in users]
+            heavy = [(1,)] * 20
+            results[name] = {
+                "query": text,
+                "matching_rows": conn.execute(
+                    "SELECT count(*) FROM chat_history_fts WHERE chat_history_fts MATCH ?", (expression,)).fetchone()[0],
+                "like": time_queries(like, params),
+                "fts_filter_after": time_queries(filter_after, params[:20]),
+                "fts": time_queries(fts, params),
+                "heavy_user_like": time_queries(like, heavy),
+                "heavy_user_fts": time_queries(fts, heavy),
+            }
+        conn.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
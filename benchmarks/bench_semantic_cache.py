@@ -0,0 +1,151 @@
+"""Measure VectorIndex lookup latency at increasing index sizes.
+
+Reports p50/p99 lookup latency for brute-force and approximate (IVF) search
+and the recall@1 of approximate search against brute force.  Vectors are
+random, so this measures the index, not MedBERT.  1M 768-d float32 vectors
+take about 3 GB of RAM.
+
+``--pairs`` instead checks the similarity threshold on real MedBERT
+embeddings (models from ``MODELS_PACKAGE``): it embeds pairs of paraphrases,
+which the cache should answer from each other, and pairs of related but
+different questions, which it must not.  Reports the cosine of every pair
+and fails if any non-paraphrase pair clears ``--threshold``, since the cache
+would serve one question's answer for the other.
+
+Usage:
+    python benchmarks/bench_semantic_cache.py --sizes 10000 100000 1000000
+    python benchmarks/bench_semantic_cache.py --pairs --threshold 0.97
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.abspath(ROOT)))
+
+from vector_index import VectorIndex  # noqa: E402
+
+PARAPHRASES = (
+    ("What are the symptoms of diabetes?", "What symptoms does diabetes cause?"),
+    ("How is high blood pressure treated?", "What is the treatment for high blood pressure?"),
+    ("What causes migraines?", "Why do people get migraines?"),
+    ("Is the flu contagious?", "Can influenza spread from person to person?"),
+    ("How long does a cold last?", "How many days does a common cold usually last?"),
+)
+
+# Related questions whose answers differ: serving one for the other is a wrong answer
+NON_PARAPHRASES = (
+    ("What are the symptoms of type 1 diabetes?", "What are the symptoms of type 2 diabetes?"),
+    ("What is the dose of ibuprofen for adults?", "What is the dose of ibuprofen for children?"),
+    ("Can I take aspirin while pregnant?", "Can I take ibuprofen while pregnant?"),
+    ("What are the symptoms of a heart attack?", "What are the symptoms of a panic attack?"),
+    ("How is hypertension treated?", "How is hypotension treated?"),
+    ("What causes a high white blood cell count?", "What causes a low white blood cell count?"),
+    ("Is a fever of 38 C dangerous in a baby?", "Is a fever of 38 C dangerous in an adult?"),
+    ("What are the side effects of metformin?", "What are the side effects of insulin?"),
+)
+
+
+def build(vectors: np.ndarray, approximate: bool) -> VectorIndex:
+    n, dim = vectors.shape
+    index = VectorIndex(dim, n, approximate_threshold=n if approximate else n + 1)
+    for i, vector in enumerate(vectors):
+        index.add(vector, i)
+    return index
+
+
+def time_lookups(index: VectorIndex, queries: np.ndarray):
+    latencies, answers = [], []
+    for query in queries:
+        start = time.perf_counter()
+        result = index.search(query, k=1)
+        latencies.append((time.perf_counter() - start) * 1000)
+        answers.append(result[0][1] if result else None)
+    return np.percentile(latencies, [50, 99]), answers
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def check_pairs(threshold: float) -> dict:
+    """Cosine of every paraphrase and non-paraphrase pair under MedBERT, against ``threshold``."""
+    from inference import ModelRegistry, embed_query
+
+    models = ModelRegistry(warmup=False, server="")
+    models.start()
+    if not models.wait(600) or models.error:
+        raise SystemExit(f"Models did not load: {models.error}")
+
+    def scored(pairs):
+        rows = []
+        for a, b in pairs:
+            ea, eb = embed_query(models.medbert, a), embed_query(models.medbert, b)
+            if ea is None or eb is None:
+                raise SystemExit("The MedBERT wrapper exposes no encoder to embed with")
+            rows.append({"a": a, "b": b, "cosine": round(cosine(ea, eb), 4)})
+        return rows
+
+    paraphrases, others = scored(PARAPHRASES), scored(NON_PARAPHRASES)
+    return {
+        "threshold": threshold,
+        "paraphrases_matched": f"{sum(r['cosine'] >= threshold for r in paraphrases)}/{len(paraphrases)}",
+        "false_matches": [r for r in others if r["cosine"] >= threshold],
+        "paraphrases": paraphrases,
+        "non_paraphrases": others,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--pairs", action="store_true", help="check the threshold on MedBERT embeddings")
+    parser.add_argument("--threshold", type=float, default=None, help="default: SEMANTIC_CACHE_THRESHOLD")
+    args = parser.parse_args()
+
+    if args.pairs:
+        from cache import SEMANTIC_CACHE_THRESHOLD
+
+        result = check_pairs(SEMANTIC_CACHE_THRESHOLD if args.threshold is None else args.threshold)
+        print(json.dumps(result, indent=2))
+        if result["false_matches"]:
+            raise SystemExit(f"{len(result['false_matches'])} different questions would share a cached answer")
+        return
+
+    rng = np.random.default_rng(0)
+    results = []
+    for size in args.sizes:
+        vectors = rng.standard_normal((size, args.dim), dtype=np.float32)
+        # Queries are perturbed copies of stored vectors, like paraphrases
+        picks = rng.choice(size, args.queries, replace=False)
+        queries = vectors[picks] + 0.3 * rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+
+        row = {"entries": size, "dim": args.dim}
+        for mode in ("exact", "approximate"):
+            start = time.perf_counter()
+            index = build(vectors, approximate=mode == "approximate")
+            build_s = time.perf_counter() - start
+            (p50, p99), answers = time_lookups(index, queries)
+            row[mode] = {"build_s": round(build_s, 2), "p50_ms": round(p50, 3), "p99_ms": round(p99, 3),
+                         "index_mb": round(index.nbytes / 2**20, 1)}
+            if mode == "exact":
+                exact_answers = answers
+            else:
+                recall = np.mean([a == b for a, b in zip(answers, exact_answers)])
+                row[mode]["recall_at_1"] = round(float(recall), 3)
+            del index
+        results.append(row)
+        print(json.dumps(row), flush=True)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Compare follow-up turn latency with and without per-session KV-cache reuse.
+
+Runs the same scripted conversation through two SessionStores, one keeping
+each session's past key/values and one recomputing the whole context every
+turn, and reports the latency of every turn.
+
+Usage:
+    python benchmarks/bench_sessions.py --turns 6 --max-new-tokens 48
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, ".."))
+
+from sessions import SessionStore  # noqa: E402
+
+CONVERSATION = [
+    "What are the symptoms of type 2 diabetes?",
+    "How is it diagnosed?",
+    "What treatments are available?",
+    "Are there side effects of metformin?",
+    "Can diet alone control it?",
+    "How often should blood sugar be checked?",
+    "What complications should I watch for?",
+    "Is exercise safe with this condition?",
+]
+
+
+def run(wrapper, reuse_cache: bool, turns: int, max_new_tokens: int, conversations: int) -> list:
+    store = SessionStore(reuse_cache=reuse_cache, max_context_tokens=4096)
+    per_turn = [[] for _ in range(turns)]
+    for n in range(conversations):
+        session = store.get("bench", f"conversation-{n}")
+        for turn in range(turns):
+            start = time.perf_counter()
+            store.generate_turn(wrapper, session, CONVERSATION[turn % len(CONVERSATION)], max_new_tokens=max_new_tokens)
+            per_turn[turn].append((time.perf_counter() - start) * 1000)
+    return [round(statistics.median(samples), 1) for samples in per_turn]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--max-new-tokens", type=int, default=48)
+    parser.add_argument("--conversations", type=int, default=3)
+    args = parser.parse_args()
+
+    from Models.biogpt import biogpt
+
+    run(biogpt, True, 1, 4, 1)  # warm-up
+    with_cache = run(biogpt, True, args.turns, args.max_new_tokens, args.conversations)
+    without_cache = run(biogpt, False, args.turns, args.max_new_tokens, args.conversations)
+    print(json.dumps({
+        "turn_ms_with_cache": with_cache,
+        "turn_ms_without_cache": without_cache,
+        "follow_up_speedup": [round(b / a, 2) for a, b in zip(with_cache[1:], without_cache[1:])],
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
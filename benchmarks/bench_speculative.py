@@ -0,0 +1,141 @@
+"""Latency of BioGPT greedy decoding with and without a speculative draft model.
+
+Loads the models through ``ModelRegistry`` and answers a fixed set of medical
+prompts one at a time (the single-prompt path streams, turns and unbatched
+/healthbot calls take), first with plain greedy decoding and then with the
+draft model proposing ``--num-tokens`` tokens per BioGPT forward pass, once
+per value given.  Every speculative answer is compared with the greedy one;
+the benchmark fails if any differ.  Reports time, tokens/s, the speedup, the
+draft acceptance rate and tokens per BioGPT pass.
+
+``--draft`` is a Hugging Face model id or directory sharing BioGPT's
+tokenizer.  Without it, a stand-in draft is built from BioGPT's first
+``--draft-layers`` layers (same embeddings and head) and saved to a
+temporary directory; a distilled draft usually accepts more.  Models come
+from ``MODELS_PACKAGE`` (default ``Models`` next to the repo).
+
+Usage:
+    python benchmarks/bench_speculative.py --draft path/to/draft --num-tokens 3 5 8
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.dirname(ROOT))
+
+PROMPTS = (
+    "What are the common symptoms of type 2 diabetes?",
+    "How is high blood pressure treated in older adults?",
+    "What causes a persistent dry cough?",
+    "Is influenza contagious before symptoms appear?",
+    "What are the warning signs of a heart attack?",
+    "How is iron deficiency anemia diagnosed?",
+    "What is the first-line treatment for migraine?",
+    "Can asthma develop in adulthood?",
+    "What are the side effects of metformin?",
+    "How long does a common cold usually last?",
+    "What lifestyle changes lower cholesterol?",
+    "When should a fever in a child be checked by a doctor?",
+)
+
+
+def truncated_draft(model, layers: int, directory: str) -> str:
+    """Save ``model`` cut to its first ``layers`` layers (as a draft sharing its tokenizer) to ``directory``."""
+    config = copy.deepcopy(model.config)
+    config.num_hidden_layers = layers
+    draft = type(model)(config)
+    # Keys of the layers beyond ``layers`` are simply not loaded
+    missing, _ = draft.load_state_dict(model.state_dict(), strict=False)
+    if missing:
+        raise RuntimeError(f"Cannot build a truncated draft, missing {missing[:5]}")
+    draft.save_pretrained(directory)
+    return directory
+
+
+def run(wrapper, max_new_tokens: int) -> dict:
+    from inference import Budget, generate_budgeted
+    from metrics import GENERATED_TOKENS
+
+    texts = []
+    before = GENERATED_TOKENS.value(model="biogpt")
+    started = time.perf_counter()
+    for prompt in PROMPTS:
+        generation, = generate_budgeted(wrapper, [prompt], [Budget(max_new_tokens)])
+        texts.append(generation.text)
+    seconds = time.perf_counter() - started
+    tokens = int(GENERATED_TOKENS.value(model="biogpt") - before)
+    return {"texts": texts, "seconds": round(seconds, 3), "tokens": tokens, "tokens_per_s": round(tokens / seconds, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--draft", default="")
+    parser.add_argument("--draft-layers", type=int, default=2)
+    parser.add_argument("--num-tokens", type=int, nargs="+", default=[3, 5, 8])
+    parser.add_argument("--schedule", choices=("constant", "heuristic"), default="constant")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    import torch
+    from inference import ModelRegistry, exposes_hf_model
+    from speculative import load_draft, speculation_stats
+
+    torch.manual_seed(0)
+    models = ModelRegistry(server="")
+    models.start()
+    if not models.wait(600) or models.error:
+        raise SystemExit(f"Models did not load: {models.error}")
+    wrapper = models.biogpt
+    if not exposes_hf_model(wrapper):
+        raise SystemExit("The BioGPT wrapper exposes no HF model to decode speculatively")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        draft_path = args.draft or truncated_draft(wrapper.model, args.draft_layers, tmp)
+        run(wrapper, 8)  # warm-up
+        greedy = run(wrapper, args.max_new_tokens)
+        load_draft(wrapper, draft_path)
+    results = {
+        "prompts": len(PROMPTS),
+        "max_new_tokens": args.max_new_tokens,
+        "draft": args.draft or f"BioGPT's first {args.draft_layers} layers",
+        "draft_parameters_m": round(sum(p.numel() for p in wrapper.draft_model.parameters()) / 1e6, 1),
+        "target_parameters_m": round(sum(p.numel() for p in wrapper.model.parameters()) / 1e6, 1),
+        "greedy": {key: value for key, value in greedy.items() if key != "texts"},
+    }
+
+    config = wrapper.draft_model.generation_config
+    config.num_assistant_tokens_schedule = args.schedule
+    run(wrapper, 8)  # warm-up
+    mismatches = 0
+    for num_tokens in args.num_tokens:
+        config.num_assistant_tokens = num_tokens  # the heuristic schedule adapts it; start every run the same
+        before = speculation_stats.stats()
+        result = run(wrapper, args.max_new_tokens)
+        after = speculation_stats.stats()
+        proposed = after["proposed_tokens"] - before["proposed_tokens"]
+        accepted = after["accepted_tokens"] - before["accepted_tokens"]
+        generated = after["generated_tokens"] - before["generated_tokens"]
+        passes = generated - accepted  # every BioGPT pass adds one token of its own
+        identical = sum(a == b for a, b in zip(result.pop("texts"), greedy["texts"]))
+        mismatches += len(PROMPTS) - identical
+        results[f"speculative_{num_tokens}"] = {
+            **result,
+            "identical_to_greedy": f"{identical}/{len(PROMPTS)}",
+            "speedup": round(greedy["seconds"] / result["seconds"], 2),
+            "acceptance_rate": round(accepted / proposed, 3) if proposed else None,
+            "tokens_per_target_pass": round(generated / passes, 2) if passes else None,
+        }
+    print(json.dumps(results, indent=2))
+    if mismatches:
+        raise SystemExit(f"{mismatches} speculative answers differ from greedy decoding")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Startup time and memory of N model-loading processes, copied vs memory-mapped weights.
+
+Starts ``--processes`` processes at once, each loading the models through
+``ModelRegistry`` (with its warm-up inference, so every weight is touched) as
+an API worker or model server would.  For each it records the time from
+spawn to ready, then RSS and PSS (proportional set size: shared pages split
+between the processes mapping them) overall and for the mapped weight files.
+
+Modes:
+
+* ``copy``: ``MMAP_WEIGHTS=0``, every process holds its own weights;
+* ``mmap_cold``: ``MMAP_WEIGHTS=1`` with the exports evicted from the page
+  cache first, the first start after a deploy or reboot;
+* ``mmap_warm``: ``MMAP_WEIGHTS=1`` with the exports already cached.
+
+The exports are written to a temporary ``WEIGHTS_DIR`` first (timed as
+``export_s``).  Models come from ``MODELS_PACKAGE`` (default ``Models`` next
+to the repo).
+
+Usage:
+    python benchmarks/bench_weights.py --processes 4
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+
+import weights  # noqa: E402
+
+
+def child():
+    """Load the models, report, and hold them until stdin closes."""
+    from inference import ModelRegistry
+
+    models = ModelRegistry(server="")
+    models.start()
+    models.wait()
+    print(json.dumps(models.status()), flush=True)
+    sys.stdin.read()
+
+
+def evict(directory: str):
+    """Drop the exports' clean pages from the page cache (no root needed)."""
+    for path in glob.glob(os.path.join(directory, "*.safetensors")):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def run_mode(args, env: dict, mmap: bool) -> dict:
+    env = {**env, "MMAP_WEIGHTS": "1" if mmap else "0"}
+    started = time.perf_counter()
+    children = [subprocess.Popen([sys.executable, __file__, "--child"], cwd=ROOT, env=env,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                for _ in range(args.processes)]
+    try:
+        ready_s, statuses = [], []
+        for process in children:
+            line = process.stdout.readline()
+            if not line:
+                raise RuntimeError(f"Child {process.pid} exited with {process.wait()}")
+            ready_s.append(round(time.perf_counter() - started, 2))
+            statuses.append(json.loads(line))
+        reports = [weights.memory_report(process.pid) for process in children]
+    finally:
+        for process in children:
+            process.stdin.close()
+            process.wait(30)
+
+    mapped_pss = [sum(f["pss_mb"] for f in report["weights"].values()) for report in reports]
+    mapped_dirty = [sum(f.get("private_dirty_mb", 0) for f in report["weights"].values()) for report in reports]
+    return {
+        "ready_s_each": ready_s,
+        "models_load_s_each": [round(s.get("medbert_load_s", 0) + s.get("biogpt_load_s", 0), 2) for s in statuses],
+        "rss_mb_each": [report["rss_mb"] for report in reports],
+        "pss_mb_each": [report["pss_mb"] for report in reports],
+        "pss_mb_total": round(sum(report["pss_mb"] for report in reports), 1),
+        "mapped_weights_pss_mb_total": round(sum(mapped_pss), 1),
+        "mapped_weights_private_dirty_mb_total": round(sum(mapped_dirty), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--modes", nargs="+", choices=("copy", "mmap_cold", "mmap_warm"),
+                        default=["copy", "mmap_cold", "mmap_warm"])
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    from inference import MODELS_PACKAGE
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.pathsep.join([ROOT, os.path.dirname(ROOT), os.environ.get("PYTHONPATH", "")])
+        env = {**os.environ, "PYTHONPATH": path, "WEIGHTS_DIR": tmp, "MODEL_SERVER": ""}
+        started = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(ROOT, "weights.py"), "export", "--dir", tmp,
+                        "--package", MODELS_PACKAGE], env=env, check=True, stderr=subprocess.DEVNULL)
+        results = {
+            "processes": args.processes,
+            "export_s": round(time.perf_counter() - started, 2),
+            "export_mb": round(sum(os.path.getsize(p) for p in glob.glob(os.path.join(tmp, "*"))) / 2 ** 20, 1),
+        }
+        for mode in args.modes:
+            if mode == "mmap_cold":
+                evict(tmp)
+            results[mode] = run_mode(args, env, mmap=mode != "copy")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""Mixed-workload load test for the HealthBot API.
+
+Runs app.py in-process (httpx ASGI transport, startup/shutdown hooks
+included) or as a ``uvicorn`` subprocess, against a temporary database and,
+by default, the deterministic stand-ins in ``benchmarks/stub_models``
+(``--models real`` loads the real ``Models`` package instead).
+
+After registering ``--users`` users and seeding some history, every
+``--concurrency`` level runs for ``--duration`` seconds with that many
+clients.  Each client draws operations from ``--mix`` (login, healthbot,
+history, detail) with its own seeded RNG, so the request sequence is the
+same on every run.  Healthbot queries come from ``--distinct-queries``
+questions, which sets how often the response cache can answer.
+
+The report (stdout or ``--output``) is JSON with p50/p95/p99 latency,
+throughput and error rates per level and per operation, plus the git commit
+it ran against.  ``--compare base.json new.json`` prints the differences.
+
+Usage:
+    python benchmarks/loadtest.py --concurrency 1 8 32 --duration 15 --output before.json
+    python benchmarks/loadtest.py --server uvicorn --stub-biogpt-ms 120 --output after.json
+    python benchmarks/loadtest.py --compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+OPERATIONS = ("login", "healthbot", "history", "detail")
+CONDITIONS = ("diabetes", "asthma", "migraine", "flu", "hypertension", "anemia", "arthritis", "eczema",
+              "bronchitis", "gastritis", "insomnia", "psoriasis", "sinusitis", "tonsillitis", "gout", "angina")
+TEMPLATES = ("What are the symptoms of {}?", "How is {} treated?", "What causes {}?",
+             "Is {} contagious?", "How long does {} last?", "Can diet help with {}?")
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {name!r}, expected one of {OPERATIONS}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def build_queries(count: int) -> list:
+    queries = [t.format(c) for t in TEMPLATES for c in CONDITIONS]
+    return [queries[i % len(queries)] + ("" if i < len(queries) else f" (case {i})") for i in range(count)]
+
+
+def app_environment(args, database_path: str) -> dict:
+    env = {
+        "SECRET_KEY": "loadtest",
+        "DATABASE": database_path,
+        "LOGIN_IP_MAX_ATTEMPTS": "1000000000",  # every client shares one IP
+        "SCHEDULER_REGISTERED_RATE": "0",  # measure the server, not the per-user quotas
+        "SCHEDULER_REGISTERED_MAX_CONCURRENT": "0",
+        "AUTH_HASH_MAX_QUEUE": str(max(args.concurrency) * 2),
+    }
+    if args.models == "stub":
+        env.update({
+            "MODELS_PACKAGE": "stub_models",
+            "STUB_MEDBERT_LATENCY_MS": str(args.stub_medbert_ms),
+            "STUB_BIOGPT_LATENCY_MS": str(args.stub_biogpt_ms),
+            "STUB_BIOGPT_MS_PER_WORD": str(args.stub_ms_per_word),
+            "STUB_RESPONSE_WORDS": str(args.stub_words),
+        })
+    return env
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def summarize(samples: list) -> dict:
+    latencies = [ms for ms, _ in samples]
+    errors = sum(1 for _, status in samples if status >= 400)
+    statuses = defaultdict(int)
+    for _, status in samples:
+        statuses[str(status)] += 1
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0.0, 0.0, 0.0)
+    return {
+        "count": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "mean_ms": round(float(np.mean(latencies)), 2) if latencies else 0.0,
+        "status": dict(statuses),
+    }
+
+
+class Workload:
+    """Users, their tokens and chat ids, and the operations the clients draw from."""
+
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.queries = build_queries(args.distinct_queries)
+        self.users = [(f"loadtest{i}", f"password-{i}") for i in range(args.users)]
+        self.tokens = {}
+        self.chat_ids = defaultdict(list)
+        ops = [op for op in OPERATIONS if args.mix.get(op, 0) > 0]
+        self.ops, self.weights = ops, [args.mix[op] for op in ops]
+
+    def headers(self, user: str) -> dict:
+        return {"Authorization": f"Bearer {self.tokens[user]}"}
+
+    async def setup(self, history_per_user: int = 3):
+        for username, password in self.users:
+            await self.client.post("/auth/register", json={"username": username, "password": password})
+            r = await self.client.post("/auth/login", json={"username": username, "password": password})
+            r.raise_for_status()
+            self.tokens[username] = r.json()["token"]
+        rng = random.Random(self.args.seed)
+        for username, _ in self.users:
+            for _ in range(history_per_user):
+                r = await self.client.post("/healthbot", json={"query": rng.choice(self.queries)},
+                                           headers=self.headers(username))
+                r.raise_for_status()
+            r = await self.client.get("/chat_history/", params={"fields": "id", "limit": 100},
+                                      headers=self.headers(username))
+            self.chat_ids[username] = [c["id"] for day in r.json()["history"].values() for c in day]
+
+    async def request(self, op: str, rng: random.Random) -> int:
+        username, password = rng.choice(self.users)
+        if op == "login":
+            r = await self.client.post("/auth/login", json={"username": username, "password": password})
+        elif op == "healthbot":
+            r = await self.client.post("/healthbot", json={"query": rng.choice(self.queries)},
+                                       headers=self.headers(username))
+        elif op == "history":
+            r = await self.client.get("/chat_history/", params={"limit": 50}, headers=self.headers(username))
+        else:
+            chat_id = rng.choice(self.chat_ids[username]) if self.chat_ids[username] else 0
+            r = await self.client.get(f"/chat_history/{chat_id}", headers=self.headers(username))
+        return r.status_code
+
+    async def client_loop(self, index: int, deadline: float, samples: dict):
+        rng = random.Random(self.args.seed * 100_003 + index)
+        while time.perf_counter() < deadline:
+            op = rng.choices(self.ops, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                status = await self.request(op, rng)
+            except Exception:
+                status = 599  # transport error or timeout
+            samples[op].append(((time.perf_counter() - start) * 1000, status))
+
+    async def run_level(self, concurrency: int, duration: float) -> dict:
+        samples = defaultdict(list)
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(self.client_loop(i, deadline, samples) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        everything = [s for op in samples.values() for s in op]
+        overall = summarize(everything)
+        return {
+            "concurrency": concurrency,
+            "duration_s": round(elapsed, 2),
+            "throughput_rps": round(len(everything) / elapsed, 1),
+            **{k: overall[k] for k in ("count", "errors", "error_rate", "p50_ms", "p95_ms", "p99_ms")},
+            "operations": {op: summarize(samples[op]) for op in self.ops if samples[op]},
+        }
+
+
+async def wait_ready(client, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/readyz")).status_code == 200:
+                return
+        except Exception:
+            pass  # server still starting
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"API not ready after {timeout:.0f}s")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run(args) -> dict:
+    import httpx
+
+    timeout = httpx.Timeout(args.request_timeout)
+    limits = httpx.Limits(max_connections=max(args.concurrency) * 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        env = app_environment(args, os.path.join(tmp, "loadtest.db"))
+        server = app = None
+        if args.server == "uvicorn":
+            port = free_port()
+            path = os.pathsep.join([BENCH_DIR, ROOT, os.path.dirname(ROOT), os.environ.get("PYTHONPATH", "")])
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+                 "--log-level", "warning"],
+                cwd=ROOT, env={**os.environ, **env, "PYTHONPATH": path})
+            client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=timeout, limits=limits)
+        else:
+            os.environ.update(env)
+            sys.path[:0] = [BENCH_DIR, ROOT]
+            import app
+            await app.app.router.startup()
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://loadtest",
+                                       timeout=timeout)
+        try:
+            await wait_ready(client, args.ready_timeout)
+            workload = Workload(client, args)
+            await workload.setup()
+            if args.warmup:
+                await workload.run_level(args.concurrency[0], args.warmup)
+            levels = []
+            for concurrency in args.concurrency:
+                level = await workload.run_level(concurrency, args.duration)
+                print(json.dumps({k: level[k] for k in ("concurrency", "throughput_rps", "p50_ms", "p99_ms",
+                                                        "error_rate")}), file=sys.stderr, flush=True)
+                levels.append(level)
+        finally:
+            await client.aclose()
+            if server is not None:
+                server.terminate()
+                server.wait(timeout=30)
+            elif app is not None:
+                await app.app.router.shutdown()
+
+    return {
+        "commit": git_commit(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("compare", "output")},
+        "levels": levels,
+    }
+
+
+def compare(base_path: str, new_path: str):
+    """Print per level/operation changes of throughput, p50, p99 and error rate."""
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def change(old, value):
+        return f"{old:>9} -> {value:>9} ({(value - old) / old * 100:+.1f}%)" if old else f"{old:>9} -> {value:>9}"
+
+    print(f"{base['commit']} -> {new['commit']}")
+    base_levels = {level["concurrency"]: level for level in base["levels"]}
+    for level in new["levels"]:
+        old = base_levels.get(level["concurrency"])
+        if old is None:
+            continue
+        print(f"\nconcurrency {level['concurrency']}")
+        print(f"  throughput_rps {change(old['throughput_rps'], level['throughput_rps'])}")
+        for op, stats in level["operations"].items():
+            before = old["operations"].get(op)
+            if before is None:
+                continue
+            for key in ("p50_ms", "p99_ms", "error_rate"):
+                print(f"  {op:<9} {key:<10} {change(before[key], stats[key])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=("inprocess", "uvicorn"), default="inprocess")
+    parser.add_argument("--models", choices=("stub", "real"), default="stub")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--duration", type=float, default=15, help="seconds per concurrency level")
+    parser.add_argument("--warmup", type=float, default=2, help="unrecorded seconds before the first level")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("login=1,healthbot=6,history=2,detail=1"))
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--distinct-queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stub-medbert-ms", type=float, default=5)
+    parser.add_argument("--stub-biogpt-ms", type=float, default=40)
+    parser.add_argument("--stub-ms-per-word", type=float, default=1)
+    parser.add_argument("--stub-words", type=int, default=60)
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--ready-timeout", type=float, default=600)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two reports and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
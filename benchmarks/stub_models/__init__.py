@@ -0,0 +1,27 @@
+"""Deterministic stand-ins for ``Models.medbert`` and ``Models.biogpt``.
+
+Select them with ``MODELS_PACKAGE=stub_models`` (``benchmarks/`` must be on
+``sys.path``; ``loadtest.py`` arranges that).  They expose only the wrapper
+interface (``classify_text`` / ``generate_response``), so the API takes its
+non-HF fallbacks, and they never touch torch.  Latency is simulated with
+``time.sleep`` (which, like a torch forward pass, releases the GIL):
+
+* ``STUB_MEDBERT_LATENCY_MS`` - per ``classify_text`` call (default 5).
+* ``STUB_BIOGPT_LATENCY_MS`` - fixed cost per ``generate_response`` call
+  (default 40).
+* ``STUB_BIOGPT_MS_PER_WORD`` - additional cost per generated word
+  (default 1).
+* ``STUB_RESPONSE_WORDS`` - words per response (default 60).
+
+Outputs depend only on the input text, so runs are reproducible.
+"""
+import hashlib
+import os
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+def seed_of(text: str) -> int:
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
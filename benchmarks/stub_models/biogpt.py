@@ -0,0 +1,26 @@
+import random
+import time
+
+from . import env_float, seed_of
+
+VOCABULARY = (
+    "symptoms include fever cough fatigue pain swelling nausea headache rash treatment may involve rest "
+    "fluids medication rarely surgery consult a doctor if they persist or worsen the condition is common "
+    "and usually resolves within days chronic cases need monitoring blood pressure glucose levels diet "
+    "exercise and sleep help recovery"
+).split()
+
+
+class StubBioGPT:
+    def __init__(self):
+        self.latency_s = env_float("STUB_BIOGPT_LATENCY_MS", 40) / 1000
+        self.per_word_s = env_float("STUB_BIOGPT_MS_PER_WORD", 1) / 1000
+        self.words = int(env_float("STUB_RESPONSE_WORDS", 60))
+
+    def generate_response(self, query: str) -> str:
+        time.sleep(self.latency_s + self.per_word_s * self.words)
+        rng = random.Random(seed_of(query))
+        return " ".join(rng.choice(VOCABULARY) for _ in range(self.words))
+
+
+biogpt = StubBioGPT()
@@ -0,0 +1,21 @@
+import time
+
+import numpy as np
+
+from . import env_float, seed_of
+
+NUM_LABELS = 3
+
+
+class StubMedBERT:
+    def __init__(self):
+        self.latency_s = env_float("STUB_MEDBERT_LATENCY_MS", 5) / 1000
+
+    def classify_text(self, text: str) -> np.ndarray:
+        time.sleep(self.latency_s)
+        logits = np.random.default_rng(seed_of(text)).normal(size=(1, NUM_LABELS))
+        scores = np.exp(logits)
+        return scores / scores.sum(axis=-1, keepdims=True)
+
+
+medbert = StubMedBERT()
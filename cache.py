@@ -0,0 +1,306 @@
+"""Response caching for /healthbot.
+
+``ResponseCache`` maps a normalized query to the BioGPT response generated
+for it and why the generation stopped, so a hit reports an answer cut at the
+token limit as partial just like the miss that produced it.  Entries are
+evicted least-recently-used once the entry or byte cap is reached and expire
+after a TTL.  The cache can be persisted to a SQLite table so it survives
+restarts; its inserts and deletes are handed to one writer thread, in order,
+so the event loop never waits on a commit.  ``get_or_compute`` coalesces
+identical in-flight queries so they share one generation.
+
+``SemanticCache`` catches paraphrases: it keeps the MedBERT embedding of
+every generated query in a ``VectorIndex`` and answers a new query from the
+closest stored response when their cosine similarity clears a threshold.
+"""
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from vector_index import VectorIndex
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB")  # unset keeps the cache in memory only
+
+# Off by default: MedBERT is not tuned for sentence similarity, and its mean-pooled
+# embeddings sit close together, so distinct questions can clear the threshold.
+# Check the threshold with ``bench_semantic_cache.py --pairs`` before enabling it.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "20000"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+SEMANTIC_CACHE_APPROXIMATE_AT = int(os.getenv("SEMANTIC_CACHE_APPROXIMATE_AT", "50000"))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH")  # e.g. semantic_cache.npz
+
+HIT, MISS, COALESCED = "hit", "miss", "coalesced"
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Case-fold, collapse whitespace and drop trailing punctuation."""
+    return _WHITESPACE.sub(" ", query).strip().rstrip("?!.").strip().casefold()
+
+
+class ResponseCache:
+    """LRU + TTL cache of responses keyed by normalized query."""
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_SIZE,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        ttl_seconds: float = RESPONSE_CACHE_TTL,
+        db_path: Optional[str] = RESPONSE_CACHE_DB,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(1, max_bytes)
+        self.ttl = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[str, Optional[str], float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+        self._db = None
+        self._writer: Optional[ThreadPoolExecutor] = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    stop_reason TEXT
+                )
+            """)
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(response_cache)")]
+            if "stop_reason" not in columns:  # caches persisted before stop reasons were kept
+                self._db.execute("ALTER TABLE response_cache ADD COLUMN stop_reason TEXT")
+            self._db.commit()
+            # One thread, so writes apply in the order the in-memory cache made them
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+            self._load()
+
+    def _load(self):
+        """Warm the in-memory LRU with the newest unexpired persisted rows."""
+        cutoff = time.time() - self.ttl
+        self._db.execute("DELETE FROM response_cache WHERE created_at < ?", (cutoff,))
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT key, response, stop_reason, created_at FROM response_cache ORDER BY created_at DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        for key, response, stop_reason, created_at in reversed(rows):
+            self._store(key, response, stop_reason, created_at)
+        logger.info(f"Loaded {len(self._entries)} cached responses from disk")
+
+    def get(self, query: str) -> Optional[Tuple[str, Optional[str]]]:
+        """``(response, stop_reason)`` for ``query``, or None."""
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[2] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def put(self, query: str, response: str, stop_reason: Optional[str] = None):
+        key = normalize_query(query)
+        created_at = time.time()
+        with self._lock:
+            self._store(key, response, stop_reason, created_at)
+            self._write(
+                "INSERT OR REPLACE INTO response_cache (key, response, stop_reason, created_at) VALUES (?, ?, ?, ?)",
+                (key, response, stop_reason, created_at),
+            )
+
+    def _write(self, sql: str, params: tuple):
+        """Queue one statement for the writer thread (no-op for in-memory caches)."""
+        if self._writer is not None:
+            self._writer.submit(self._execute, sql, params)
+
+    def _execute(self, sql: str, params: tuple):
+        try:
+            self._db.execute(sql, params)
+            self._db.commit()
+        except sqlite3.Error:
+            logger.exception("Could not persist a response cache change")
+
+    def close(self):
+        """Wait for queued writes and close the database."""
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+            self._writer = None
+            self._db.close()
+
+    def _store(self, key: str, response: str, stop_reason: Optional[str], created_at: float):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (response, stop_reason, created_at)
+        self._bytes += len(response.encode("utf-8"))
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        response, _, _ = self._entries.pop(key)
+        self._bytes -= len(response.encode("utf-8"))
+        self._write("DELETE FROM response_cache WHERE key = ?", (key,))
+
+    async def get_or_compute(
+        self,
+        query: str,
+        compute: Callable[[], Awaitable[Tuple[str, Optional[str]]]],
+        cacheable: Optional[Callable[[Tuple[str, Optional[str]]], bool]] = None,
+    ) -> Tuple[Tuple[str, Optional[str]], str]:
+        """Return ``((response, stop_reason), status)`` where status is hit, miss or coalesced.
+
+        ``compute`` returns ``(response, stop_reason)``.  Only the first caller
+        for a key runs it; identical queries that arrive while it is running
+        wait for its result.  A result ``cacheable`` rejects (e.g. one cut
+        short for its own caller) is not stored, and the waiting callers
+        compute their own.
+        """
+        key = normalize_query(query)
+        while True:
+            cached = self.get(query)
+            if cached is not None:
+                self.hits += 1
+                return cached, HIT
+
+            leader = self._inflight.get(key)
+            if leader is None:
+                break
+            try:
+                result = await asyncio.shield(leader)
+            except asyncio.CancelledError:
+                if leader.cancelled():
+                    continue  # the leader's client went away; try again ourselves
+                raise
+            self.coalesced += 1
+            return result, COALESCED
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # followers re-raise it; don't warn if there are none
+            raise
+        finally:
+            del self._inflight[key]
+
+        if cacheable is not None and not cacheable(result):
+            future.cancel()
+            return result, MISS
+        self.put(query, *result)
+        future.set_result(result)
+        return result, MISS
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            "persistent": self._db is not None,
+        }
+
+
+class SemanticCache:
+    """Answers near-duplicate queries from stored responses by embedding similarity."""
+
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = SEMANTIC_CACHE_SIZE,
+        approximate_threshold: int = SEMANTIC_CACHE_APPROXIMATE_AT,
+        path: Optional[str] = SEMANTIC_CACHE_PATH,
+        enabled: bool = SEMANTIC_CACHE_ENABLED,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.approximate_threshold = approximate_threshold
+        self.path = path
+        self.enabled = enabled
+        self._index: Optional[VectorIndex] = None
+        self.hits = 0
+        self.misses = 0
+
+        if enabled and path and os.path.exists(path):
+            with np.load(path) as data:
+                dim = data["vectors"].shape[1]
+            self._index = self._new_index(dim)
+            self._index.load(path)
+            logger.info(f"Loaded {len(self._index)} semantic cache entries from {path}")
+
+    def _new_index(self, dim: int) -> VectorIndex:
+        return VectorIndex(dim, self.max_entries, approximate_threshold=self.approximate_threshold)
+
+    def lookup(self, embedding: Optional[np.ndarray]) -> Optional[Tuple[str, Optional[str]]]:
+        """Return ``(response, stop_reason)`` of the closest stored query above the threshold."""
+        if not self.enabled or embedding is None or self._index is None:
+            return None
+        matches = self._index.search(embedding, k=1)
+        if matches and matches[0][0] >= self.threshold:
+            self.hits += 1
+            payload = matches[0][1]
+            return payload["response"], payload.get("stop_reason")
+        self.misses += 1
+        return None
+
+    def add(self, embedding: Optional[np.ndarray], query: str, response: str, stop_reason: Optional[str] = None):
+        if not self.enabled or embedding is None:
+            return
+        if self._index is None:
+            self._index = self._new_index(embedding.shape[-1])
+        self._index.add(embedding, {"query": query, "response": response, "stop_reason": stop_reason})
+
+    def save(self):
+        if self.enabled and self.path and self._index is not None:
+            self._index.save(self.path)
+            logger.info(f"Saved {len(self._index)} semantic cache entries to {self.path}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._index) if self._index is not None else 0,
+            "bytes": self._index.nbytes if self._index is not None else 0,
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "approximate": self._index.approximate if self._index is not None else False,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,495 @@
+"""SQLite access layer for the HealthBot API.
+
+Connections come from a fixed-size ``ConnectionPool`` instead of being
+opened per request.  Every connection runs in WAL mode with
+``synchronous=NORMAL`` (readers never block the writer and commits skip the
+per-transaction fsync of the main database file), a memory-mapped read path
+and a larger page cache.  SQL text lives in module constants so each
+connection's statement cache reuses the prepared statements.
+
+Async routes call ``run_db(fn, *args)``, which runs ``fn(conn, *args)`` on a
+dedicated thread pool so SQLite I/O never blocks the event loop.
+
+Chat records are written behind the response by ``ChatWriter``, which
+queues them and commits them in batches; readers of a user's history call
+``ChatWriter.flush_user`` first so they always see that user's own writes.
+
+``search_history`` runs ranked full-text search over a user's chats through
+the ``chat_history_fts`` FTS5 index, which triggers keep in sync.
+"""
+import asyncio
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DATABASE = os.getenv("DATABASE", "health_chatbot.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", str(64 * 1024)))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+DB_DELETE_CHUNK = int(os.getenv("DB_DELETE_CHUNK", "500"))  # rows per write transaction in bulk deletes
+# 0 commits each chat before responding.  Off by default with MODEL_SERVER, the setup for several
+# API workers, since read-your-writes only holds within one process (see ChatWriter)
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "0" if os.getenv("MODEL_SERVER") else "1") == "1"
+CHAT_WRITE_BATCH = int(os.getenv("CHAT_WRITE_BATCH", "256"))
+CHAT_WRITE_INTERVAL_MS = float(os.getenv("CHAT_WRITE_INTERVAL_MS", "50"))
+CHAT_WRITE_MAX_PENDING = int(os.getenv("CHAT_WRITE_MAX_PENDING", "10000"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS chat_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    query TEXT NOT NULL,
+    response TEXT NOT NULL,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+"""
+
+# Applied in order by init_db(); PRAGMA user_version records how many have run.
+# Append new steps, never edit or reorder released ones.
+MIGRATIONS = [
+    # 1: a user's history newest-first without scanning or sorting the whole table
+    """
+    CREATE INDEX IF NOT EXISTS idx_chat_history_user_timestamp
+        ON chat_history (user_id, timestamp DESC);
+    """,
+    # 2: id as tie-breaker so keyset pages (timestamp, id) come straight off the index
+    """
+    CREATE INDEX IF NOT EXISTS idx_chat_history_user_timestamp_id
+        ON chat_history (user_id, timestamp DESC, id DESC);
+    DROP INDEX IF EXISTS idx_chat_history_user_timestamp;
+    """,
+    # 3: the retention job finds expired rows oldest-first across all users
+    """
+    CREATE INDEX IF NOT EXISTS idx_chat_history_timestamp
+        ON chat_history (timestamp, id);
+    """,
+    # 4: full-text search over queries and responses.  External content (the
+    # text is not stored twice), kept in sync by triggers.  user_id is indexed
+    # as a token so a user's matches are an intersection of two doclists
+    # instead of every user's matches filtered afterwards; its bm25 weight is 0.
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5(
+        user_id, query, response,
+        content='chat_history', content_rowid='id', tokenize='porter unicode61'
+    );
+    INSERT INTO chat_history_fts (chat_history_fts, rank) VALUES ('rank', 'bm25(0.0, 2.0, 1.0)');
+    CREATE TRIGGER IF NOT EXISTS chat_history_fts_insert AFTER INSERT ON chat_history BEGIN
+        INSERT INTO chat_history_fts (rowid, user_id, query, response)
+            VALUES (new.id, new.user_id, new.query, new.response);
+    END;
+    CREATE TRIGGER IF NOT EXISTS chat_history_fts_delete AFTER DELETE ON chat_history BEGIN
+        INSERT INTO chat_history_fts (chat_history_fts, rowid, user_id, query, response)
+            VALUES ('delete', old.id, old.user_id, old.query, old.response);
+    END;
+    CREATE TRIGGER IF NOT EXISTS chat_history_fts_update AFTER UPDATE ON chat_history BEGIN
+        INSERT INTO chat_history_fts (chat_history_fts, rowid, user_id, query, response)
+            VALUES ('delete', old.id, old.user_id, old.query, old.response);
+        INSERT INTO chat_history_fts (rowid, user_id, query, response)
+            VALUES (new.id, new.user_id, new.query, new.response);
+    END;
+    INSERT INTO chat_history_fts (chat_history_fts) VALUES ('rebuild');
+    -- One segment up front, or the following writes pay for merging the rebuild's segments
+    INSERT INTO chat_history_fts (chat_history_fts) VALUES ('optimize');
+    """,
+]
+
+SQL_USER_BY_NAME = "SELECT * FROM users WHERE username = ?"
+SQL_USER_ID_BY_NAME = "SELECT id FROM users WHERE username = ?"
+SQL_INSERT_USER = "INSERT INTO users (username, password) VALUES (?, ?)"
+SQL_INSERT_CHAT = "INSERT INTO chat_history (user_id, query, response) VALUES (?, ?, ?)"
+SQL_CHAT_DETAIL = "SELECT query, response, timestamp FROM chat_history WHERE id = ? AND user_id = ?"
+SQL_SEARCH_HISTORY = (
+    "SELECT c.id, c.query, c.response, c.timestamp, "
+    "snippet(chat_history_fts, 2, '**', '**', '…', 16) "
+    "FROM chat_history_fts JOIN chat_history AS c ON c.id = chat_history_fts.rowid "
+    "WHERE chat_history_fts MATCH ? AND c.user_id = ? ORDER BY rank LIMIT ? OFFSET ?"
+)
+SQL_DELETE_HISTORY_CHUNK = "DELETE FROM chat_history WHERE id IN (SELECT id FROM chat_history WHERE user_id = ? LIMIT ?)"
+
+
+class ConnectionPool:
+    """Fixed-size pool of tuned SQLite connections shared across threads."""
+
+    def __init__(self, path: str = DATABASE, size: int = DB_POOL_SIZE):
+        self.path = path
+        self.size = max(1, size)
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._connect()
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+pool = ConnectionPool()
+_executor = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix="sqlite")
+
+
+def _call(fn: Callable, args: tuple):
+    with pool.connection() as conn:
+        return fn(conn, *args)
+
+
+async def run_db(fn: Callable, *args):
+    """Run ``fn(conn, *args)`` with a pooled connection off the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(_executor, _call, fn, args)
+
+
+def _statements(script: str) -> List[str]:
+    """Split a migration script into its statements; trigger bodies stay whole."""
+    statements, current = [], ""
+    for line in script.splitlines(keepends=True):
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ""
+    return statements
+
+
+def migrate(conn: sqlite3.Connection):
+    """Bring the schema up to ``len(MIGRATIONS)``, one transaction per step.
+
+    Each step takes the write lock first (BEGIN IMMEDIATE) and reads
+    user_version inside it, so workers starting together apply every step
+    exactly once: the others wait for the lock and find the step done.
+    """
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return
+            logger.info(f"Applying database migration {version + 1}")
+            # Statement by statement: executescript would commit the open transaction
+            for statement in _statements(MIGRATIONS[version]):
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def incremental_vacuum_enabled(conn: sqlite3.Connection) -> bool:
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def enable_incremental_vacuum(conn: sqlite3.Connection):
+    """Switch the file to auto_vacuum=INCREMENTAL so freed pages can be returned.
+
+    Once the file has a header (WAL mode writes one) the mode only changes
+    through a VACUUM, which rewrites the whole file under an exclusive lock.
+    ``init_db`` does it for a new, empty database only; an existing one is
+    switched by the maintenance step ``python retention.py --enable-incremental-vacuum``.
+    """
+    if incremental_vacuum_enabled(conn):
+        return
+    if conn.execute("SELECT count(*) FROM sqlite_master").fetchone()[0]:
+        logger.info("Rebuilding the database file for incremental vacuum")
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def init_db():
+    with pool.connection() as conn:
+        if not conn.execute("SELECT count(*) FROM sqlite_master").fetchone()[0]:
+            enable_incremental_vacuum(conn)  # instant while the file is empty
+        elif not incremental_vacuum_enabled(conn):
+            logger.warning("Freed pages are not returned to the filesystem until the database is switched "
+                           "to incremental vacuum: run `python retention.py --enable-incremental-vacuum`")
+        conn.executescript(SCHEMA)
+        conn.commit()
+        migrate(conn)
+
+
+# -- queries ----------------------------------------------------------------
+
+def fetch_user(conn: sqlite3.Connection, username: str) -> Optional[tuple]:
+    return conn.execute(SQL_USER_BY_NAME, (username,)).fetchone()
+
+
+def fetch_user_id(conn: sqlite3.Connection, username: str) -> Optional[int]:
+    row = conn.execute(SQL_USER_ID_BY_NAME, (username,)).fetchone()
+    return row[0] if row else None
+
+
+def insert_user(conn: sqlite3.Connection, username: str, hashed_password: str):
+    conn.execute(SQL_INSERT_USER, (username, hashed_password))
+    conn.commit()
+
+
+def insert_chat(conn: sqlite3.Connection, user_id: int, query: str, response: str):
+    conn.execute(SQL_INSERT_CHAT, (user_id, query, response))
+    conn.commit()
+
+
+def insert_chats(conn: sqlite3.Connection, records: List[Tuple[int, str, str]]):
+    """Insert ``(user_id, query, response)`` records in one transaction."""
+    conn.executemany(SQL_INSERT_CHAT, records)
+    conn.commit()
+
+
+HISTORY_COLUMNS = ("id", "query", "response", "timestamp")
+
+
+def history_page_sql(columns: Sequence[str], since: bool = False, until: bool = False, after: bool = False) -> str:
+    """SQL for one newest-first page of a user's history.
+
+    ``after`` continues from a ``(timestamp, id)`` keyset cursor.  Only the
+    few flag combinations are possible, so statement caching still applies.
+    """
+    unknown = set(columns) - set(HISTORY_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown chat_history columns: {sorted(unknown)}")
+    sql = f"SELECT {', '.join(columns)} FROM chat_history WHERE user_id = ?"
+    if since:
+        sql += " AND timestamp >= ?"
+    if until:
+        sql += " AND timestamp < ?"
+    if after:
+        sql += " AND (timestamp, id) < (?, ?)"
+    return sql + " ORDER BY timestamp DESC, id DESC LIMIT ?"
+
+
+def fetch_history_page(
+    conn: sqlite3.Connection,
+    user_id: int,
+    columns: Sequence[str] = HISTORY_COLUMNS,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    after: Optional[Tuple[str, int]] = None,
+    limit: int = 100,
+) -> list:
+    """Rows of ``columns`` for one page, newest first."""
+    params = [user_id]
+    if since is not None:
+        params.append(since)
+    if until is not None:
+        params.append(until)
+    if after is not None:
+        params.extend(after)
+    params.append(limit)
+    sql = history_page_sql(columns, since is not None, until is not None, after is not None)
+    return conn.execute(sql, params).fetchall()
+
+
+SEARCH_COLUMNS = ("id", "query", "response", "timestamp", "snippet")
+SEARCH_MAX_TERMS = 16
+
+
+def search_expression(text: str) -> Optional[str]:
+    """Free text -> FTS5 query matching every word; None when there are no words.
+
+    Words are quoted, so user input can never be read as FTS5 syntax.
+    """
+    terms = re.findall(r"\w+", text)[:SEARCH_MAX_TERMS]
+    return " AND ".join(f'"{term}"' for term in terms) or None
+
+
+def search_history(conn: sqlite3.Connection, user_id: int, expression: str, limit: int = 20, offset: int = 0) -> list:
+    """A user's chats matching ``expression``, best match (bm25) first."""
+    # The terms are scoped to the text columns so one equal to a user id cannot match user_id
+    match = f'user_id : "{user_id}" AND {{query response}} : ({expression})'
+    return conn.execute(SQL_SEARCH_HISTORY, (match, user_id, limit, offset)).fetchall()
+
+
+def fetch_chat(conn: sqlite3.Connection, chat_id: int, user_id: int) -> Optional[tuple]:
+    return conn.execute(SQL_CHAT_DETAIL, (chat_id, user_id)).fetchone()
+
+
+def delete_history(conn: sqlite3.Connection, user_id: int, chunk: int = DB_DELETE_CHUNK) -> int:
+    """Delete a user's history ``chunk`` rows per transaction; returns the row count.
+
+    Committing between chunks lets other writers in instead of holding the
+    write lock for the whole delete.
+    """
+    deleted = 0
+    while True:
+        count = conn.execute(SQL_DELETE_HISTORY_CHUNK, (user_id, chunk)).rowcount
+        conn.commit()
+        deleted += count
+        if count < chunk:
+            return deleted
+
+
+# -- write-behind -----------------------------------------------------------
+
+class ChatWriter:
+    """Write-behind queue for chat_history inserts.
+
+    ``submit`` queues a record and returns at once; a background task
+    commits queued records in one transaction once ``batch_size`` are waiting
+    or ``interval_ms`` has passed since the first of them arrived.
+    ``flush_user`` waits until every record queued for a user is committed
+    (it cuts the interval short), which gives the history routes
+    read-your-writes.  ``close`` drains the queue on shutdown.
+
+    The queue is per process, so read-your-writes only holds within one: with
+    ``uvicorn --workers N`` a history read served by another worker can miss
+    a chat for up to ``interval_ms`` (Streamlit rereads right after each
+    chat).  Run several workers with ``CHAT_WRITE_BEHIND=0``, the default when
+    ``MODEL_SERVER`` is set.
+
+    With ``write_behind=False`` each record is committed before ``submit``
+    returns, as before.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = CHAT_WRITE_BATCH,
+        interval_ms: float = CHAT_WRITE_INTERVAL_MS,
+        max_pending: int = CHAT_WRITE_MAX_PENDING,
+        write_behind: bool = CHAT_WRITE_BEHIND,
+    ):
+        self.batch_size = max(1, batch_size)
+        self.interval = max(0.0, interval_ms) / 1000
+        self.max_pending = max(0, max_pending)
+        self.write_behind = write_behind
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._flush_now: Optional[asyncio.Event] = None
+        self._pending: Dict[int, asyncio.Future] = {}  # user id -> future of its latest queued record
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    async def submit(self, user_id: int, query: str, response: str):
+        if not self.write_behind:
+            await run_db(insert_chat, user_id, query, response)
+            self.written += 1
+            return
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[user_id] = future
+        # Blocks only when max_pending records are already queued
+        await self._queue.put(((user_id, query, response), future))
+
+    async def flush_user(self, user_id: int):
+        """Return once every record queued so far for ``user_id`` is committed."""
+        future = self._pending.get(user_id)
+        if future is None or future.done():
+            return
+        self._flush_now.set()
+        await asyncio.wait([future])
+
+    def _ensure_worker(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_pending)
+            self._flush_now = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _collect(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0 or self._flush_now.is_set():
+                break
+            get = asyncio.ensure_future(self._queue.get())
+            flush = asyncio.ensure_future(self._flush_now.wait())
+            await asyncio.wait([get, flush], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            flush.cancel()
+            if not get.cancel():
+                batch.append(get.result())
+        self._flush_now.clear()
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await run_db(insert_chats, [record for record, _ in batch])
+                self.written += len(batch)
+                self.batches += 1
+            except Exception:
+                self.failed += len(batch)
+                logger.exception(f"Failed to write {len(batch)} chat records")
+            for (user_id, _, _), future in batch:
+                future.set_result(None)
+                if self._pending.get(user_id) is future:
+                    del self._pending[user_id]
+                self._queue.task_done()
+
+    async def close(self):
+        """Commit everything still queued and stop the background task."""
+        if self._queue is None:
+            return
+        self._flush_now.set()
+        await self._queue.join()
+        if self._worker is not None:
+            self._worker.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "write_behind": self.write_behind,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "avg_batch": round(self.written / self.batches, 1) if self.batches else 0.0,
+            "failed": self.failed,
+        }
@@ -0,0 +1,820 @@
+"""Inference helpers shared by the HealthBot API.
+
+The wrappers in ``Models`` expose one prompt at a time
+(``biogpt.generate_response(query)``).  The helpers here add batched
+generation on top of the wrapper's Hugging Face ``model``/``tokenizer`` and a
+``MicroBatcher`` that gathers concurrent /healthbot queries for a short window
+so they share one forward pass.  With ``DRAFT_MODEL`` set, single-prompt
+generation is speculative (see ``speculative``), with the same output.
+
+Generation runs within a ``Budget`` per request: a token budget, a deadline
+and a cancellation flag, checked after every token, per row of a batch.  The
+result is a ``Generation``, the text and why it stopped (``complete``,
+``length``, ``deadline`` or ``cancelled``), so a cut-short answer can be
+returned marked as partial.
+
+All model calls run on ``InferencePool``, a bounded worker pool with
+admission control, so generation never blocks the asyncio event loop.
+``ModelRegistry`` loads the wrappers in the background so the API can serve
+auth and history routes while the models are still loading, or, with
+``MODEL_SERVER`` set, connects to a shared ``model_server`` process instead.
+Its remote wrappers provide ``generate_budgeted``, ``classify_batch``,
+``length_buckets``, ``embed`` and ``generate_stream`` themselves; the helpers
+below hand such calls straight to them.  torch and transformers are imported
+on the first local model call, so API workers using a model server never
+load them.
+"""
+import asyncio
+import contextvars
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from metrics import GENERATED_TOKENS, GENERATION_STOPS, MODEL_BATCH_SIZE, PROMPT_TOKENS, model_span
+from model_server import MODEL_SERVER, connect
+from speculative import DRAFT_MODEL, assistant_kwargs, counting, load_draft, record
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "15"))
+GENERATION_MAX_NEW_TOKENS = int(os.getenv("GENERATION_MAX_NEW_TOKENS", "200"))
+GENERATION_TIMEOUT_S = float(os.getenv("GENERATION_TIMEOUT_S", "60"))  # 0 lets generation run to its token budget
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", "32"))
+INFERENCE_RETRY_AFTER = int(os.getenv("INFERENCE_RETRY_AFTER", "5"))
+MODELS_PACKAGE = os.getenv("MODELS_PACKAGE", "Models")
+MODEL_PRELOAD = os.getenv("MODEL_PRELOAD", "1") == "1"  # 0 defers loading to the first inference request
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "1") == "1"
+
+_current_ticket: contextvars.ContextVar = contextvars.ContextVar("inference_ticket", default=None)
+
+
+class PoolSaturated(Exception):
+    """Raised by ``InferencePool.admit`` when the queue-depth limit is reached."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """One admitted request.  Tracks how long it waited for a worker.
+
+    A ticket with a ``lease`` (set by ``scheduler.FairScheduler``) is entered
+    with ``async with``, which first waits for the scheduler to grant it a
+    slot; that wait counts towards ``wait_s`` too.  A ticket admitted ahead of
+    a response body that may never run must be ``discard``-ed afterwards; one
+    held across a body's ``yield``s is released even when the body is closed
+    from another task.
+    """
+
+    def __init__(self, pool: "InferencePool", queue_depth: int):
+        self._pool = pool
+        self.queue_depth = queue_depth
+        self.wait_s = 0.0
+        self.lease = None
+        self._token = None
+        self._entered = False
+
+    def discard(self):
+        """Give back the slot if the ticket was never entered (e.g. the client left first); no-op otherwise."""
+        if not self._entered:
+            self._entered = True
+            self._pool._release()
+
+    def __enter__(self):
+        self._entered = True
+        self._token = _current_ticket.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            _current_ticket.reset(self._token)
+        except ValueError:
+            # Exited from another context: a streamed body paused in one task is closed
+            # by its response from another.  The slot still has to come back.
+            pass
+        finally:
+            self._pool._release()
+
+    async def __aenter__(self):
+        self._entered = True
+        if self.lease is not None:
+            try:
+                self.wait_s += await self.lease.acquire()
+            except BaseException:
+                self._pool._release()
+                raise
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        try:
+            self.__exit__(*exc)
+        finally:
+            if self.lease is not None:
+                self.lease.release(self.wait_s)
+
+    @property
+    def wait_ms(self) -> float:
+        return self.wait_s * 1000
+
+
+class InferencePool:
+    """Bounded worker pool for model calls with a queue-depth limit.
+
+    ``admit()`` reserves a slot for a request or raises ``PoolSaturated`` once
+    ``max_workers + max_queue`` requests are already in flight.  ``run()``
+    executes a blocking call on one of the pool threads and charges the time
+    it spent waiting for a thread to the current request's ``Ticket``.
+    """
+
+    def __init__(self, max_workers: int = INFERENCE_WORKERS, max_queue: int = INFERENCE_MAX_QUEUE, name: str = "inference"):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._running = 0
+        self._completed = 0
+        self._avg_wait_s = 0.0
+        self._avg_service_s = 0.0
+
+    def admit(self, limit: Optional[int] = None) -> Ticket:
+        """Reserve a slot; ``limit`` lowers the in-flight bound for this request (e.g. for lower priorities)."""
+        bound = self.max_workers + self.max_queue
+        if limit is not None:
+            bound = min(bound, limit)
+        with self._lock:
+            if self._admitted >= bound:
+                raise PoolSaturated(self.retry_after())
+            depth = self._admitted
+            self._admitted += 1
+        return Ticket(self, depth)
+
+    def _release(self):
+        with self._lock:
+            self._admitted -= 1
+
+    def retry_after(self) -> int:
+        """Seconds until a queued slot is likely to free up."""
+        if not self._avg_service_s:
+            return INFERENCE_RETRY_AFTER
+        backlog = self._admitted / self.max_workers
+        return max(1, math.ceil(backlog * self._avg_service_s))
+
+    async def run(self, fn: Callable, *args, tickets: Optional[List[Ticket]] = None):
+        """Run ``fn(*args)`` on the pool.
+
+        ``tickets`` lists the requests the call is made for (a batch carries
+        several); by default it is the ticket of the calling request.
+        """
+        if tickets is None:
+            ticket = _current_ticket.get()
+            tickets = [ticket] if ticket is not None else []
+        submitted = time.perf_counter()
+
+        def call():
+            started = time.perf_counter()
+            with self._lock:
+                self._running += 1
+            for ticket in tickets:
+                ticket.wait_s += started - submitted
+            try:
+                return fn(*args)
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                    self._avg_wait_s += 0.1 * ((started - submitted) - self._avg_wait_s)
+                    self._avg_service_s += 0.1 * ((finished - started) - self._avg_service_s)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "in_flight": self._admitted,
+                "running": self._running,
+                "queue_depth": max(0, self._admitted - self._running),
+                "completed": self._completed,
+                "avg_wait_ms": round(self._avg_wait_s * 1000, 2),
+                "avg_service_ms": round(self._avg_service_s * 1000, 2),
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class ModelsNotReady(Exception):
+    """Raised when a model is needed before ``ModelRegistry`` has finished loading."""
+
+
+class ModelRegistry:
+    """Loads the MedBERT and BioGPT wrappers off the request path.
+
+    ``start()`` kicks off loading on a background thread and returns
+    immediately.  Until loading (and the optional warm-up inference) finishes,
+    ``medbert``/``biogpt`` raise ``ModelsNotReady``.  Load and warm-up times
+    are kept in ``status()`` for the readiness endpoint.
+    """
+
+    def __init__(self, package: str = MODELS_PACKAGE, warmup: bool = MODEL_WARMUP, server: Optional[str] = None):
+        self.package = package
+        self.warmup = warmup
+        self.server = MODEL_SERVER if server is None else server
+        self.client = None
+        self._medbert = None
+        self._biogpt = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._loader: Optional[threading.Thread] = None
+        self.error: Optional[str] = None
+        self.timings = {}
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    @property
+    def medbert(self):
+        if not self.ready:
+            raise ModelsNotReady("MedBERT is still loading")
+        return self._medbert
+
+    @property
+    def biogpt(self):
+        if not self.ready:
+            raise ModelsNotReady("BioGPT is still loading")
+        return self._biogpt
+
+    def start(self):
+        """Begin loading in the background (no-op if already started)."""
+        with self._lock:
+            if self._loader is None or (self.error and not self._loader.is_alive()):
+                self.error = None
+                self._loader = threading.Thread(target=self._load, name="model-loader", daemon=True)
+                self._loader.start()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def _load(self):
+        if self.server:
+            self._connect()
+            return
+        try:
+            from backends import BIOGPT_BACKEND, MEDBERT_BACKEND, apply_backend
+            from weights import MMAP_WEIGHTS, load_wrapper
+
+            started = time.perf_counter()
+            self._medbert = load_wrapper(self.package, "medbert")
+            apply_backend(self._medbert, MEDBERT_BACKEND, "medbert")
+            self.timings["medbert_load_s"] = round(time.perf_counter() - started, 3)
+
+            started = time.perf_counter()
+            self._biogpt = load_wrapper(self.package, "biogpt")
+            apply_backend(self._biogpt, BIOGPT_BACKEND, "biogpt")
+            self.timings["biogpt_load_s"] = round(time.perf_counter() - started, 3)
+            if DRAFT_MODEL:
+                started = time.perf_counter()
+                load_draft(self._biogpt)
+                self.timings["draft_load_s"] = round(time.perf_counter() - started, 3)
+            self.timings["backends"] = {"medbert": MEDBERT_BACKEND, "biogpt": BIOGPT_BACKEND}
+            self.timings["mmap_weights"] = MMAP_WEIGHTS
+
+            if self.warmup:
+                # First calls pay for lazy allocations and kernel selection
+                started = time.perf_counter()
+                self._medbert.classify_text("warm up")
+                generate_batch(self._biogpt, ["warm up"], max_new_tokens=4)
+                self.timings["warmup_s"] = round(time.perf_counter() - started, 3)
+        except Exception as e:
+            logger.exception("Model loading failed")
+            self.error = f"{type(e).__name__}: {e}"
+            return
+
+        self.timings["cold_start_s"] = round(time.time() - _process_start_time(), 3)
+        self._ready.set()
+        logger.info(f"Models ready: {self.timings}")
+
+    def _connect(self):
+        try:
+            started = time.perf_counter()
+            self._medbert, self._biogpt, self.client = connect(self.server)
+            self.timings["model_server_connect_s"] = round(time.perf_counter() - started, 3)
+        except Exception as e:
+            logger.exception("Connecting to the model server failed")
+            self.error = f"{type(e).__name__}: {e}"
+            return
+        self._ready.set()
+        logger.info(f"Using the model server at {self.server}")
+
+    def status(self) -> dict:
+        loading = not self.ready and self._loader is not None and self._loader.is_alive()
+        return {"ready": self.ready, "loading": loading, "error": self.error, **self.timings}
+
+
+def _process_start_time() -> float:
+    try:
+        import psutil
+        return psutil.Process().create_time()
+    except ImportError:
+        return time.time()
+
+
+def exposes_hf_model(wrapper) -> bool:
+    """True if the wrapper exposes the HF ``model`` and ``tokenizer`` we drive directly."""
+    return hasattr(wrapper, "model") and hasattr(wrapper, "tokenizer")
+
+
+def _pad_token_id(tokenizer) -> int:
+    if tokenizer.pad_token_id is not None:
+        return tokenizer.pad_token_id
+    return tokenizer.eos_token_id
+
+
+STOP_COMPLETE, STOP_LENGTH, STOP_DEADLINE, STOP_CANCELLED = "complete", "length", "deadline", "cancelled"
+
+
+class Budget:
+    """How far and how long one request's generation may run, and whether it was abandoned.
+
+    ``max_new_tokens`` caps the answer's length and ``deadline`` (a
+    ``time.monotonic()`` instant, or None) its wall time, counted from the
+    request's arrival so time spent queueing uses it up too.  ``cancel()``
+    stops generation at the next token, e.g. once the client disconnected.
+    One budget can cover several generations of the same request.
+    """
+
+    _ids = itertools.count()
+
+    def __init__(self, max_new_tokens: int = GENERATION_MAX_NEW_TOKENS, timeout_s: Optional[float] = None):
+        self.max_new_tokens = max(1, int(max_new_tokens))
+        self.deadline = time.monotonic() + timeout_s if timeout_s is not None else None
+        self.id = f"{os.getpid()}.{next(self._ids)}"
+        self._cancelled = threading.Event()
+        self._on_cancel: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_request(cls, max_new_tokens: Optional[int] = None, timeout_s: Optional[float] = None) -> "Budget":
+        """The server's policy, lowered (never raised) by the client's ``max_new_tokens``/``timeout_s``."""
+        if max_new_tokens is not None:
+            max_new_tokens = min(max_new_tokens, GENERATION_MAX_NEW_TOKENS)
+        timeouts = [t for t in (timeout_s, GENERATION_TIMEOUT_S) if t]
+        return cls(max_new_tokens or GENERATION_MAX_NEW_TOKENS, min(timeouts) if timeouts else None)
+
+    @property
+    def lowered(self) -> bool:
+        """True if the token budget is below the server's, so the answer can't be shared with other queries."""
+        return self.max_new_tokens < GENERATION_MAX_NEW_TOKENS
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def remaining_s(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def stop_reason(self) -> Optional[str]:
+        """Why generation must stop now regardless of length, or None to carry on."""
+        if self._cancelled.is_set():
+            return STOP_CANCELLED
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return STOP_DEADLINE
+        return None
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self._cancelled.set()
+            callbacks, self._on_cancel = self._on_cancel, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Cancellation callback failed")
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """Call ``callback`` once the budget is cancelled (right away if it already is)."""
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._on_cancel.append(callback)
+                return
+        callback()
+
+    def limits(self) -> tuple:
+        """``(max_new_tokens, remaining_s, id)``, to rebuild the budget in another process."""
+        return self.max_new_tokens, self.remaining_s(), self.id
+
+    @classmethod
+    def from_limits(cls, limits: tuple) -> "Budget":
+        max_new_tokens, remaining_s, budget_id = limits
+        budget = cls(max_new_tokens, remaining_s)
+        budget.id = budget_id
+        return budget
+
+
+class Generation(NamedTuple):
+    """A generated answer and why it stopped: complete, length, deadline or cancelled."""
+
+    text: str
+    stop_reason: str
+
+    @property
+    def partial(self) -> bool:
+        return self.stop_reason != STOP_COMPLETE
+
+
+def _eos_token_ids(wrapper) -> set:
+    eos = getattr(getattr(wrapper.model, "generation_config", None), "eos_token_id", None)
+    if eos is None:
+        eos = wrapper.tokenizer.eos_token_id
+    return set(eos) if isinstance(eos, (list, tuple)) else {eos}
+
+
+def _decoding_kwargs(wrapper) -> dict:
+    """Decoding settings for ``generate`` matching the wrapper's own ``generate_response``.
+
+    The model's ``generation_config`` applies as it does to any ``generate``
+    call; a wrapper that passes more settings lists them in
+    ``generation_kwargs`` (e.g. ``{"repetition_penalty": 1.2}``).  Token
+    limits come from the request's budget, search stays at one beam since
+    budgets stop each row on its own, and padding, streaming and stopping are
+    set by the caller.
+    """
+    kwargs = dict(getattr(wrapper, "generation_kwargs", None) or {})
+    for key in ("max_new_tokens", "max_length", "num_beams", "pad_token_id", "streamer", "stopping_criteria"):
+        kwargs.pop(key, None)
+    return {**kwargs, "num_beams": 1}
+
+
+def _budget_criteria(budgets: List[Budget], prompt_length: int, eos_token_ids: set):
+    """A ``StoppingCriteria`` ending each row at its budget; ``reasons`` says why each row stopped."""
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class BudgetCriteria(StoppingCriteria):
+        def __init__(self):
+            self.reasons: List[Optional[str]] = [None] * len(budgets)
+
+        def __call__(self, input_ids, scores, **kwargs):
+            generated = input_ids.shape[1] - prompt_length
+            for row, budget in enumerate(budgets):
+                if self.reasons[row] is not None:
+                    continue
+                if int(input_ids[row, -1]) in eos_token_ids:
+                    self.reasons[row] = STOP_COMPLETE
+                elif generated >= budget.max_new_tokens:
+                    self.reasons[row] = STOP_LENGTH
+                else:
+                    self.reasons[row] = budget.stop_reason()
+            return torch.tensor([reason is not None for reason in self.reasons], device=input_ids.device)
+
+    criteria = BudgetCriteria()
+    return criteria, StoppingCriteriaList([criteria])
+
+
+def _generate_whole(wrapper, query: str, budget: Budget) -> Generation:
+    """``generate_response`` can't be stopped part-way, so the budget is only checked before it."""
+    reason = budget.stop_reason()
+    if reason is not None:
+        return Generation("", reason)
+    return Generation(wrapper.generate_response(query), STOP_COMPLETE)
+
+
+def generate_budgeted(wrapper, queries: List[str], budgets: List[Budget]) -> List[Generation]:
+    """Generate one response per query with a single padded ``generate`` call, each within its budget.
+
+    Prompts are left-padded so every row continues from its last real token.
+    Each row stops at its own token budget, deadline or cancellation; queries
+    whose budget ran out while they were queued are not generated at all.
+    Wrappers without a ``model``/``tokenizer`` fall back to one
+    ``generate_response`` call per query.
+    """
+    results: List[Optional[Generation]] = [None] * len(queries)
+    live = []
+    for i, budget in enumerate(budgets):
+        reason = budget.stop_reason()
+        if reason is None:
+            live.append(i)
+        else:
+            results[i] = Generation("", reason)
+    if live:
+        MODEL_BATCH_SIZE.observe(len(live), model="biogpt")
+        generated = _generate_live(wrapper, [queries[i] for i in live], [budgets[i] for i in live])
+        for i, generation in zip(live, generated):
+            results[i] = generation
+    for generation in results:
+        GENERATION_STOPS.inc(model="biogpt", reason=generation.stop_reason)
+    return results
+
+
+def _generate_live(wrapper, queries: List[str], budgets: List[Budget]) -> List[Generation]:
+    if hasattr(wrapper, "generate_budgeted"):
+        return wrapper.generate_budgeted(queries, budgets)
+    if not exposes_hf_model(wrapper):
+        with model_span("biogpt", "generate"):
+            return [_generate_whole(wrapper, query, budget) for query, budget in zip(queries, budgets)]
+
+    import torch
+
+    tokenizer, model = wrapper.tokenizer, wrapper.model
+    with model_span("biogpt", "tokenize"):
+        inputs = tokenizer(queries, return_tensors="pt", padding=True, padding_side="left")
+    pad_token_id = _pad_token_id(tokenizer)
+    prompt_length = inputs["input_ids"].shape[1]
+    criteria, stopping_criteria = _budget_criteria(budgets, prompt_length, _eos_token_ids(wrapper))
+    assist = assistant_kwargs(wrapper, len(queries))
+    with model_span("biogpt", "generate"), torch.inference_mode(), counting(assist) as passes:
+        output = model.generate(
+            **inputs,
+            max_new_tokens=max(budget.max_new_tokens for budget in budgets),
+            pad_token_id=pad_token_id,
+            stopping_criteria=stopping_criteria,
+            **_decoding_kwargs(wrapper),
+            **assist,
+        )
+
+    new_tokens = output[:, prompt_length:]
+    generated = int((new_tokens != pad_token_id).sum())
+    PROMPT_TOKENS.inc(int(inputs["attention_mask"].sum()), model="biogpt")
+    GENERATED_TOKENS.inc(generated, model="biogpt")
+    record(passes, generated)
+    with model_span("biogpt", "decode"):
+        texts = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+    return [Generation(text, reason or STOP_LENGTH) for text, reason in zip(texts, criteria.reasons)]
+
+
+def generate_batch(wrapper, queries: List[str], max_new_tokens: int = GENERATION_MAX_NEW_TOKENS) -> List[str]:
+    """``generate_budgeted`` with the same token budget and no deadline for every query; just the texts."""
+    budget = Budget(max_new_tokens)
+    return [generation.text for generation in generate_budgeted(wrapper, queries, [budget] * len(queries))]
+
+
+def length_buckets(wrapper, queries: List[str], bucket_size: int = BATCH_MAX_SIZE) -> List[List[int]]:
+    """Indices of ``queries`` grouped into batches of similar prompt length.
+
+    All queries are tokenized in one call; sorting by length keeps the left
+    padding, which every row of a ``generate`` call pays for, to a minimum.
+    """
+    if hasattr(wrapper, "length_buckets"):
+        return wrapper.length_buckets(queries, bucket_size)
+    if exposes_hf_model(wrapper):
+        with model_span("biogpt", "tokenize"):
+            lengths = [len(ids) for ids in wrapper.tokenizer(queries)["input_ids"]]
+    else:
+        lengths = [len(query) for query in queries]
+    order = sorted(range(len(queries)), key=lengths.__getitem__)
+    bucket_size = max(1, bucket_size)
+    return [order[i:i + bucket_size] for i in range(0, len(order), bucket_size)]
+
+
+def classify_batch(wrapper, texts: List[str]) -> List[np.ndarray]:
+    """Class probabilities for each text from one padded MedBERT forward pass.
+
+    Each entry has the ``(1, num_labels)`` shape ``classify_text`` returns.
+    Wrappers without a ``model``/``tokenizer`` fall back to one
+    ``classify_text`` call per text.
+    """
+    if hasattr(wrapper, "classify_batch"):
+        return wrapper.classify_batch(texts)
+    if not exposes_hf_model(wrapper):
+        with model_span("medbert", "classify"):
+            return [np.asarray(wrapper.classify_text(text)) for text in texts]
+
+    import torch
+
+    with model_span("medbert", "tokenize"):
+        inputs = wrapper.tokenizer(texts, return_tensors="pt", padding=True, truncation=True)
+    with model_span("medbert", "classify"), torch.inference_mode():
+        logits = wrapper.model(**inputs).logits
+    probabilities = torch.softmax(logits.float(), dim=-1).numpy()
+    return [probabilities[i:i + 1] for i in range(len(texts))]
+
+
+def embed_query(wrapper, query: str) -> Optional[np.ndarray]:
+    """Mean-pooled last hidden state of the wrapper's encoder for ``query``.
+
+    Runs only the base encoder, not the classification head.  Returns None
+    when the wrapper does not expose its HF model.
+    """
+    if hasattr(wrapper, "embed"):
+        return wrapper.embed(query)
+    if not exposes_hf_model(wrapper):
+        return None
+
+    import torch
+
+    with model_span("medbert", "tokenize"):
+        inputs = wrapper.tokenizer(query, return_tensors="pt", truncation=True)
+    with model_span("medbert", "embed"), torch.inference_mode():
+        hidden = wrapper.model.base_model(**inputs)[0]
+    return _mean_pool(hidden, inputs["attention_mask"])
+
+
+def classify_and_embed(wrapper, query: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """``classify_text`` and ``embed_query`` for ``query`` from one MedBERT forward pass.
+
+    The embedding is pooled from the last hidden state the classifier
+    computes anyway.  Wrappers without a ``model``/``tokenizer`` classify
+    with ``classify_text`` and return no embedding.
+    """
+    if hasattr(wrapper, "classify_and_embed"):
+        return wrapper.classify_and_embed(query)
+    if not exposes_hf_model(wrapper):
+        with model_span("medbert", "classify"):
+            return np.asarray(wrapper.classify_text(query)), None
+
+    import torch
+
+    with model_span("medbert", "tokenize"):
+        inputs = wrapper.tokenizer(query, return_tensors="pt", truncation=True)
+    with model_span("medbert", "classify"), torch.inference_mode():
+        output = wrapper.model(**inputs, output_hidden_states=True)
+    probabilities = torch.softmax(output.logits.float(), dim=-1).numpy()
+    return probabilities, _mean_pool(output.hidden_states[-1], inputs["attention_mask"])
+
+
+def _mean_pool(hidden, attention_mask) -> np.ndarray:
+    mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+    pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+    return pooled[0].float().numpy()
+
+
+def _callback_streamer(tokenizer, on_text: Callable[[str], None]):
+    """``TextStreamer`` that hands each decoded piece to ``on_text`` instead of stdout."""
+    from transformers import TextStreamer
+
+    class CallbackStreamer(TextStreamer):
+        def on_finalized_text(self, text: str, stream_end: bool = False):
+            if text:
+                on_text(text)
+
+    return CallbackStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+
+def generate_stream(
+    wrapper,
+    query: str,
+    on_text: Callable[[str], None],
+    max_new_tokens: int = GENERATION_MAX_NEW_TOKENS,
+    budget: Optional[Budget] = None,
+) -> Generation:
+    """Generate a response for ``query``, passing text to ``on_text`` as it is decoded.
+
+    Returns the full response and why it stopped.  ``budget`` (default:
+    ``max_new_tokens`` and no deadline) can stop it early.  Wrappers without
+    a ``model``/``tokenizer`` produce the whole response in one piece.
+    """
+    budget = budget or Budget(max_new_tokens)
+    generation = _stream(wrapper, query, on_text, budget)
+    GENERATION_STOPS.inc(model="biogpt", reason=generation.stop_reason)
+    return generation
+
+
+def _stream(wrapper, query: str, on_text: Callable[[str], None], budget: Budget) -> Generation:
+    if hasattr(wrapper, "generate_stream"):
+        return wrapper.generate_stream(query, on_text, budget)
+    if not exposes_hf_model(wrapper):
+        with model_span("biogpt", "generate"):
+            generation = _generate_whole(wrapper, query, budget)
+        if generation.text:
+            on_text(generation.text)
+        return generation
+    reason = budget.stop_reason()
+    if reason is not None:
+        return Generation("", reason)
+
+    import torch
+
+    pieces = []
+
+    def collect(text: str):
+        pieces.append(text)
+        on_text(text)
+
+    tokenizer, model = wrapper.tokenizer, wrapper.model
+    with model_span("biogpt", "tokenize"):
+        inputs = tokenizer(query, return_tensors="pt")
+    prompt_length = inputs["input_ids"].shape[1]
+    criteria, stopping_criteria = _budget_criteria([budget], prompt_length, _eos_token_ids(wrapper))
+    assist = assistant_kwargs(wrapper, 1)
+    with model_span("biogpt", "generate"), torch.inference_mode(), counting(assist) as passes:
+        output = model.generate(
+            **inputs,
+            max_new_tokens=budget.max_new_tokens,
+            pad_token_id=_pad_token_id(tokenizer),
+            streamer=_callback_streamer(tokenizer, collect),
+            stopping_criteria=stopping_criteria,
+            **_decoding_kwargs(wrapper),
+            **assist,
+        )
+    PROMPT_TOKENS.inc(prompt_length, model="biogpt")
+    GENERATED_TOKENS.inc(output.shape[1] - prompt_length, model="biogpt")
+    record(passes, output.shape[1] - prompt_length)
+    return Generation("".join(pieces), criteria.reasons[0] or STOP_LENGTH)
+
+
+class MicroBatcher:
+    """Collects concurrent requests and runs them through ``fn`` as one batch.
+
+    ``fn`` takes a list of items and returns a list of results in the same
+    order.  A batch is dispatched once ``max_batch_size`` items are waiting or
+    ``max_wait_ms`` has passed since the first item arrived, whichever comes
+    first.  Batches run on ``pool`` so the event loop stays free while the
+    model is busy, up to ``max_in_flight`` at once (one per pool worker by
+    default); while they are all running the next batch keeps filling.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[list], list],
+        pool: InferencePool,
+        max_batch_size: int = BATCH_MAX_SIZE,
+        max_wait_ms: float = BATCH_MAX_WAIT_MS,
+        max_in_flight: Optional[int] = None,
+    ):
+        self._fn = fn
+        self._pool = pool
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.max_in_flight = max(1, pool.max_workers if max_in_flight is None else max_in_flight)
+        self._queue: Optional[asyncio.Queue] = None
+        self._in_flight: Optional[asyncio.Semaphore] = None
+        self._batches: set = set()
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, item):
+        """Queue ``item`` for the next batch and wait for its result."""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future, _current_ticket.get()))
+        return await future
+
+    def _ensure_worker(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        if self._worker is None or self._worker.done():
+            # A fresh context so the worker does not inherit the ticket of the
+            # request that happened to start it.
+            self._worker = asyncio.get_running_loop().create_task(self._run(), context=contextvars.Context())
+
+    async def _collect(self) -> List[Tuple[object, asyncio.Future, Optional[Ticket]]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Callers that gave up while waiting don't need a result.
+        return [entry for entry in batch if not entry[1].done()]
+
+    async def _run(self):
+        while True:
+            # Wait for a free worker before collecting, so items arriving meanwhile join the next batch
+            await self._in_flight.acquire()
+            batch = await self._collect()
+            if not batch:
+                self._in_flight.release()
+                continue
+            task = asyncio.get_running_loop().create_task(self._dispatch(batch))
+            self._batches.add(task)  # keep a reference until it finishes
+            task.add_done_callback(self._batches.discard)
+
+    async def _dispatch(self, batch: List[Tuple[object, asyncio.Future, Optional[Ticket]]]):
+        try:
+            items = [item for item, _, _ in batch]
+            tickets = [ticket for _, _, ticket in batch if ticket is not None]
+            try:
+                results = await self._pool.run(self._fn, items, tickets=tickets)
+            except Exception as e:
+                logger.exception(f"Batch of {len(items)} failed")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._in_flight.release()
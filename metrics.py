@@ -0,0 +1,280 @@
+"""Prometheus metrics and per-request timing spans for the HealthBot API.
+
+A small in-process registry rendered in the Prometheus text format (0.0.4)
+by the /metrics route, so no client library is needed:
+
+* ``Counter`` and ``Histogram`` are updated on the request path; each
+  update is a dict lookup and a few additions under a lock.
+* ``CallbackGauge`` reads its value(s) from a function at scrape time, for
+  numbers other components already track (queue depth, cache hits, RSS).
+
+``span(stage)`` times one stage of the current request into
+``healthbot_request_stage_seconds{route,stage}`` and remembers it for the
+``Server-Timing`` response header.  ``MetricsMiddleware`` sets up the
+request scope and records ``healthbot_request_seconds``.  Work that runs on
+the worker pools is shared across requests (batches) and is timed with
+``model_stage_seconds{model,stage}`` instead.
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+METRICS_SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "1") == "1"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_request: contextvars.ContextVar = contextvars.ContextVar("metrics_request", default=None)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in values]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, list] = {}  # key -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        lines = self.header()
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values[:-1]):
+                cumulative += count
+                le = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(values[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackGauge(_Metric):
+    """Value(s) read at scrape time.
+
+    ``fn`` returns a number, or a dict from label-value tuples to numbers.
+    ``kind`` may be set to "counter" for monotonically increasing values
+    that another component already counts.
+    """
+
+    def __init__(self, name: str, documentation: str, fn: Callable, labelnames: Tuple[str, ...] = (),
+                 kind: str = "gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        value = self.fn()
+        if value is None:
+            return []
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric  # re-registering replaces, e.g. after a reload
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "healthbot_request_seconds", "HTTP request latency until the response headers are sent.",
+    ("route", "method", "status")))
+REQUEST_STAGE_SECONDS = REGISTRY.register(Histogram(
+    "healthbot_request_stage_seconds", "Time spent in each stage of a request.", ("route", "stage")))
+MODEL_STAGE_SECONDS = REGISTRY.register(Histogram(
+    "model_stage_seconds", "Time spent in each stage of a model call (per call, batches included).",
+    ("model", "stage")))
+MODEL_BATCH_SIZE = REGISTRY.register(Histogram(
+    "model_batch_size", "Queries per generation call.", ("model",), buckets=(1, 2, 4, 8, 16, 32, 64)))
+GENERATED_TOKENS = REGISTRY.register(Counter(
+    "model_generated_tokens_total", "Tokens generated by the language model.", ("model",)))
+PROMPT_TOKENS = REGISTRY.register(Counter(
+    "model_prompt_tokens_total", "Prompt tokens fed to the language model.", ("model",)))
+GENERATION_STOPS = REGISTRY.register(Counter(
+    "model_generation_stops_total", "Generations by why they stopped: complete, length, deadline or cancelled.",
+    ("model", "reason")))
+SCHEDULER_QUEUE_WAIT = REGISTRY.register(Histogram(
+    "scheduler_queue_wait_seconds", "Time an inference request waited for a slot and a worker, by priority class.",
+    ("priority",)))
+SCHEDULER_REJECTIONS = REGISTRY.register(Counter(
+    "scheduler_rejections_total", "Inference requests refused, by priority class and reason (rate_limited, over_burst, queue_full).",
+    ("priority", "reason")))
+DRAFT_TOKENS = REGISTRY.register(Counter(
+    "model_draft_tokens_total", "Draft-model tokens proposed in speculative decoding, accepted or rejected.",
+    ("model", "outcome")))
+
+
+class _RequestState:
+    __slots__ = ("scope", "spans")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.spans: List[Tuple[str, float]] = []
+
+    @property
+    def route(self) -> str:
+        # Routing stores the matched route in the scope; templates keep label cardinality bounded
+        return getattr(self.scope.get("route"), "path", "unmatched")
+
+
+@contextmanager
+def span(stage: str):
+    """Time ``stage`` of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - started)
+
+
+def record_span(stage: str, seconds: float):
+    state = _request.get()
+    route = state.route if state is not None else "background"
+    REQUEST_STAGE_SECONDS.observe(seconds, route=route, stage=stage)
+    if state is not None:
+        state.spans.append((stage, seconds))
+
+
+@contextmanager
+def model_span(model: str, stage: str):
+    """Time ``stage`` of a model call on a worker thread."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        MODEL_STAGE_SECONDS.observe(time.perf_counter() - started, model=model, stage=stage)
+
+
+def _server_timing(spans: List[Tuple[str, float]], total: float) -> bytes:
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in spans]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries).encode("latin-1")
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by its route template.
+
+    Pure ASGI rather than ``BaseHTTPMiddleware`` so streaming responses pass
+    straight through and the per-request cost stays a few microseconds.
+    """
+
+    def __init__(self, app, server_timing: bool = METRICS_SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        state = _RequestState(scope)
+        token = _request.set(state)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", _server_timing(state.spans, time.perf_counter() - started)))
+                    message = {**message, "headers": headers}
+                REQUEST_SECONDS.observe(time.perf_counter() - started, route=state.route,
+                                        method=scope["method"], status=status)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request.reset(token)
@@ -0,0 +1,492 @@
+"""Out-of-process model server shared by the API workers on one host.
+
+With ``uvicorn --workers N`` every worker loads its own MedBERT and BioGPT.
+Instead, one model server process (or a few) can own the models and serve
+them over Unix sockets (``multiprocessing.connection``):
+
+    python model_server.py --socket /run/healthbot/models.sock
+    MODEL_SERVER=/run/healthbot/models.sock uvicorn app:app --workers 8
+
+With ``MODEL_SERVER`` set, ``ModelRegistry`` connects instead of loading and
+hands out ``RemoteMedBERT``/``RemoteBioGPT``.  They implement the wrapper
+interface (``classify_text``/``generate_response``) plus the batched and
+streaming entry points the helpers in ``inference`` and ``sessions`` look for,
+so micro-batching, /healthbot/batch and streaming keep working; conversation
+sessions and their KV caches live in the server.  Chat records are then
+committed before each response (``CHAT_WRITE_BEHIND`` defaults to 0), so a
+history read on any worker sees them.
+
+``--processes N`` starts N servers (``<socket>.0`` ... ``<socket>.N-1``);
+list them all in ``MODEL_SERVER`` (comma-separated).  Calls go to the server
+with the fewest calls in flight; a session's turns always go to the same one.
+
+Each message is a pickled tuple, so only authenticated clients are served:
+every connection must pass the multiprocessing HMAC handshake, within
+``MODEL_SERVER_HANDSHAKE_TIMEOUT`` seconds and on its own thread, so a
+client that connects and stalls holds up no one else.  Set
+``MODEL_SERVER_AUTHKEY`` on both sides, or leave it unset and each server
+generates a key at start and writes it to ``<socket>.key``, where clients
+read it.  The socket and the key file are created owner and group only
+(mode 0660 and 0640), and a server handles at most
+``MODEL_SERVER_MAX_CONNECTIONS`` connections at once; it closes the ones
+beyond that.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import secrets
+import socket
+import struct
+import threading
+import time
+import weakref
+import zlib
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener, answer_challenge, deliver_challenge
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from metrics import model_span
+from speculative import speculation_stats
+
+logger = logging.getLogger(__name__)
+
+MODEL_SERVER = os.getenv("MODEL_SERVER", "")  # comma-separated socket paths; empty loads models in-process
+MODEL_SERVER_AUTHKEY = os.getenv("MODEL_SERVER_AUTHKEY", "").encode() or None  # unset: generated, in <socket>.key
+MODEL_SERVER_CONNECT_TIMEOUT = float(os.getenv("MODEL_SERVER_CONNECT_TIMEOUT", "120"))
+MODEL_SERVER_MAX_CONNECTIONS = int(os.getenv("MODEL_SERVER_MAX_CONNECTIONS", "256"))
+MODEL_SERVER_HANDSHAKE_TIMEOUT = float(os.getenv("MODEL_SERVER_HANDSHAKE_TIMEOUT", "5"))
+
+
+class ModelServerError(Exception):
+    """A model call failed in the server, or the server could not be reached."""
+
+
+def key_path(address: str) -> str:
+    return f"{address}.key"
+
+
+def write_authkey(address: str) -> bytes:
+    """Generate a key for the server on ``address`` and store it in ``<address>.key`` (mode 0640)."""
+    authkey = secrets.token_hex(32).encode()
+    path = key_path(address)
+    if os.path.exists(f"{path}.tmp"):
+        os.remove(f"{path}.tmp")  # left over, and its mode is not ours to trust
+    previous = os.umask(0o137)
+    try:
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(authkey)
+    finally:
+        os.umask(previous)
+    os.replace(f"{path}.tmp", path)
+    return authkey
+
+
+def read_authkey(address: str) -> bytes:
+    """The key the server on ``address`` generated, read again on every connect since restarts change it."""
+    try:
+        with open(key_path(address), "rb") as f:
+            return f.read().strip()
+    except OSError as e:
+        raise ModelServerError(f"No authkey for model server {address}: set MODEL_SERVER_AUTHKEY or "
+                               f"make {key_path(address)} readable ({e})") from e
+
+
+# -- server -------------------------------------------------------------------
+
+def _set_timeout(conn: Connection, seconds: float):
+    """Send and receive timeout on the connection's socket; 0 blocks for good."""
+    sock = socket.socket(fileno=conn.fileno())
+    try:
+        value = struct.pack("ll", int(seconds), int(seconds % 1 * 1_000_000))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, value)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+    finally:
+        sock.detach()  # the fd stays the connection's
+
+
+class ModelServer:
+    """Serves the models of a loaded ``ModelRegistry`` on one socket, a thread per connection.
+
+    Without an ``authkey`` one is generated for the clients in ``<address>.key``.
+    """
+
+    def __init__(self, address: str, models, authkey: Optional[bytes] = MODEL_SERVER_AUTHKEY,
+                 max_connections: int = MODEL_SERVER_MAX_CONNECTIONS,
+                 handshake_timeout: float = MODEL_SERVER_HANDSHAKE_TIMEOUT):
+        from sessions import SessionStore
+
+        self.address = address
+        self.models = models
+        self.authkey = authkey
+        self.max_connections = max(1, max_connections)
+        self.handshake_timeout = handshake_timeout
+        self.sessions = SessionStore()
+        self.budgets: "weakref.WeakValueDictionary[str, object]" = weakref.WeakValueDictionary()
+        self.connections = 0
+        self.refused = 0
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def handlers(self) -> dict:
+        from inference import (classify_and_embed, classify_batch, embed_query, generate_budgeted, generate_stream,
+                               length_buckets)
+
+        medbert, biogpt = self.models.medbert, self.models.biogpt
+        return {
+            "ping": lambda: True,
+            "stats": self.stats,
+            "cancel": self.cancel,
+            "classify_text": lambda text: np.asarray(medbert.classify_text(text)),
+            "classify_batch": lambda texts: classify_batch(medbert, texts),
+            "embed": lambda query: embed_query(medbert, query),
+            "classify_and_embed": lambda query: classify_and_embed(medbert, query),
+            "generate_response": lambda query: biogpt.generate_response(query),
+            "generate_budgeted": lambda queries, limits: generate_budgeted(biogpt, queries, self._budgets(limits)),
+            "length_buckets": lambda queries, size: length_buckets(biogpt, queries, size),
+            "generate_stream": lambda query, limits, on_text: generate_stream(
+                biogpt, query, on_text, budget=self._budgets([limits])[0]),
+            "generate_turn": lambda key, query, limits, on_text: self.sessions.generate_turn(
+                biogpt, self.sessions.get(*key), query, on_text, budget=self._budgets([limits])[0]),
+            "session_started": lambda key: self.sessions.started(biogpt, *key),
+            "seed_turn": lambda key, query, response: self.sessions.seed(biogpt, *key, query, response),
+        }
+
+    def _budgets(self, limits: list) -> list:
+        """Rebuild the callers' budgets, one per id, where ``cancel`` can find them while they run."""
+        from inference import Budget
+
+        budgets = {}
+        for entry in limits:
+            budget_id = entry[2]
+            if budget_id not in budgets:
+                budgets[budget_id] = Budget.from_limits(entry)
+                self.budgets[budget_id] = budgets[budget_id]
+        return [budgets[entry[2]] for entry in limits]
+
+    def cancel(self, budget_id: str) -> bool:
+        budget = self.budgets.get(budget_id)
+        if budget is None:
+            return False
+        budget.cancel()
+        return True
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)  # left over from a previous run
+        handlers = self.handlers()
+        authkey = self.authkey or write_authkey(self.address)
+        # The socket is created with its final mode, so there is no moment it is open to everyone
+        previous = os.umask(0o117)
+        try:
+            # No authkey here: accept() would run the handshake on this thread, where one
+            # stalled client holds up every other; each connection's thread runs its own
+            listener = Listener(self.address, family="AF_UNIX")
+        finally:
+            os.umask(previous)
+        with listener:
+            logger.info(f"Model server listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except OSError:
+                    logger.exception("Could not accept a model server connection")
+                    continue
+                with self._lock:
+                    full = self.connections >= self.max_connections
+                    if full:
+                        self.refused += 1
+                    else:
+                        self.connections += 1
+                if full:
+                    logger.warning(f"Refused a model server connection, {self.max_connections} already open")
+                    conn.close()
+                    continue
+                threading.Thread(target=self._serve, args=(conn, handlers, authkey), daemon=True).start()
+
+    def _serve(self, conn: Connection, handlers: dict, authkey: bytes):
+        try:
+            try:
+                _set_timeout(conn, self.handshake_timeout)
+                deliver_challenge(conn, authkey)
+                answer_challenge(conn, authkey)
+                _set_timeout(conn, 0)
+            except (AuthenticationError, EOFError, OSError) as e:
+                logger.warning(f"Rejected a model server connection: {type(e).__name__}: {e}")
+                return
+            while True:
+                try:
+                    method, args, streaming = conn.recv()
+                except (EOFError, OSError):
+                    return
+                with self._lock:
+                    self.calls += 1
+                try:
+                    handler = handlers[method]
+                    if streaming:
+                        result = handler(*args, lambda text: conn.send(("text", text)))
+                    else:
+                        result = handler(*args)
+                    conn.send(("ok", result))
+                except Exception as e:
+                    with self._lock:
+                        self.errors += 1
+                    logger.exception(f"Model server call {method} failed")
+                    try:
+                        conn.send(("error", f"{type(e).__name__}: {e}"))
+                    except OSError:
+                        return  # the client went away mid-call
+        finally:
+            conn.close()
+            with self._lock:
+                self.connections -= 1
+
+    def stats(self) -> dict:
+        try:
+            import psutil
+            rss = psutil.Process().memory_info().rss
+        except ImportError:
+            rss = None
+        return {
+            "address": self.address,
+            "pid": os.getpid(),
+            "rss_bytes": rss,
+            "connections": self.connections,
+            "max_connections": self.max_connections,
+            "refused_connections": self.refused,
+            "calls": self.calls,
+            "errors": self.errors,
+            "sessions": self.sessions.stats(),
+            "speculative": speculation_stats.stats(),
+        }
+
+
+def serve(address: str):
+    """Load the models in this process and serve them on ``address`` (blocks)."""
+    from inference import ModelRegistry
+
+    logging.basicConfig(level=logging.INFO)
+    models = ModelRegistry(server="")
+    models.start()
+    models.wait()
+    if models.error:
+        raise SystemExit(f"Model loading failed: {models.error}")
+    ModelServer(address, models).serve_forever()
+
+
+# -- client -------------------------------------------------------------------
+
+class _Endpoint:
+    def __init__(self, address: str, authkey: Optional[bytes]):
+        self.address = address
+        self.authkey = authkey
+        self.in_flight = 0
+        self._idle: "queue.LifoQueue[Connection]" = queue.LifoQueue()
+
+    def connect(self) -> Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return Client(self.address, family="AF_UNIX", authkey=self.authkey or read_authkey(self.address))
+        except AuthenticationError as e:
+            raise ModelServerError(f"Model server {self.address} refused the authkey: {e}") from e
+
+    def release(self, conn: Connection):
+        self._idle.put(conn)
+
+
+class ModelServerClient:
+    """Blocking calls to one or more model servers; safe to share between threads.
+
+    Each calling thread takes its own connection from a per-server idle pool.
+    """
+
+    def __init__(self, addresses: Sequence[str], authkey: Optional[bytes] = MODEL_SERVER_AUTHKEY):
+        if not addresses:
+            raise ValueError("No model server addresses")
+        self.endpoints = [_Endpoint(address, authkey) for address in addresses]
+        self._lock = threading.Lock()
+
+    def _pick(self, affinity: Optional[tuple]) -> _Endpoint:
+        if affinity is not None:
+            return self.endpoints[zlib.crc32(repr(affinity).encode()) % len(self.endpoints)]
+        with self._lock:
+            return min(self.endpoints, key=lambda endpoint: endpoint.in_flight)
+
+    def call(self, method: str, *args, on_text: Optional[Callable[[str], None]] = None,
+             affinity: Optional[tuple] = None):
+        endpoint = self._pick(affinity)
+        with self._lock:
+            endpoint.in_flight += 1
+        conn = None
+        try:
+            conn = endpoint.connect()
+            conn.send((method, args, on_text is not None))
+            while True:
+                kind, payload = conn.recv()
+                if kind == "text":
+                    on_text(payload)
+                    continue
+                endpoint.release(conn)
+                conn = None
+                if kind == "error":
+                    raise ModelServerError(payload)
+                return payload
+        except (OSError, EOFError) as e:
+            raise ModelServerError(f"Model server {endpoint.address} unreachable: {e}") from e
+        finally:
+            if conn is not None:
+                conn.close()  # mid-call failure: the stream position is unknown
+            with self._lock:
+                endpoint.in_flight -= 1
+
+    def _call_endpoint(self, endpoint: _Endpoint, method: str, *args):
+        try:
+            conn = endpoint.connect()
+            conn.send((method, args, False))
+            kind, payload = conn.recv()
+        except (OSError, EOFError) as e:
+            raise ModelServerError(f"Model server {endpoint.address} unreachable: {e}") from e
+        endpoint.release(conn)
+        if kind == "error":
+            raise ModelServerError(payload)
+        return payload
+
+    def wait_ready(self, timeout: float = MODEL_SERVER_CONNECT_TIMEOUT):
+        """Block until every server answers (the server only listens once its models are loaded)."""
+        deadline = time.monotonic() + timeout
+        for endpoint in self.endpoints:
+            while True:
+                try:
+                    self._call_endpoint(endpoint, "ping")
+                    break
+                except ModelServerError:
+                    if time.monotonic() > deadline:
+                        raise ModelServerError(f"Model server {endpoint.address} did not come up in {timeout:g}s")
+                    time.sleep(0.5)
+
+    def broadcast(self, method: str, *args):
+        """Call ``method`` on every server, ignoring the ones that can't be reached."""
+        for endpoint in self.endpoints:
+            try:
+                self._call_endpoint(endpoint, method, *args)
+            except ModelServerError as e:
+                logger.warning(f"{method} on {endpoint.address} failed: {e}")
+
+    def stats(self) -> List[dict]:
+        stats = []
+        for endpoint in self.endpoints:
+            try:
+                stats.append({**self._call_endpoint(endpoint, "stats"), "in_flight": endpoint.in_flight})
+            except ModelServerError as e:
+                stats.append({"address": endpoint.address, "error": str(e)})
+        return stats
+
+
+class RemoteMedBERT:
+    """MedBERT wrapper whose calls run in the model server."""
+
+    def __init__(self, client: ModelServerClient):
+        self.client = client
+
+    def classify_text(self, text: str) -> np.ndarray:
+        with model_span("medbert", "remote_classify"):
+            return self.client.call("classify_text", text)
+
+    def classify_batch(self, texts: List[str]) -> List[np.ndarray]:
+        with model_span("medbert", "remote_classify"):
+            return self.client.call("classify_batch", texts)
+
+    def embed(self, query: str) -> Optional[np.ndarray]:
+        with model_span("medbert", "remote_embed"):
+            return self.client.call("embed", query)
+
+    def classify_and_embed(self, query: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        with model_span("medbert", "remote_classify"):
+            return self.client.call("classify_and_embed", query)
+
+
+class RemoteBioGPT:
+    """BioGPT wrapper whose calls run in the model server.
+
+    Budgets travel as their limits; cancelling one locally cancels its
+    generation in the server too.
+    """
+
+    def __init__(self, client: ModelServerClient):
+        self.client = client
+        self._watched: "weakref.WeakSet" = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def _limits(self, budget) -> tuple:
+        with self._lock:
+            watch = budget not in self._watched
+            self._watched.add(budget)
+        if watch:
+            budget.on_cancel(lambda: self.client.broadcast("cancel", budget.id))
+        return budget.limits()
+
+    def generate_response(self, query: str) -> str:
+        with model_span("biogpt", "remote_generate"):
+            return self.client.call("generate_response", query)
+
+    def generate_budgeted(self, queries: List[str], budgets: list) -> list:
+        with model_span("biogpt", "remote_generate"):
+            return self.client.call("generate_budgeted", queries, [self._limits(budget) for budget in budgets])
+
+    def length_buckets(self, queries: List[str], bucket_size: int) -> List[List[int]]:
+        return self.client.call("length_buckets", queries, bucket_size)
+
+    def generate_stream(self, query: str, on_text: Callable[[str], None], budget):
+        with model_span("biogpt", "remote_generate"):
+            return self.client.call("generate_stream", query, self._limits(budget), on_text=on_text)
+
+    def session_started(self, key: tuple) -> bool:
+        return self.client.call("session_started", key, affinity=key)
+
+    def seed_turn(self, key: tuple, query: str, response: str):
+        self.client.call("seed_turn", key, query, response, affinity=key)
+
+    def generate_turn(self, key: tuple, query: str, on_text: Optional[Callable[[str], None]], budget):
+        # The session's KV cache lives in the server, so its turns stick to one server
+        with model_span("biogpt", "remote_session_generate"):
+            if on_text is None:
+                return self.client.call("generate_turn", key, query, self._limits(budget), None, affinity=key)
+            return self.client.call("generate_turn", key, query, self._limits(budget), on_text=on_text,
+                                    affinity=key)
+
+
+def connect(addresses: str = MODEL_SERVER):
+    """``(RemoteMedBERT, RemoteBioGPT, client)`` for the comma-separated ``addresses``; waits for the servers."""
+    client = ModelServerClient([a.strip() for a in addresses.split(",") if a.strip()])
+    client.wait_ready()
+    return RemoteMedBERT(client), RemoteBioGPT(client), client
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve MedBERT and BioGPT to the API workers over Unix sockets.")
+    parser.add_argument("--socket", default=MODEL_SERVER or "healthbot-models.sock")
+    parser.add_argument("--processes", type=int, default=1, help="servers to start, each with its own models")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        serve(args.socket)
+        return
+    addresses = [f"{args.socket}.{i}" for i in range(args.processes)]
+    processes = [multiprocessing.Process(target=serve, args=(address,), name=f"model-server-{i}")
+                 for i, address in enumerate(addresses)]
+    for process in processes:
+        process.start()
+    print(f"MODEL_SERVER={','.join(addresses)}", flush=True)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""On-demand profiling of the model calls behind /healthbot.
+
+Off unless ``PROFILE_ADMIN_TOKEN`` is set.  A request is profiled when
+
+* it carries ``X-Profile: <admin token>`` (it then bypasses the response
+  and semantic caches so the models actually run), or
+* it is sampled: ``PROFILE_SAMPLE_RATE`` (changeable at runtime through
+  ``POST /admin/profiling``) is the fraction of requests whose model calls
+  are profiled when they miss the caches.
+
+``Profiler.capture`` runs a model call on the worker thread under cProfile
+and, if ``PROFILE_TORCH`` is on, the torch profiler.  Each capture writes
+``<id>-<label>.prof`` (pstats) and ``<id>-<label>.trace.json`` (Chrome trace)
+under ``PROFILE_DIR``; only the newest ``PROFILE_MAX_DUMPS`` captures are
+kept.  One capture runs at a time; calls arriving meanwhile run unprofiled.
+
+Summarize the hottest frames across the dumps:
+    python profiling.py summarize --top 30
+    python profiling.py summarize --sort tottime --label generate
+"""
+import argparse
+import cProfile
+import glob
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")  # unset disables profiling
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_DUMPS = int(os.getenv("PROFILE_MAX_DUMPS", "50"))
+PROFILE_TORCH = os.getenv("PROFILE_TORCH", "1") == "1"
+
+
+class Profiler:
+    def __init__(
+        self,
+        admin_token: Optional[str] = PROFILE_ADMIN_TOKEN,
+        sample_rate: float = PROFILE_SAMPLE_RATE,
+        directory: str = PROFILE_DIR,
+        max_dumps: int = PROFILE_MAX_DUMPS,
+        torch_profiler: bool = PROFILE_TORCH,
+    ):
+        self.admin_token = admin_token or None
+        self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        self.directory = directory
+        self.max_dumps = max(1, max_dumps)
+        self.torch_profiler = torch_profiler
+        self._lock = threading.Lock()
+        self.captures = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.admin_token is not None
+
+    def is_admin(self, token: Optional[str]) -> bool:
+        return self.enabled and token is not None and hmac.compare_digest(token, self.admin_token)
+
+    def sampled(self) -> bool:
+        return self.enabled and self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def new_id(self) -> str:
+        return f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+    def capture(self, profile_id: str, label: str, fn: Callable, *args):
+        """Run ``fn(*args)`` under the profilers and write the dumps.  Blocking."""
+        if not self._lock.acquire(blocking=False):
+            self.skipped += 1
+            return fn(*args)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory, f"{profile_id}-{label}")
+            torch_prof = self._torch_profile()
+            profile = cProfile.Profile()
+            if torch_prof is not None:
+                torch_prof.__enter__()
+            profile.enable()
+            try:
+                return fn(*args)
+            finally:
+                profile.disable()
+                profile.dump_stats(base + ".prof")
+                if torch_prof is not None:
+                    torch_prof.__exit__(None, None, None)
+                    torch_prof.export_chrome_trace(base + ".trace.json")
+                self.captures += 1
+                self._rotate()
+                logger.info(f"Profiled {label} into {base}.*")
+        finally:
+            self._lock.release()
+
+    def _torch_profile(self):
+        if not self.torch_profiler:
+            return None
+        try:
+            from torch.profiler import ProfilerActivity, profile
+        except ImportError:
+            return None
+        return profile(activities=[ProfilerActivity.CPU], record_shapes=True)
+
+    def dumps(self) -> List[str]:
+        """Capture base paths (without extension), newest first."""
+        paths = glob.glob(os.path.join(self.directory, "*.prof"))
+        paths.sort(key=os.path.getmtime, reverse=True)
+        return [p[: -len(".prof")] for p in paths]
+
+    def _rotate(self):
+        for base in self.dumps()[self.max_dumps:]:
+            for suffix in (".prof", ".trace.json"):
+                try:
+                    os.remove(base + suffix)
+                except FileNotFoundError:
+                    pass
+
+    def status(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "directory": self.directory,
+            "torch_profiler": self.torch_profiler,
+            "captures": self.captures,
+            "skipped_busy": self.skipped,
+            "dumps": [os.path.basename(b) for b in self.dumps()[:20]],
+        }
+
+
+# -- summarize CLI ------------------------------------------------------------
+
+def summarize_cprofile(paths: List[str], sort: str, top: int) -> str:
+    stats = pstats.Stats(paths[0], stream=io.StringIO())
+    for path in paths[1:]:
+        stats.add(path)
+    out = io.StringIO()
+    stats.stream = out
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+    return out.getvalue()
+
+
+def summarize_torch(paths: List[str], top: int) -> str:
+    totals, counts = defaultdict(float), defaultdict(int)
+    for path in paths:
+        with open(path) as f:
+            events = json.load(f).get("traceEvents", [])
+        for event in events:
+            if event.get("ph") == "X" and event.get("cat") == "cpu_op":
+                totals[event["name"]] += event.get("dur", 0)
+                counts[event["name"]] += 1
+    lines = [f"{'total ms':>10} {'calls':>8}  op"]
+    for name, us in sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]:
+        lines.append(f"{us / 1000:>10.2f} {counts[name]:>8}  {name}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize profiling dumps.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    summarize = sub.add_parser("summarize", help="hottest frames across dumps")
+    summarize.add_argument("--dir", default=PROFILE_DIR)
+    summarize.add_argument("--label", help="only dumps of this call, e.g. generate or classify")
+    summarize.add_argument("--sort", default="cumulative", choices=("cumulative", "tottime", "ncalls"))
+    summarize.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+
+    pattern = f"*-{args.label}" if args.label else "*"
+    profiles = sorted(glob.glob(os.path.join(args.dir, pattern + ".prof")))
+    traces = sorted(glob.glob(os.path.join(args.dir, pattern + ".trace.json")))
+    if not profiles:
+        parser.exit(1, f"No dumps in {args.dir}\n")
+
+    print(f"== cProfile: {len(profiles)} dumps, sorted by {args.sort} ==")
+    print(summarize_cprofile(profiles, args.sort, args.top))
+    if traces:
+        print(f"== torch profiler: {len(traces)} traces, CPU ops by total time ==")
+        print(summarize_torch(traces, args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Retention policy for chat_history.
+
+``RetentionJob`` runs in the background every ``RETENTION_INTERVAL`` seconds
+and removes rows older than ``RETENTION_DAYS`` (0 keeps everything):
+
+1. Expired rows are read oldest-first, ``RETENTION_CHUNK`` at a time.
+2. Each chunk is appended to a gzip-compressed NDJSON archive under
+   ``RETENTION_ARCHIVE_DIR`` (one file per run) and synced to disk.
+3. Only then is the chunk deleted, in its own short write transaction, so
+   the write lock is never held for more than one chunk.
+4. Freed pages go back to the filesystem with ``PRAGMA incremental_vacuum``,
+   ``RETENTION_VACUUM_PAGES`` at a time.
+
+A crash between steps 2 and 3 archives that chunk again on the next run;
+rows are never deleted before they are archived.
+
+Step 4 needs the database in auto_vacuum=INCREMENTAL mode.  A new database
+starts in it; an existing one is switched once by rebuilding the file, which
+holds an exclusive lock for the whole rebuild, so it is a maintenance step
+rather than something the API does while starting.
+
+Usage (one run, outside the API):
+    python retention.py --days 90
+    python retention.py --enable-incremental-vacuum  # once, with the API stopped
+"""
+import argparse
+import asyncio
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+from typing import List, Optional
+
+import database
+from database import run_db
+
+logger = logging.getLogger(__name__)
+
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "0"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_CHUNK = int(os.getenv("RETENTION_CHUNK", "500"))
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "chat_archive")  # empty deletes without archiving
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "1000"))
+
+SQL_EXPIRED_CHUNK = (
+    "SELECT id, user_id, query, response, timestamp FROM chat_history "
+    "WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?"
+)
+COLUMNS = ("id", "user_id", "query", "response", "timestamp")
+
+
+class RetentionJob:
+    def __init__(
+        self,
+        days: float = RETENTION_DAYS,
+        interval_seconds: float = RETENTION_INTERVAL,
+        chunk: int = RETENTION_CHUNK,
+        archive_dir: Optional[str] = RETENTION_ARCHIVE_DIR,
+        vacuum_pages: int = RETENTION_VACUUM_PAGES,
+    ):
+        self.days = days
+        self.interval = interval_seconds
+        self.chunk = max(1, chunk)
+        self.archive_dir = archive_dir or None
+        self.vacuum_pages = max(1, vacuum_pages)
+        self._task: Optional[asyncio.Task] = None
+        self._archive = self._archive_file = None
+        self.runs = 0
+        self.rows_purged = 0
+        self.rows_archived = 0
+        self.pages_reclaimed = 0
+        self.transactions = 0
+        self.lock_hold_max_ms = 0.0
+        self.lock_hold_total_ms = 0.0
+        self.last_run: Optional[dict] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.days > 0
+
+    def cutoff(self) -> str:
+        moment = datetime.datetime.utcnow() - datetime.timedelta(days=self.days)
+        return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+    # -- blocking steps, run through run_db ---------------------------------
+
+    def _write_archive(self, rows: List[tuple]):
+        if self._archive is None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+            path = os.path.join(self.archive_dir, f"chat_history-{stamp}.ndjson.gz")
+            self._archive_file = open(path, "ab")
+            self._archive = gzip.GzipFile(fileobj=self._archive_file, mode="ab")
+            logger.info(f"Archiving expired chat history to {path}")
+        self._archive.write("".join(json.dumps(dict(zip(COLUMNS, row))) + "\n" for row in rows).encode("utf-8"))
+        self._archive.flush()
+        self._archive_file.flush()
+        os.fsync(self._archive_file.fileno())
+        self.rows_archived += len(rows)
+
+    def _close_archive(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive_file.close()
+            self._archive = self._archive_file = None
+
+    def purge_chunk(self, conn, cutoff: str) -> int:
+        """Archive and delete up to ``chunk`` expired rows; returns how many."""
+        rows = conn.execute(SQL_EXPIRED_CHUNK, (cutoff, self.chunk)).fetchall()
+        if not rows:
+            return 0
+        if self.archive_dir:
+            self._write_archive(rows)
+        conn.execute("BEGIN IMMEDIATE")
+        locked = time.perf_counter()
+        conn.executemany("DELETE FROM chat_history WHERE id = ?", [(row[0],) for row in rows])
+        conn.commit()
+        self._record_lock(time.perf_counter() - locked)
+        self.rows_purged += len(rows)
+        return len(rows)
+
+    def vacuum_step(self, conn) -> int:
+        """Return up to ``vacuum_pages`` free pages to the filesystem; returns how many."""
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not before:
+            return 0
+        locked = time.perf_counter()
+        # Each step of this pragma frees one page; executescript runs it to completion
+        conn.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages});")
+        self._record_lock(time.perf_counter() - locked)
+        reclaimed = before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        self.pages_reclaimed += reclaimed
+        return reclaimed
+
+    def _record_lock(self, held_s: float):
+        held_ms = held_s * 1000
+        self.transactions += 1
+        self.lock_hold_total_ms += held_ms
+        self.lock_hold_max_ms = max(self.lock_hold_max_ms, held_ms)
+
+    # -- scheduling ---------------------------------------------------------
+
+    async def run_once(self) -> dict:
+        """One full pass: purge every expired row, then vacuum the freed pages."""
+        started = time.perf_counter()
+        cutoff = self.cutoff()
+        purged = reclaimed = 0
+        try:
+            while True:
+                count = await run_db(self.purge_chunk, cutoff)
+                purged += count
+                if count < self.chunk:
+                    break
+        finally:
+            self._close_archive()
+        while True:
+            count = await run_db(self.vacuum_step)
+            reclaimed += count
+            if count < self.vacuum_pages:
+                break
+        self.runs += 1
+        self.last_run = {
+            "cutoff": cutoff,
+            "rows_purged": purged,
+            "pages_reclaimed": reclaimed,
+            "duration_s": round(time.perf_counter() - started, 3),
+        }
+        if purged:
+            logger.info(f"Retention purged {purged} chat records older than {cutoff}, reclaimed {reclaimed} pages")
+        return self.last_run
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Retention run failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+            logger.info(f"Retention enabled: chat history older than {self.days:g} days is purged")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "retention_days": self.days,
+            "runs": self.runs,
+            "rows_purged": self.rows_purged,
+            "rows_archived": self.rows_archived,
+            "pages_reclaimed": self.pages_reclaimed,
+            "write_transactions": self.transactions,
+            "lock_hold_avg_ms": round(self.lock_hold_total_ms / self.transactions, 3) if self.transactions else 0.0,
+            "lock_hold_max_ms": round(self.lock_hold_max_ms, 3),
+            "last_run": self.last_run,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Purge chat history older than the retention period once.")
+    parser.add_argument("--days", type=float, default=RETENTION_DAYS or None)
+    parser.add_argument("--archive-dir", default=RETENTION_ARCHIVE_DIR)
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="rebuild the database file so freed pages can be returned, then exit")
+    args = parser.parse_args()
+    if not args.days and not args.enable_incremental_vacuum:
+        parser.error("--days is required (or set RETENTION_DAYS)")
+
+    logging.basicConfig(level=logging.INFO)
+    if args.enable_incremental_vacuum:
+        with database.pool.connection() as conn:
+            database.enable_incremental_vacuum(conn)
+        return
+    database.init_db()
+    job = RetentionJob(days=args.days, archive_dir=args.archive_dir)
+    asyncio.run(job.run_once())
+    print(json.dumps(job.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
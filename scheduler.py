@@ -0,0 +1,313 @@
+"""Fair-share scheduling of inference work across callers.
+
+The inference pool on its own admits requests first come, first served, so
+one client scripting "Bearer guest" requests can hold every slot.
+``FairScheduler`` sits between admission and the model calls:
+
+* Priority classes: ``registered`` callers are always dispatched before
+  ``guest`` callers, and guests may only fill ``SCHEDULER_GUEST_QUEUE_SHARE``
+  of the pool's queue, so a guest flood leaves room for registered users.
+* Per-caller concurrency caps: a caller with ``max_concurrent`` requests
+  running waits for one of them to finish, however many slots are free.
+* Token buckets per caller: ``charge`` takes one token per request; an
+  empty bucket is refused with a Retry-After before anything is queued.
+  Batches are charged one token per query to a second, larger bucket
+  (``SCHEDULER_*_BATCH_*``), sized by default so a registered user can send
+  one full /healthbot/batch at a time; a batch larger than a full bucket,
+  which could never be paid for, is refused outright.
+* Weighted fair queuing among the callers of a class: a request's finish
+  tag is ``max(class virtual time, caller's last tag) + cost``, its cost
+  being the tokens it may generate, and of the callers under their cap the
+  one with the smallest tag goes next.  A caller sending many requests (or
+  long ones) only queues behind itself; an idle caller earns no credit.
+
+At most ``SCHEDULER_SLOTS`` requests hold a slot at once (by default enough
+to fill every micro-batch of every worker); the rest wait in the scheduler,
+where the order is decided, rather than in the pool's FIFO.  Registered
+callers are keyed by user id, guests by the per-session id a trusted proxy
+sends (``X-Guest-Id``) or else their client IP.  A limit of 0 disables that
+cap or bucket.
+"""
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, NamedTuple, Optional, Tuple
+
+from inference import BATCH_MAX_SIZE, INFERENCE_WORKERS, PoolSaturated
+from metrics import SCHEDULER_QUEUE_WAIT, SCHEDULER_REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_REGISTERED, PRIORITY_GUEST = "registered", "guest"
+PRIORITIES = (PRIORITY_REGISTERED, PRIORITY_GUEST)  # dispatch order
+
+SCHEDULER_SLOTS = int(os.getenv("SCHEDULER_SLOTS", str(INFERENCE_WORKERS * BATCH_MAX_SIZE)))
+SCHEDULER_REGISTERED_MAX_CONCURRENT = int(os.getenv("SCHEDULER_REGISTERED_MAX_CONCURRENT", "8"))
+SCHEDULER_REGISTERED_RATE = float(os.getenv("SCHEDULER_REGISTERED_RATE", "5"))  # requests/s per user
+SCHEDULER_REGISTERED_BURST = float(os.getenv("SCHEDULER_REGISTERED_BURST", "30"))
+SCHEDULER_GUEST_MAX_CONCURRENT = int(os.getenv("SCHEDULER_GUEST_MAX_CONCURRENT", "2"))
+SCHEDULER_GUEST_RATE = float(os.getenv("SCHEDULER_GUEST_RATE", "0.5"))  # requests/s per guest
+SCHEDULER_GUEST_BURST = float(os.getenv("SCHEDULER_GUEST_BURST", "5"))
+SCHEDULER_GUEST_QUEUE_SHARE = float(os.getenv("SCHEDULER_GUEST_QUEUE_SHARE", "0.5"))
+# Batches: queries/s per caller, and the most a caller can send at once (HEALTHBOT_BATCH_MAX_QUERIES's default)
+SCHEDULER_REGISTERED_BATCH_RATE = float(os.getenv("SCHEDULER_REGISTERED_BATCH_RATE", "2"))
+SCHEDULER_REGISTERED_BATCH_BURST = float(os.getenv("SCHEDULER_REGISTERED_BATCH_BURST", "256"))
+SCHEDULER_GUEST_BATCH_RATE = float(os.getenv("SCHEDULER_GUEST_BATCH_RATE", "0.5"))
+SCHEDULER_GUEST_BATCH_BURST = float(os.getenv("SCHEDULER_GUEST_BATCH_BURST", "5"))
+
+
+class Caller(NamedTuple):
+    key: str  # "user:<id>", "guest:id:<guest id>" or "guest:<ip>"
+    priority: str
+
+
+class ClassPolicy(NamedTuple):
+    max_concurrent: int
+    rate: float
+    burst: float
+    queue_share: float = 1.0
+    batch_rate: float = 0.0
+    batch_burst: float = 0.0
+
+
+DEFAULT_POLICIES = {
+    PRIORITY_REGISTERED: ClassPolicy(SCHEDULER_REGISTERED_MAX_CONCURRENT, SCHEDULER_REGISTERED_RATE,
+                                     SCHEDULER_REGISTERED_BURST, 1.0, SCHEDULER_REGISTERED_BATCH_RATE,
+                                     SCHEDULER_REGISTERED_BATCH_BURST),
+    PRIORITY_GUEST: ClassPolicy(SCHEDULER_GUEST_MAX_CONCURRENT, SCHEDULER_GUEST_RATE, SCHEDULER_GUEST_BURST,
+                                SCHEDULER_GUEST_QUEUE_SHARE, SCHEDULER_GUEST_BATCH_RATE, SCHEDULER_GUEST_BATCH_BURST),
+}
+
+
+class RateLimited(Exception):
+    """Raised by ``FairScheduler.charge`` when the caller's token bucket is empty."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Rate limit reached, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class OverBurst(Exception):
+    """Raised by ``FairScheduler.charge`` for an amount larger than the caller's bucket holds."""
+
+    def __init__(self, burst: int):
+        super().__init__(f"At most {burst} at once")
+        self.burst = burst
+
+
+class TokenBucket:
+    """``burst`` tokens, refilled at ``rate`` per second."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = now
+
+    def take(self, amount: float, now: float) -> float:
+        """Take ``amount`` tokens and return 0, or return the seconds until they are there."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class _Flow:
+    """One caller's requests: running, and waiting in tag order."""
+
+    __slots__ = ("caller", "running", "waiting", "last_finish")
+
+    def __init__(self, caller: Caller):
+        self.caller = caller
+        self.running = 0
+        self.waiting: Deque["Lease"] = deque()
+        self.last_finish = 0.0
+
+
+class Lease:
+    """A ticket's claim on a scheduler slot, awaited before its model calls."""
+
+    __slots__ = ("scheduler", "caller", "cost", "finish", "future", "granted")
+
+    def __init__(self, scheduler: "FairScheduler", caller: Caller, cost: float):
+        self.scheduler = scheduler
+        self.caller = caller
+        self.cost = max(1.0, cost)
+        self.finish = 0.0
+        self.future: Optional[asyncio.Future] = None
+        self.granted = False
+
+    async def acquire(self) -> float:
+        """Wait for a slot; returns the seconds waited."""
+        return await self.scheduler._acquire(self)
+
+    def release(self, wait_s: float):
+        """Give the slot back; ``wait_s`` is the request's whole queue wait, for the per-class metric."""
+        SCHEDULER_QUEUE_WAIT.observe(wait_s, priority=self.caller.priority)
+        self.scheduler._release(self)
+
+
+class FairScheduler:
+    def __init__(self, slots: int = SCHEDULER_SLOTS, policies: Optional[Dict[str, ClassPolicy]] = None,
+                 max_keys: int = 100_000):
+        self.slots = max(1, slots)
+        self.policies = policies or DEFAULT_POLICIES
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._flows: Dict[str, Dict[str, _Flow]] = {priority: {} for priority in PRIORITIES}
+        self._virtual_time = {priority: 0.0 for priority in PRIORITIES}
+        self._buckets: "OrderedDict[Tuple[str, bool], TokenBucket]" = OrderedDict()
+        self._granted = 0
+        self.dispatched = {priority: 0 for priority in PRIORITIES}
+        self.rejected = {priority: 0 for priority in PRIORITIES}
+
+    def charge(self, caller: Caller, amount: float = 1, batch: bool = False):
+        """Take ``amount`` from the caller's bucket (its batch bucket if ``batch``) or raise ``RateLimited``.
+
+        ``OverBurst`` is raised for an amount the full bucket could never cover.
+        """
+        policy = self.policies[caller.priority]
+        rate, burst = (policy.batch_rate, policy.batch_burst) if batch else (policy.rate, policy.burst)
+        if rate <= 0:
+            return
+        burst = max(1.0, burst)
+        if amount > burst:
+            with self._lock:
+                self.rejected[caller.priority] += 1
+            SCHEDULER_REJECTIONS.inc(priority=caller.priority, reason="over_burst")
+            raise OverBurst(int(burst))
+        now = time.monotonic()
+        with self._lock:
+            key = (caller.key, batch)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            wait = bucket.take(amount, now)
+            if wait:
+                self.rejected[caller.priority] += 1
+        if wait:
+            SCHEDULER_REJECTIONS.inc(priority=caller.priority, reason="rate_limited")
+            raise RateLimited(max(1, math.ceil(wait)))
+
+    def admit(self, pool, caller: Caller, cost: float):
+        """Admit a request to ``pool`` within its class's share of the queue; the ticket carries a ``Lease``."""
+        limit = pool.max_workers + int(pool.max_queue * self.policies[caller.priority].queue_share)
+        try:
+            ticket = pool.admit(limit)
+        except PoolSaturated:
+            with self._lock:
+                self.rejected[caller.priority] += 1
+            SCHEDULER_REJECTIONS.inc(priority=caller.priority, reason="queue_full")
+            raise
+        ticket.lease = Lease(self, caller, cost)
+        return ticket
+
+    async def _acquire(self, lease: Lease) -> float:
+        enqueued = time.perf_counter()
+        lease.future = asyncio.get_running_loop().create_future()
+        priority = lease.caller.priority
+        with self._lock:
+            flows = self._flows[priority]
+            flow = flows.get(lease.caller.key)
+            if flow is None:
+                flow = flows[lease.caller.key] = _Flow(lease.caller)
+            lease.finish = max(self._virtual_time[priority], flow.last_finish) + lease.cost
+            flow.last_finish = lease.finish
+            flow.waiting.append(lease)
+            self._dispatch()
+        try:
+            await lease.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if lease.granted:
+                    self._finish(lease)
+                elif lease in flow.waiting:
+                    flow.waiting.remove(lease)
+                    self._forget(flow)
+            raise
+        return time.perf_counter() - enqueued
+
+    def _release(self, lease: Lease):
+        with self._lock:
+            if lease.granted:
+                self._finish(lease)
+
+    def _finish(self, lease: Lease):
+        lease.granted = False
+        self._granted -= 1
+        flow = self._flows[lease.caller.priority][lease.caller.key]
+        flow.running -= 1
+        self._forget(flow)
+        self._dispatch()
+
+    def _forget(self, flow: _Flow):
+        flows = self._flows[flow.caller.priority]
+        if not flow.running and not flow.waiting and flows.get(flow.caller.key) is flow:
+            del flows[flow.caller.key]
+
+    def _dispatch(self):
+        """Grant free slots: highest class first, then the smallest finish tag among callers under their cap."""
+        while self._granted < self.slots:
+            lease = None
+            for priority in PRIORITIES:
+                cap = self.policies[priority].max_concurrent
+                ready = [flow for flow in self._flows[priority].values()
+                         if flow.waiting and (cap <= 0 or flow.running < cap)]
+                if ready:
+                    lease = min((flow.waiting[0] for flow in ready), key=lambda waiting: waiting.finish)
+                    break
+            if lease is None:
+                return
+            flow = self._flows[priority][lease.caller.key]
+            flow.waiting.popleft()
+            if lease.future.cancelled():  # its task is unwinding and will find it gone
+                self._forget(flow)
+                continue
+            flow.running += 1
+            self._granted += 1
+            self.dispatched[priority] += 1
+            # Virtual time follows the service given: the start tag of the request dispatched
+            self._virtual_time[priority] = max(self._virtual_time[priority], lease.finish - lease.cost)
+            lease.granted = True
+            lease.future.set_result(None)
+
+    def counts(self, key: str) -> Dict[str, int]:
+        """``running`` or ``waiting`` requests per class."""
+        with self._lock:
+            if key == "running":
+                return {priority: sum(flow.running for flow in flows.values())
+                        for priority, flows in self._flows.items()}
+            return {priority: sum(len(flow.waiting) for flow in flows.values())
+                    for priority, flows in self._flows.items()}
+
+    def stats(self) -> dict:
+        running, waiting = self.counts("running"), self.counts("waiting")
+        with self._lock:
+            return {
+                "slots": self.slots,
+                "granted": self._granted,
+                "classes": {
+                    priority: {
+                        "callers": len(self._flows[priority]),
+                        "running": running[priority],
+                        "waiting": waiting[priority],
+                        "dispatched": self.dispatched[priority],
+                        "rejected": self.rejected[priority],
+                        **self.policies[priority]._asdict(),
+                    }
+                    for priority in PRIORITIES
+                },
+                "rate_buckets": len(self._buckets),
+            }
@@ -0,0 +1,255 @@
+"""Multi-turn conversation sessions with per-session KV-cache reuse.
+
+A session's context is the exact token stream of its previous turns
+(query tokens followed by the generated answer tokens).  A follow-up turn
+appends its query tokens to that stream and generates from there, passing
+the past key/values kept from the previous turn so only the new tokens go
+through the model.
+
+``SessionStore`` keeps sessions in an LRU.  KV caches are the expensive part,
+so once their total size passes ``max_cache_bytes`` the caches of the least
+recently used sessions are dropped first (their token context is kept and is
+recomputed on the next turn).  Whole sessions are evicted once there are more
+than ``max_sessions`` or they have been idle for ``ttl_seconds``.
+
+A session's first turn needs no context, so the API answers it like any
+other question (from the caches or in a micro-batch) and ``seed``s the
+session with the query and answer; ``started`` tells the two cases apart.
+
+Sessions live in the memory of one process.  Run the API as a single
+process, or with ``MODEL_SERVER`` set (the model server then keeps every
+session and all workers share them): with several workers and in-process
+models a follow-up landing on another worker finds no session there and is
+answered without its conversation.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from inference import (GENERATION_MAX_NEW_TOKENS, STOP_LENGTH, Budget, Generation, _budget_criteria,
+                       _callback_streamer, _decoding_kwargs, _eos_token_ids, _pad_token_id, exposes_hf_model)
+from metrics import GENERATED_TOKENS, GENERATION_STOPS, PROMPT_TOKENS, model_span
+from speculative import assistant_kwargs, counting, record
+
+logger = logging.getLogger(__name__)
+
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "256"))
+SESSION_MAX_CACHE_MB = float(os.getenv("SESSION_MAX_CACHE_MB", "512"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX_CONTEXT_TOKENS = int(os.getenv("SESSION_MAX_CONTEXT_TOKENS", "768"))
+
+
+def _cache_bytes(past) -> int:
+    if past is None:
+        return 0
+    if hasattr(past, "element_size"):  # a tensor
+        return past.numel() * past.element_size()
+    if isinstance(past, (tuple, list)):
+        return sum(_cache_bytes(p) for p in past)
+    # transformers Cache objects
+    return sum(_cache_bytes(t) for t in getattr(past, "key_cache", [])) + \
+        sum(_cache_bytes(t) for t in getattr(past, "value_cache", []))
+
+
+class Session:
+    def __init__(self, key: Tuple[str, str]):
+        self.key = key
+        self.token_ids = None  # (1, length) tensor, the context so far
+        self.past = None  # KV cache covering token_ids[:, :-1]
+        self.cache_bytes = 0
+        self.turns = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()  # one turn at a time per session
+
+
+class SessionStore:
+    def __init__(
+        self,
+        max_sessions: int = SESSION_MAX_SESSIONS,
+        max_cache_mb: float = SESSION_MAX_CACHE_MB,
+        ttl_seconds: float = SESSION_TTL,
+        max_context_tokens: int = SESSION_MAX_CONTEXT_TOKENS,
+        reuse_cache: bool = True,
+    ):
+        self.max_sessions = max(1, max_sessions)
+        self.max_cache_bytes = int(max_cache_mb * 2**20)
+        self.ttl = ttl_seconds
+        self.max_context_tokens = max_context_tokens
+        self.reuse_cache = reuse_cache
+        self._sessions: "OrderedDict[Tuple[str, str], Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._cache_bytes = 0
+        self.cache_evictions = 0
+        self.session_evictions = 0
+
+    def get(self, owner: str, session_id: str) -> Session:
+        """Return the caller's session, creating it if needed."""
+        key = (owner, session_id)
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = Session(key)
+                while len(self._sessions) > self.max_sessions:
+                    _, evicted = self._sessions.popitem(last=False)
+                    self._cache_bytes -= evicted.cache_bytes
+                    self.session_evictions += 1
+            self._sessions.move_to_end(key)
+            session.last_used = time.monotonic()
+            return session
+
+    def started(self, wrapper, owner: str, session_id: str) -> bool:
+        """Whether the session has context yet (asked of the model server when it keeps the sessions)."""
+        if hasattr(wrapper, "session_started"):
+            return wrapper.session_started((owner, session_id))
+        with self._lock:
+            session = self._sessions.get((owner, session_id))
+            return session is not None and session.token_ids is not None
+
+    def seed(self, wrapper, owner: str, session_id: str, query: str, response: str):
+        """Start a session from a first turn answered outside it: its context becomes ``query`` and ``response``.
+
+        Does nothing if a turn got there first.  No KV cache is kept; the
+        next turn computes it.
+        """
+        if hasattr(wrapper, "seed_turn"):
+            wrapper.seed_turn((owner, session_id), query, response)
+            return
+        if not exposes_hf_model(wrapper):
+            return
+        import torch
+
+        session = self.get(owner, session_id)
+        tokenizer = wrapper.tokenizer
+        with session.lock:
+            if session.token_ids is not None:
+                return
+            ids = [tokenizer(query, return_tensors="pt")["input_ids"]]
+            if response:
+                ids.append(tokenizer(" " + response, return_tensors="pt", add_special_tokens=False)["input_ids"])
+            session.token_ids = torch.cat(ids, dim=1)
+            session.turns += 1
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if session.last_used > cutoff:
+                break
+            del self._sessions[key]
+            self._cache_bytes -= session.cache_bytes
+            self.session_evictions += 1
+
+    def _store_cache(self, session: Session, past):
+        size = _cache_bytes(past) if self.reuse_cache else 0
+        with self._lock:
+            self._cache_bytes += size - session.cache_bytes
+            session.past = past if self.reuse_cache else None
+            session.cache_bytes = size
+            # Drop the KV caches of the least recently used sessions first
+            for other in list(self._sessions.values()):
+                if self._cache_bytes <= self.max_cache_bytes:
+                    break
+                if other is session or other.past is None:
+                    continue
+                self._cache_bytes -= other.cache_bytes
+                other.past, other.cache_bytes = None, 0
+                self.cache_evictions += 1
+            if self._cache_bytes > self.max_cache_bytes:
+                # This session alone is over the budget
+                self._cache_bytes -= session.cache_bytes
+                session.past, session.cache_bytes = None, 0
+                self.cache_evictions += 1
+
+    def generate_turn(
+        self,
+        wrapper,
+        session: Session,
+        query: str,
+        on_text: Optional[Callable[[str], None]] = None,
+        max_new_tokens: int = GENERATION_MAX_NEW_TOKENS,
+        budget: Optional[Budget] = None,
+    ) -> Generation:
+        """Generate the answer to ``query`` in the context of ``session``, within ``budget``.
+
+        A turn cut short stays in the context as far as it got.
+        """
+        budget = budget or Budget(max_new_tokens)
+        generation = self._turn(wrapper, session, query, on_text, budget)
+        GENERATION_STOPS.inc(model="biogpt", reason=generation.stop_reason)
+        return generation
+
+    def _turn(self, wrapper, session: Session, query: str, on_text: Optional[Callable[[str], None]],
+              budget: Budget) -> Generation:
+        if hasattr(wrapper, "generate_turn"):
+            # Served by a model_server process, which keeps the context and KV cache
+            with session.lock:
+                generation = wrapper.generate_turn(session.key, query, on_text, budget)
+                session.turns += 1
+            return generation
+        if not exposes_hf_model(wrapper):
+            raise RuntimeError("Conversation sessions need a wrapper that exposes its HF model")
+        import torch
+
+        tokenizer, model = wrapper.tokenizer, wrapper.model
+        max_new_tokens = budget.max_new_tokens
+        with session.lock:
+            reason = budget.stop_reason()  # may have run out waiting for the session's previous turn
+            if reason is not None:
+                return Generation("", reason)
+            if session.token_ids is None:
+                new_ids = tokenizer(query, return_tensors="pt")["input_ids"]
+                input_ids, past = new_ids, None
+            else:
+                new_ids = tokenizer(" " + query, return_tensors="pt", add_special_tokens=False)["input_ids"]
+                input_ids, past = torch.cat([session.token_ids, new_ids], dim=1), session.past
+
+            if input_ids.shape[1] + max_new_tokens > self.max_context_tokens:
+                # Positions shift when the front is cut, so the cache can't be reused
+                keep = max(new_ids.shape[1], self.max_context_tokens - max_new_tokens)
+                input_ids, past = input_ids[:, -keep:], None
+
+            kwargs = {}
+            if on_text is not None:
+                kwargs["streamer"] = _callback_streamer(tokenizer, on_text)
+            criteria, stopping_criteria = _budget_criteria([budget], input_ids.shape[1], _eos_token_ids(wrapper))
+            kwargs.update(assistant_kwargs(wrapper, 1))
+            with model_span("biogpt", "session_generate"), torch.inference_mode(), counting(kwargs) as passes:
+                output = model.generate(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    past_key_values=past,
+                    max_new_tokens=max_new_tokens,
+                    pad_token_id=_pad_token_id(tokenizer),
+                    return_dict_in_generate=True,
+                    use_cache=True,
+                    stopping_criteria=stopping_criteria,
+                    **_decoding_kwargs(wrapper),
+                    **kwargs,
+                )
+
+            # Only the tokens not covered by the reused cache were fed through the model
+            PROMPT_TOKENS.inc(input_ids.shape[1] - (session.token_ids.shape[1] - 1 if past is not None else 0),
+                              model="biogpt")
+            GENERATED_TOKENS.inc(output.sequences.shape[1] - input_ids.shape[1], model="biogpt")
+            record(passes, output.sequences.shape[1] - input_ids.shape[1])
+            session.token_ids = output.sequences
+            session.turns += 1
+            self._store_cache(session, output.past_key_values)
+            text = tokenizer.decode(output.sequences[0, input_ids.shape[1]:], skip_special_tokens=True)
+            return Generation(text, criteria.reasons[0] or STOP_LENGTH)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "cache_mb": round(self._cache_bytes / 2**20, 2),
+                "max_cache_mb": round(self.max_cache_bytes / 2**20, 2),
+                "cached_sessions": sum(1 for s in self._sessions.values() if s.past is not None),
+                "cache_evictions": self.cache_evictions,
+                "session_evictions": self.session_evictions,
+            }
@@ -0,0 +1,152 @@
+"""Speculative decoding for BioGPT with a small draft model.
+
+With ``DRAFT_MODEL`` set (a Hugging Face model id or directory of a small
+causal LM sharing BioGPT's tokenizer, e.g. a distilled or layer-truncated
+BioGPT) the registry loads it next to BioGPT, and single-prompt generation
+(streams, conversation turns, micro-batches of one) runs as transformers'
+assisted generation: the draft proposes up to ``DRAFT_NUM_TOKENS`` tokens
+greedily, BioGPT scores all of them in one forward pass and keeps the longest
+prefix matching its own greedy choice, plus the token it picks after it.
+The text is the one plain greedy decoding produces; only the number of
+BioGPT forward passes changes.  Padded batches of several prompts keep plain
+greedy decoding (assisted generation takes one sequence at a time), so under
+load micro-batching amortises the forward passes instead.
+
+Acceptance is counted with forward hooks on both models, in the thread
+running the generation: each BioGPT pass adds one token of its own on top of
+the draft tokens it accepted, so accepted = generated - BioGPT passes, and
+every draft pass proposes one token.
+"""
+import copy
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+from metrics import DRAFT_TOKENS
+
+logger = logging.getLogger(__name__)
+
+DRAFT_MODEL = os.getenv("DRAFT_MODEL", "")  # empty disables speculative decoding
+DRAFT_NUM_TOKENS = int(os.getenv("DRAFT_NUM_TOKENS", "5"))
+DRAFT_SCHEDULE = os.getenv("DRAFT_SCHEDULE", "heuristic")  # or "constant": always propose DRAFT_NUM_TOKENS
+
+_counting = threading.local()
+
+
+class SpeculationStats:
+    """Totals over every assisted generation in this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.draft_model: Optional[str] = None
+        self.generations = 0
+        self.generated_tokens = 0
+        self.target_passes = 0
+        self.proposed_tokens = 0
+        self.accepted_tokens = 0
+
+    def record(self, generated: int, target_passes: int, draft_passes: int):
+        accepted = max(0, generated - target_passes)
+        with self._lock:
+            self.generations += 1
+            self.generated_tokens += generated
+            self.target_passes += target_passes
+            self.proposed_tokens += draft_passes
+            self.accepted_tokens += accepted
+        DRAFT_TOKENS.inc(accepted, model="biogpt", outcome="accepted")
+        DRAFT_TOKENS.inc(max(0, draft_passes - accepted), model="biogpt", outcome="rejected")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "draft_model": self.draft_model,
+                "draft_num_tokens": DRAFT_NUM_TOKENS,
+                "draft_schedule": DRAFT_SCHEDULE,
+                "generations": self.generations,
+                "generated_tokens": self.generated_tokens,
+                "proposed_tokens": self.proposed_tokens,
+                "accepted_tokens": self.accepted_tokens,
+                "acceptance_rate": round(self.accepted_tokens / self.proposed_tokens, 3)
+                if self.proposed_tokens else None,
+                "tokens_per_target_pass": round(self.generated_tokens / self.target_passes, 3)
+                if self.target_passes else None,
+            }
+
+
+speculation_stats = SpeculationStats()
+
+
+def _count_passes(module, role: str):
+    """Count ``module``'s forward passes as ``role`` while ``counting`` is active (hooked once)."""
+    if getattr(module, "_speculation_role", None) is not None:
+        return
+
+    def hook(module, args, output):
+        counts = getattr(_counting, "counts", None)
+        if counts is not None:
+            counts[role] += 1
+
+    module.register_forward_hook(hook)
+    module._speculation_role = role
+
+
+def load_draft(wrapper, name_or_path: str = DRAFT_MODEL):
+    """Load the draft model for ``wrapper`` (BioGPT) and attach it as ``wrapper.draft_model``.
+
+    Does nothing when ``name_or_path`` is empty.  The draft must share the
+    target's vocabulary, since proposed token ids are checked as they are.
+    """
+    if not name_or_path:
+        return None
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    target = getattr(wrapper, "model", None)
+    if not isinstance(target, torch.nn.Module) or not hasattr(target, "generate"):
+        logger.warning("BioGPT wrapper exposes no torch model to verify drafts; speculative decoding is off")
+        return None
+    draft = AutoModelForCausalLM.from_pretrained(name_or_path).float().eval()
+    if draft.config.vocab_size != target.config.vocab_size:
+        raise ValueError(f"Draft model {name_or_path} has {draft.config.vocab_size} tokens, "
+                         f"BioGPT has {target.config.vocab_size}; they must share a tokenizer")
+    # The draft's generation config drives the proposals; transformers adapts it per call
+    draft.generation_config = copy.deepcopy(draft.generation_config)
+    draft.generation_config.num_assistant_tokens = DRAFT_NUM_TOKENS
+    draft.generation_config.num_assistant_tokens_schedule = DRAFT_SCHEDULE
+    _count_passes(draft, "draft")
+    _count_passes(target, "target")
+    wrapper.draft_model = draft
+    speculation_stats.draft_model = name_or_path
+    parameters = sum(p.numel() for p in draft.parameters())
+    logger.info(f"Speculative decoding with {name_or_path} ({parameters / 1e6:.0f}M parameters), "
+                f"up to {DRAFT_NUM_TOKENS} draft tokens per step")
+    return draft
+
+
+def assistant_kwargs(wrapper, rows: int) -> dict:
+    """``generate`` kwargs for assisted generation of ``rows`` prompts: empty unless a draft is loaded and rows == 1."""
+    draft = getattr(wrapper, "draft_model", None)
+    if draft is None or rows != 1:
+        return {}
+    return {"assistant_model": draft}
+
+
+@contextmanager
+def counting(kwargs: dict):
+    """Count forward passes of the assisted ``generate`` call inside; yields None if ``kwargs`` is not assisted."""
+    if "assistant_model" not in kwargs:
+        yield None
+        return
+    counts = _counting.counts = {"target": 0, "draft": 0}
+    try:
+        yield counts
+    finally:
+        _counting.counts = None
+
+
+def record(counts: Optional[dict], generated: int):
+    """Add an assisted generation's passes (from ``counting``) to the stats; no-op for plain ones."""
+    if counts is not None and counts["target"]:
+        speculation_stats.record(generated, counts["target"], counts["draft"])
@@ -3,6 +3,9 @@ import requests
 from bs4 import BeautifulSoup
 import pytz,os,sys
 import datetime
+import json
+import uuid
+from urllib.parse import urlencode
 
 
 from dotenv import load_dotenv
@@ -14,6 +17,7 @@ load_dotenv()
 API_BASE_URL = os.getenv("API_BASE_URL")
 API_AUTH_URL = f"{API_BASE_URL}/auth"
 API_CHAT_URL = f"{API_BASE_URL}/healthbot"
+API_CHAT_STREAM_URL = f"{API_CHAT_URL}/stream"
 API_CHAT_HISTORY_URL = f"{API_BASE_URL}/chat_history"
 
 # Set page config
@@ -270,6 +274,10 @@ if "clear_chat_confirm" not in st.session_state:
     st.session_state.clear_chat_confirm = False
 if "clear_history_confirm" not in st.session_state:
     st.session_state.clear_history_confirm = False
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = str(uuid.uuid4())
+if "guest_id" not in st.session_state:
+    st.session_state.guest_id = str(uuid.uuid4())
 
 # Convert UTC timestamp to IST
 def convert_utc_to_ist(utc_timestamp):
@@ -284,9 +292,23 @@ def convert_utc_to_ist(utc_timestamp):
     
     return ist_time.strftime("%Y-%m-%d %I:%M %p")
 
+# Calls to the API come from this server, so pass on the address the browser's requests came from
+# and, for guests, an id for this browser session to queue them by; the API only believes them when
+# this server is listed in its TRUSTED_PROXIES.  X-Forwarded-For is only passed on when a reverse
+# proxy in front of this server sets it: otherwise it is whatever the browser chose to send.
+FORWARD_CLIENT_IP = os.getenv("STREAMLIT_FORWARD_CLIENT_IP", "0") == "1"
+
+def client_headers():
+    forwarded_for = st.context.headers.get("X-Forwarded-For") if FORWARD_CLIENT_IP else None
+    headers = {"X-Forwarded-For": forwarded_for} if forwarded_for else {}
+    if st.session_state.is_guest:
+        headers["X-Guest-Id"] = st.session_state.guest_id
+    return headers
+
 # Function to send API requests
 def api_request(endpoint, method="GET", data=None):
     headers = {"Authorization": f"Bearer {st.session_state.auth_token}"} if st.session_state.auth_token else {}
+    headers.update(client_headers())
     url = f"{API_BASE_URL}{endpoint}"
 
     try:
@@ -303,13 +325,42 @@ def api_request(endpoint, method="GET", data=None):
         st.error(f"⚠️ Unable to connect to the server. Error: {e}")
         return None
 
+PARTIAL_NOTES = {
+    "length": "✂️ Answer cut short at the length limit.",
+    "deadline": "⏱️ Answer cut short at the server's time limit.",
+}
+
+# Function to stream the bot response from the server-sent events endpoint
+def stream_chat_response(query, headers):
+    """Yield response text pieces as the server generates them."""
+    payload = {"query": query, "session_id": st.session_state.conversation_id}
+    with requests.post(API_CHAT_STREAM_URL, json=payload, headers={**headers, **client_headers()}, stream=True) as response:
+        response.raise_for_status()
+        event = "message"
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                payload = json.loads(line[len("data:"):].strip())
+                if event == "error":
+                    raise requests.exceptions.RequestException(payload.get("detail", "Generation failed"))
+                if event == "done":
+                    # Answers stopped early by the server's token budget or time limit are marked partial
+                    if payload.get("partial") and payload.get("stop_reason") in PARTIAL_NOTES:
+                        yield f"\n\n_{PARTIAL_NOTES[payload['stop_reason']]}_"
+                    return
+                yield payload["token"]
+            elif not line:
+                event = "message"
+
 # Function to load chat history from API
 def load_chat_sessions():
     """Load and display chat sessions in the sidebar."""
     if st.session_state.is_guest:
         return  # Don't load history for guest users
 
-    response = api_request("/chat_history/")
+    # The sidebar only shows entries, so skip the query/response text
+    response = api_request("/chat_history/?fields=id,timestamp&limit=200")
     if response and response.status_code == 200:
         raw_history = response.json().get("history", {})
 
@@ -335,6 +386,14 @@ def load_chat_sessions():
     else:
         st.session_state.chat_sessions = []
 
+# Function to search chat history
+def search_chat_history(query):
+    """Return the user's chats matching the query, best match first."""
+    response = api_request(f"/chat_history/search?{urlencode({'q': query, 'limit': 20})}")
+    if response and response.status_code == 200:
+        return response.json().get("results", [])
+    return []
+
 # Function to load selected chat
 def load_selected_chat(chat_id):
     """Load chat messages from a specific chat session."""
@@ -342,6 +401,7 @@ def load_selected_chat(chat_id):
 
     if response and response.status_code == 200:
         chat_data = response.json()
+        st.session_state.conversation_id = str(uuid.uuid4())
         st.session_state.messages = [
             {"role": "user", "content": chat_data["query"]},
             {"role": "assistant", "content": chat_data["response"]}
@@ -370,7 +430,7 @@ with st.sidebar:
         if auth_mode == "Login":
             if st.button("🔓 Login"):
                 try:
-                    response = requests.post(f"{API_AUTH_URL}/login", json={"username": username, "password": password})
+                    response = requests.post(f"{API_AUTH_URL}/login", json={"username": username, "password": password}, headers=client_headers())
                     # Check if the response is successful
                     if response.status_code == 200:
                         st.session_state.auth_token = response.json()["token"]
@@ -391,7 +451,7 @@ with st.sidebar:
         elif auth_mode == "Signup":
             if st.button("📝 Signup"):
                 try:
-                    response = requests.post(f"{API_AUTH_URL}/register", json={"username": username, "password": password})
+                    response = requests.post(f"{API_AUTH_URL}/register", json={"username": username, "password": password}, headers=client_headers())
                     # Check if the signup was successful
                     if response.status_code == 200:
                         st.success("✅ Signup successful! Please log in.")
@@ -424,6 +484,24 @@ with st.sidebar:
         if not st.session_state.is_guest:
             load_chat_sessions()  
 
+            # ✅ Search past chats by their text instead of scrolling by date
+            search_query = st.text_input("🔍 Search Chats", key="search_query")
+            if search_query:
+                search_results = search_chat_history(search_query)
+                if search_results:
+                    result_options = {
+                        f"{convert_utc_to_ist(result['timestamp'])} · {result['query'][:40]} (#{result['id']})": result["id"]
+                        for result in search_results
+                    }
+                    selected_result_title = st.selectbox("🔎 Search Results", options=list(result_options.keys()), key="selected_result_title")
+
+                    if st.button("📂 Open Result"):
+                        st.session_state.selected_chat = result_options.get(selected_result_title)
+                        load_selected_chat(st.session_state.selected_chat)
+                        st.rerun()
+                else:
+                    st.info("No matching chats found.")
+
             # ✅ Only show chat history if there are previous chats
             if st.session_state.chat_sessions:
                 chat_options = {f"Chat on {chat['timestamp']}": chat["id"] for chat in st.session_state.chat_sessions}
@@ -443,6 +521,7 @@ with st.sidebar:
             st.session_state.chat_sessions = []
             st.session_state.selected_chat = None
             st.session_state.is_guest = True
+            st.session_state.conversation_id = str(uuid.uuid4())
             st.rerun()
 
 # Main App - Chat Interface
@@ -467,24 +546,28 @@ if st.session_state.auth_token:
         with st.chat_message("user"):
             st.markdown(f"<p style='color:red; font-weight:bold; font-size:18px;'>🧑‍💬 <b>You:</b> {query}</p>", unsafe_allow_html=True)
 
-        with st.spinner("🤖 Thinking..."):
+        with st.chat_message("assistant"):
+            placeholder = st.empty()
+            placeholder.markdown("<span style='color:green; font-weight:bold; font-size:18px;'>🤖 <b>HealthBot:</b> Thinking...</span>", unsafe_allow_html=True)
+            bot_response = ""
             try:
                 headers = {"Authorization": f"Bearer guest"} if st.session_state.is_guest else {"Authorization": f"Bearer {st.session_state.auth_token}"}
-                response = requests.post(API_CHAT_URL, json={"query": query}, headers=headers)
-                response.raise_for_status()
-                bot_response = response.json().get("response", "⚠️ Unexpected response format.")
+                # Render tokens as they arrive instead of waiting for the whole answer
+                for token in stream_chat_response(query, headers):
+                    bot_response += token
+                    formatted_response = bot_response.replace('\n', '<br/>')
+                    placeholder.markdown(f"<span style='color:green; font-weight:bold; font-size:18px;'>🤖 <b>HealthBot:</b> {formatted_response}</span>", unsafe_allow_html=True)
 
                 # Ensure that the entire response is wrapped in green
-                formatted_response = bot_response.replace('\n', '<br/>')
+                formatted_response = bot_response.replace('\n', '<br/>') if bot_response else "⚠️ Unexpected response format."
 
             except requests.exceptions.RequestException as e:
                 formatted_response = "⚠️ Unable to process your request at the moment. Please try again later."
 
-        st.session_state.messages.append({"role": "assistant", "content": formatted_response})
-
-        with st.chat_message("assistant"):
             # Wrap the entire response in a span with green styling
-            st.markdown(f"<span style='color:green; font-weight:bold; font-size:18px;'>🤖 <b>HealthBot:</b> {formatted_response}</span>", unsafe_allow_html=True)
+            placeholder.markdown(f"<span style='color:green; font-weight:bold; font-size:18px;'>🤖 <b>HealthBot:</b> {formatted_response}</span>", unsafe_allow_html=True)
+
+        st.session_state.messages.append({"role": "assistant", "content": formatted_response})
 
         st.rerun()
     # Clear Chat Button with Confirmation
@@ -497,6 +580,7 @@ if st.session_state.auth_token:
         if st.button("Yes, clear it"):
             st.session_state.messages.clear()
             st.session_state.selected_chat = None
+            st.session_state.conversation_id = str(uuid.uuid4())
             st.session_state.clear_chat_confirm = False
             st.success("Chat cleared successfully.")
             st.rerun()
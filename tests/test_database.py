@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database  # noqa: E402
+
+
+class SearchHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.conn = sqlite3.connect(os.path.join(self.directory.name, "test.db"))
+        self.conn.executescript(database.SCHEMA)
+        database.migrate(self.conn)
+        for username in ("alice", "bob"):
+            database.insert_user(self.conn, username, "hash")
+        self.alice = database.fetch_user_id(self.conn, "alice")
+        self.bob = database.fetch_user_id(self.conn, "bob")
+
+    def tearDown(self):
+        self.conn.close()
+        self.directory.cleanup()
+
+    def search(self, user_id: int, text: str) -> list:
+        return [row[1] for row in database.search_history(self.conn, user_id, database.search_expression(text))]
+
+    def test_matches_only_the_users_own_chats(self):
+        database.insert_chat(self.conn, self.alice, "What causes migraines?", "Triggers include stress.")
+        database.insert_chat(self.conn, self.bob, "Are migraines hereditary?", "They often run in families.")
+        self.assertEqual(self.search(self.alice, "migraines"), ["What causes migraines?"])
+        self.assertEqual(self.search(self.bob, "migraine"), ["Are migraines hereditary?"])
+
+    def test_term_equal_to_the_user_id_does_not_match_every_chat(self):
+        database.insert_chat(self.conn, self.alice, "What is a normal heart rate?", "60 to 100 beats a minute.")
+        database.insert_chat(self.conn, self.alice, f"Is a dose of {self.alice} tablets safe?", "Ask a pharmacist.")
+        self.assertEqual(self.search(self.alice, str(self.alice)), [f"Is a dose of {self.alice} tablets safe?"])
+        self.assertEqual(self.search(self.alice, f"{self.alice} heart"), [])
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(database.SCHEMA)
+        return conn
+
+    def test_concurrent_migrations_apply_each_step_once(self):
+        conns = [self.connect() for _ in range(4)]
+        start, errors = threading.Barrier(len(conns)), []
+
+        def run(conn):
+            start.wait()
+            try:
+                database.migrate(conn)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(conn,)) for conn in conns]
+        with self.assertLogs(database.logger, "INFO") as logs:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        applied = [record.getMessage() for record in logs.records]
+        self.assertEqual(applied, [f"Applying database migration {n}" for n in range(1, len(database.MIGRATIONS) + 1)])
+        self.assertEqual(conns[0].execute("PRAGMA user_version").fetchone()[0], len(database.MIGRATIONS))
+        for conn in conns:
+            conn.close()
+
+    def test_trigger_bodies_stay_in_one_statement(self):
+        statements = database._statements(database.MIGRATIONS[3])
+        triggers = [s for s in statements if s.startswith("CREATE TRIGGER")]
+        self.assertEqual(len(triggers), 3)
+        self.assertTrue(all(s.endswith("END;") for s in triggers))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import asyncio
+import contextvars
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from inference import InferencePool  # noqa: E402
+
+
+class TicketTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = InferencePool(max_workers=1, max_queue=0)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def in_flight(self) -> int:
+        return self.pool.stats()["in_flight"]
+
+    def test_body_paused_in_another_task_releases_its_slot_when_closed(self):
+        ticket = self.pool.admit()
+
+        async def body():
+            async with ticket:
+                yield "first"
+                yield "second"
+
+        async def main():
+            stream = body()
+            # Like Starlette's body task: its own context, paused at the yield inside the ticket
+            started = asyncio.get_running_loop().create_task(stream.__anext__(), context=contextvars.Context())
+            self.assertEqual(await started, "first")
+            self.assertEqual(self.in_flight(), 1)
+            await stream.aclose()
+
+        asyncio.run(main())
+        self.assertEqual(self.in_flight(), 0)
+
+    def test_nested_stream_closed_from_another_task_releases_its_slot(self):
+        # The ndjson batch: lines() wraps items(), which holds the ticket across its yields
+        ticket = self.pool.admit()
+
+        async def items():
+            async with ticket:
+                for index in range(3):
+                    yield {"index": index}
+
+        async def lines():
+            results = items()
+            try:
+                async for item in results:
+                    yield f"{item}\n"
+            finally:
+                await results.aclose()
+
+        async def main():
+            stream = lines()
+            started = asyncio.get_running_loop().create_task(stream.__anext__(), context=contextvars.Context())
+            await started
+            await stream.aclose()
+
+        asyncio.run(main())
+        self.assertEqual(self.in_flight(), 0)
+
+    def test_ticket_never_entered_is_discarded(self):
+        ticket = self.pool.admit()
+        ticket.discard()
+        ticket.discard()
+        self.assertEqual(self.in_flight(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+"""In-memory cosine-similarity index backed by a NumPy matrix.
+
+Vectors are L2-normalised on insert so cosine similarity is a dot product.
+Small indexes are searched brute force.  Once an index holds
+``approximate_threshold`` vectors it switches to an inverted-file (IVF)
+layout: vectors are bucketed under k-means centroids and a search only scans
+the ``n_probe`` buckets closest to the query.
+
+The index never holds more than ``max_entries`` vectors; when full, the least
+recently matched or inserted slot is overwritten.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorIndex:
+    def __init__(
+        self,
+        dim: int,
+        max_entries: int,
+        approximate_threshold: int = 50_000,
+        n_probe: int = 8,
+        dtype=np.float32,
+    ):
+        self.dim = dim
+        self.max_entries = max(1, max_entries)
+        self.approximate_threshold = approximate_threshold
+        self.n_probe = n_probe
+        self._vectors = np.empty((min(self.max_entries, 1024), dim), dtype=dtype)
+        self._last_used = np.empty(self._vectors.shape[0], dtype=np.float64)
+        self._payloads: List[Any] = []
+        self._count = 0
+        self._lock = threading.Lock()
+
+        # IVF state, built once the index grows past approximate_threshold
+        self._centroids: Optional[np.ndarray] = None
+        self._assignments: Optional[np.ndarray] = None
+        self._lists: List[List[int]] = []
+        self._trained_at = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def approximate(self) -> bool:
+        return self._centroids is not None
+
+    @property
+    def nbytes(self) -> int:
+        return self._vectors.nbytes + self._last_used.nbytes
+
+    def add(self, vector: np.ndarray, payload: Any) -> int:
+        """Insert ``vector`` and return its slot, evicting the LRU slot if full."""
+        vector = _normalize(np.asarray(vector, dtype=np.float32).reshape(self.dim))
+        with self._lock:
+            if self._count < self.max_entries:
+                slot = self._count
+                self._grow(slot + 1)
+                self._count += 1
+                self._payloads.append(payload)
+            else:
+                slot = int(np.argmin(self._last_used[:self._count]))
+                self._unassign(slot)
+                self._payloads[slot] = payload
+
+            self._vectors[slot] = vector
+            self._last_used[slot] = time.monotonic()
+            self._assign(slot)
+
+            if self._count >= self.approximate_threshold and self._count >= 2 * self._trained_at:
+                self._train()
+            return slot
+
+    def search(self, vector: np.ndarray, k: int = 1) -> List[Tuple[float, Any]]:
+        """Return up to ``k`` ``(similarity, payload)`` pairs, best first."""
+        query = _normalize(np.asarray(vector, dtype=np.float32).reshape(self.dim))
+        with self._lock:
+            if not self._count:
+                return []
+            if self.approximate:
+                candidates = self._probe(query)
+                scores = self._vectors[candidates] @ query
+            else:
+                candidates = None
+                scores = self._vectors[:self._count] @ query
+
+            k = min(k, scores.shape[0])
+            if not k:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            slots = candidates[top] if candidates is not None else top
+            self._last_used[slots] = time.monotonic()
+            return [(float(scores[i]), self._payloads[slot]) for i, slot in zip(top, slots)]
+
+    def _grow(self, needed: int):
+        capacity = self._vectors.shape[0]
+        if needed <= capacity:
+            return
+        capacity = min(self.max_entries, max(needed, capacity * 2))
+        vectors = np.empty((capacity, self.dim), dtype=self._vectors.dtype)
+        vectors[:self._count] = self._vectors[:self._count]
+        last_used = np.empty(capacity, dtype=np.float64)
+        last_used[:self._count] = self._last_used[:self._count]
+        self._vectors, self._last_used = vectors, last_used
+        if self._assignments is not None:
+            assignments = np.full(capacity, -1, dtype=np.int32)
+            assignments[:self._count] = self._assignments[:self._count]
+            self._assignments = assignments
+
+    # -- IVF ---------------------------------------------------------------
+
+    def _train(self, iterations: int = 10, sample_size: int = 20_000):
+        """Cluster the current vectors with k-means and rebuild the inverted lists."""
+        started = time.perf_counter()
+        n_lists = max(1, int(np.sqrt(self._count)))
+        rng = np.random.default_rng(0)
+        vectors = self._vectors[:self._count]
+        sample = vectors[rng.choice(self._count, size=min(sample_size, self._count), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], size=min(n_lists, sample.shape[0]), replace=False)]
+
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(centroids.shape[0]):
+                members = sample[labels == c]
+                if members.shape[0]:
+                    centroids[c] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+
+        self._centroids = centroids.astype(self._vectors.dtype)
+        self._assignments = np.full(self._vectors.shape[0], -1, dtype=np.int32)
+        self._lists = [[] for _ in range(self._centroids.shape[0])]
+        for start in range(0, self._count, 65_536):
+            labels = np.argmax(vectors[start:start + 65_536] @ self._centroids.T, axis=1)
+            for offset, label in enumerate(labels):
+                self._assignments[start + offset] = label
+                self._lists[label].append(start + offset)
+        self._trained_at = self._count
+        logger.info(f"Trained IVF index: {self._count} vectors, {len(self._lists)} lists "
+                    f"in {time.perf_counter() - started:.2f}s")
+
+    def _assign(self, slot: int):
+        if self._centroids is None:
+            return
+        label = int(np.argmax(self._centroids @ self._vectors[slot]))
+        self._assignments[slot] = label
+        self._lists[label].append(slot)
+
+    def _unassign(self, slot: int):
+        if self._centroids is None:
+            return
+        self._lists[self._assignments[slot]].remove(slot)
+
+    def _probe(self, query: np.ndarray) -> np.ndarray:
+        nearest = np.argsort(-(self._centroids @ query))[:self.n_probe]
+        slots = [slot for label in nearest for slot in self._lists[label]]
+        return np.fromiter(slots, dtype=np.int64, count=len(slots))
+
+    # -- persistence -------------------------------------------------------
+
+    def save(self, path: str):
+        with self._lock:
+            np.savez(
+                path,
+                vectors=self._vectors[:self._count],
+                last_used=self._last_used[:self._count],
+                payloads=np.array(json.dumps(self._payloads)),
+            )
+
+    def load(self, path: str):
+        """Replace the contents with a file written by ``save``."""
+        with np.load(path) as data:
+            vectors = data["vectors"]
+            last_used = data["last_used"]
+            payloads = json.loads(str(data["payloads"]))
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            raise ValueError(f"{path} holds {vectors.shape[-1]}-d vectors, expected {self.dim}")
+
+        # Keep the most recently used entries if the file is larger than our cap
+        keep = np.argsort(-last_used)[:self.max_entries]
+        with self._lock:
+            self._count = 0
+            self._centroids = self._assignments = None
+            self._lists, self._trained_at = [], 0
+            self._grow(len(keep))
+            self._vectors[:len(keep)] = vectors[keep]
+            # Stored timestamps are from another process's monotonic clock;
+            # only their order matters.
+            self._last_used[:len(keep)] = np.arange(len(keep))[::-1] - len(keep)
+            self._payloads = [payloads[i] for i in keep]
+            self._count = len(keep)
+            if self._count >= self.approximate_threshold:
+                self._train()
@@ -0,0 +1,236 @@
+"""Memory-mapped safetensors weights for the MedBERT and BioGPT wrappers.
+
+With ``MMAP_WEIGHTS=1`` the registry loads each wrapper through
+``load_wrapper``: the ``Models`` module is imported with torch's default
+device set to ``meta`` (the model is built without allocating or reading any
+weights), then every parameter and buffer is pointed at a tensor mapped from
+``WEIGHTS_DIR/<name>.safetensors``.  Nothing is copied: cold start is a few
+page faults, and every process on the host mapping the same file shares its
+physical pages through the page cache.  The mapping is private, so the file
+is never written (a write would only copy the page it touches).
+
+The first start without an export loads the wrapper normally, writes the
+export and then swaps in the mapped tensors; ``python weights.py export``
+does the same ahead of a deploy.  Re-export after updating the models.  Only
+the ``fp32`` backend keeps the mapped tensors; ``int8`` and ``onnx`` build
+their own copies.
+
+``python weights.py memory --pid ...`` reports RSS and PSS (shared pages
+split between the processes mapping them) for running workers, in total and
+for the mapped weight files, to confirm the sharing.
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import struct
+import sys
+from typing import TYPE_CHECKING, Dict, List
+
+if TYPE_CHECKING:
+    import torch
+
+logger = logging.getLogger(__name__)
+
+MMAP_WEIGHTS = os.getenv("MMAP_WEIGHTS", "0") == "1"
+WEIGHTS_DIR = os.getenv("WEIGHTS_DIR", "weights")
+WRAPPERS = ("medbert", "biogpt")
+DATA_ALIGNMENT = 64
+
+
+class WeightsMismatch(Exception):
+    """The export does not match the model's parameters and buffers."""
+
+
+def weights_path(name: str, directory: str = WEIGHTS_DIR) -> str:
+    return os.path.join(directory, f"{name}.safetensors")
+
+
+def model_tensors(model) -> Dict[str, "torch.Tensor"]:
+    """Every parameter and buffer by qualified name, tied ones under each of their names."""
+    tensors = dict(model.named_parameters(remove_duplicate=False))
+    # Non-persistent buffers (position ids and the like) are left out of state_dict()
+    # but would stay on the meta device if the file did not carry them
+    tensors.update(model.named_buffers(remove_duplicate=False))
+    return tensors
+
+
+def export(model, path: str):
+    """Write ``model``'s tensors to ``path``; tied tensors are stored once and aliased in the metadata."""
+    unique, aliases, seen = {}, {}, {}
+    for name, tensor in model_tensors(model).items():
+        if tensor.is_meta:
+            raise WeightsMismatch(f"{name} has no data to export")
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape),
+               tuple(tensor.stride()), tensor.dtype)
+        if key in seen:
+            aliases[name] = seen[key]
+        else:
+            seen[key] = name
+            unique[name] = tensor.detach().contiguous()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    _save_aligned(unique, tmp, {"aliases": json.dumps(aliases)})
+    os.replace(tmp, path)  # concurrent workers never map a half-written file
+    logger.info(f"Exported {len(unique)} tensors ({os.path.getsize(path) / 2 ** 20:.0f} MB) to {path}")
+
+
+def _save_aligned(tensors: dict, path: str, metadata: Dict[str, str]):
+    """``save_file`` with the data section starting at a multiple of ``DATA_ALIGNMENT``.
+
+    The data follows the 8-byte length and the JSON header.  When its start is
+    misaligned, safetensors realigns the data inside the private mapping on
+    load, which dirties (copies) every page and defeats the sharing.  The
+    header is padded through a metadata entry until the offset fits.
+    """
+    from safetensors.torch import save_file
+
+    padding = 0
+    while True:
+        save_file(tensors, path, metadata={**metadata, "padding": " " * padding})
+        with open(path, "rb") as f:
+            offset = 8 + struct.unpack("<Q", f.read(8))[0]
+        if offset % DATA_ALIGNMENT == 0:
+            return
+        padding += DATA_ALIGNMENT - offset % DATA_ALIGNMENT
+
+
+def load_mapped(model, path: str) -> int:
+    """Point every parameter and buffer of ``model`` at tensors mapped from ``path``; returns bytes mapped."""
+    import torch
+    from safetensors import safe_open
+
+    with open(path, "rb") as f:
+        if (8 + struct.unpack("<Q", f.read(8))[0]) % DATA_ALIGNMENT:
+            logger.warning(f"{path} was not written by weights.export; loading it copies every page")
+    with safe_open(path, framework="pt") as f:
+        aliases = json.loads((f.metadata() or {}).get("aliases", "{}"))
+        mapped = {name: f.get_tensor(name) for name in f.keys()}
+    expected = model_tensors(model)
+    names = set(mapped) | set(aliases)
+    if names != set(expected):
+        missing, unexpected = sorted(set(expected) - names), sorted(names - set(expected))
+        raise WeightsMismatch(f"{path} does not match the model: missing {missing[:5]}, unexpected {unexpected[:5]}")
+
+    parameters = {}
+    for name, current in expected.items():
+        source = aliases.get(name, name)
+        tensor = mapped[source]
+        if tensor.shape != current.shape or tensor.dtype != current.dtype:
+            raise WeightsMismatch(f"{name}: {tuple(tensor.shape)} {tensor.dtype} in {path}, "
+                                  f"{tuple(current.shape)} {current.dtype} in the model")
+        module_name, _, attr = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if attr in module._parameters:
+            # Tied parameters stay one Parameter object, as the model built them
+            if source not in parameters:
+                parameters[source] = torch.nn.Parameter(tensor, requires_grad=False)
+            setattr(module, attr, parameters[source])
+        else:
+            module._buffers[attr] = tensor
+    return sum(tensor.nbytes for tensor in mapped.values())
+
+
+def _import_on_meta(module_name: str):
+    import torch
+
+    with torch.device("meta"):  # thread-local: requests served meanwhile are unaffected
+        return importlib.import_module(module_name)
+
+
+def load_wrapper(package: str, name: str, mmap: bool = MMAP_WEIGHTS, directory: str = WEIGHTS_DIR):
+    """Import ``<package>.<name>`` and return its ``name`` wrapper, on mapped weights if ``mmap``."""
+    module_name = f"{package}.{name}"
+    if not mmap:
+        return getattr(importlib.import_module(module_name), name)
+
+    path = weights_path(name, directory)
+    if os.path.exists(path):
+        try:
+            wrapper = getattr(_import_on_meta(module_name), name)
+            size = load_mapped(wrapper.model, path)
+            logger.info(f"{name}: mapped {size / 2 ** 20:.0f} MB of weights from {path}")
+            return wrapper
+        except Exception:
+            logger.exception(f"Could not build {name} on {path}; loading it normally")
+            sys.modules.pop(module_name, None)
+
+    wrapper = getattr(importlib.import_module(module_name), name)
+    if not _has_torch_model(wrapper):
+        logger.warning(f"{name} wrapper exposes no torch model; keeping its own weights")
+        return wrapper
+    if not os.path.exists(path):
+        export(wrapper.model, path)
+    load_mapped(wrapper.model, path)  # drops this process's private copy for the shared mapping
+    return wrapper
+
+
+def _has_torch_model(wrapper) -> bool:
+    import torch
+
+    return isinstance(getattr(wrapper, "model", None), torch.nn.Module)
+
+
+def _smaps_rollup(pid: int, suffix: str) -> Dict[str, Dict[str, int]]:
+    """Per mapped file ending in ``suffix``: Rss/Pss/Shared/Private kB summed over its mappings."""
+    files: Dict[str, Dict[str, int]] = {}
+    current = None
+    with open(f"/proc/{pid}/smaps") as smaps:
+        for line in smaps:
+            fields = line.split(None, 5)
+            if not fields[0].endswith(":"):  # a mapping header: address perms offset dev inode [path]
+                path = fields[5].strip() if len(fields) > 5 else ""
+                current = path if path.endswith(suffix) else None
+            elif current and fields[0] in ("Rss:", "Pss:", "Shared_Clean:", "Private_Clean:", "Private_Dirty:"):
+                counters = files.setdefault(current, {})
+                counters[fields[0][:-1]] = counters.get(fields[0][:-1], 0) + int(fields[1])
+    return files
+
+
+def memory_report(pid: int) -> dict:
+    """RSS and PSS of process ``pid``, in MB, overall and for its mapped ``.safetensors`` files."""
+    import psutil
+
+    info = psutil.Process(pid).memory_full_info()
+    weights = {
+        path: {key.lower() + "_mb": round(kb / 1024, 1) for key, kb in counters.items()}
+        for path, counters in _smaps_rollup(pid, ".safetensors").items()
+    }
+    return {"pid": pid, "rss_mb": round(info.rss / 2 ** 20, 1), "pss_mb": round(info.pss / 2 ** 20, 1),
+            "weights": weights}
+
+
+def export_all(package: str, directory: str, names: List[str]):
+    for name in names:
+        wrapper = load_wrapper(package, name, mmap=False)
+        if not _has_torch_model(wrapper):
+            raise SystemExit(f"{name} wrapper exposes no torch model to export")
+        export(wrapper.model, weights_path(name, directory))
+
+
+def main():
+    from inference import MODELS_PACKAGE
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export and inspect memory-mapped model weights.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_cmd = sub.add_parser("export", help="write the safetensors files the workers map")
+    export_cmd.add_argument("--package", default=MODELS_PACKAGE)
+    export_cmd.add_argument("--dir", default=WEIGHTS_DIR)
+    export_cmd.add_argument("--models", nargs="+", choices=WRAPPERS, default=list(WRAPPERS))
+    memory = sub.add_parser("memory", help="RSS/PSS of running processes and of their mapped weights")
+    memory.add_argument("--pid", type=int, nargs="+", required=True)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_all(args.package, args.dir, args.models)
+        return
+    reports = [memory_report(pid) for pid in args.pid]
+    total = {"rss_mb": round(sum(r["rss_mb"] for r in reports), 1),
+             "pss_mb": round(sum(r["pss_mb"] for r in reports), 1)}
+    print(json.dumps({"processes": reports, "total": total}, indent=2))
+
+
+if __name__ == "__main__":
+    main()